@@ -0,0 +1,41 @@
+from collections import defaultdict
+import utility
+import logging
+
+log = logging.getLogger(__name__)
+
+# agents of an agent host share one market data
+# subscription per venue, the group stands in for them
+# on the json channel and hands each message to every
+# agent watching that venue
+
+
+class AgentGroup:
+
+    def __init__(self, agents, account_id=None):
+        self.agents = list(agents)
+        self.account_id = account_id or utility.generate_account_id()
+        # market tag -> agents watching it
+        self.watchers = defaultdict(list)
+        for agent in self.agents:
+            for tag in getattr(agent, 'market_tags', ()):
+                self.watchers[tag].append(agent)
+
+    @property
+    def venues(self):
+        return list(self.watchers)
+
+    def subscriptions_for(self, market_tag):
+        """ union of what the agents watching a venue subscribe to """
+        subscriptions = set()
+        for agent in self.watchers[market_tag]:
+            agent_subscriptions = agent.subscriptions_for(market_tag)
+            if agent_subscriptions is None:
+                return None
+            subscriptions.update(agent_subscriptions)
+        return subscriptions
+
+    def handle_JSON(self, message: dict, market_tag: str):
+        for agent in self.watchers[market_tag]:
+            # agents rewrite messages in place
+            agent.handle_JSON(dict(message), market_tag)
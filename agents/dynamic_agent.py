@@ -5,14 +5,16 @@ from high_frequency_trading.hft.incoming_message import IncomingMessage
 import utility
 import string
 from random import choice
+import tracing
 import logging
 
 log = logging.getLogger(__name__)
+trace = tracing.get_tracer(__name__)
 
 # this is an active agent
-# listens on 2 different channels
+# listens on a channel per market it knows of
 # treats one as focal market and sends orders to it
-# treats other as external market and receives signals
+# treats others as external markets and receives signals
 # reacts to market events and readjusts position
 
 def generate_account_id(size=4):
@@ -25,9 +27,21 @@ class DynamicAgent(BaseMarketAgent):
     handled_ouch_events = ('C', 'U', 'E', 'A')
     handled_external_market_events = ('external_feed_change', )
     handled_focal_market_events = ('post_batch', 'bbo_change', 'signed_volume_change', 'reference_price_change')
-
-    def __init__(self, session_id, *args, **kwargs):
+    # message types as proxies publish them, before transform_incoming_message,
+    # declared when connecting so proxies only send what is handled above.
+    # keyed by the role of the market, None takes every type: all
+    # external messages but reference prices become external_feed_change
+    json_subscriptions = {
+        'focal': ('post_batch', 'bbo', 'signed_volume', 'reference_price'),
+        'external': None,
+    }
+
+    def __init__(self, session_id, *args, focal_market='focal', 
+                 external_markets=('external',), **kwargs):
         super().__init__(session_id, *args, **kwargs)
+        # market tags, json channels are named after them
+        self.focal_market = focal_market
+        self.external_markets = tuple(external_markets)
         self.model = self.trader_model_cls(
             self.session_id, 0, self.id, self.id, 'automated', '', 0, 
             firm=self.account_id, **kwargs)
@@ -35,20 +49,33 @@ class DynamicAgent(BaseMarketAgent):
         # with fields e_best_bid e_best_offer e_signed_volume
         # so I need a hack as market proxies always send those 
         # separately, this is very specific to elo environment
-        self.external_market_state = {'e_best_bid': None, 'e_best_offer': None, 
-            'e_signed_volume': 0}
+        self.external_market_state = utility.ExternalFeedState(
+            self.external_markets)
+
+    def market_role(self, market_tag):
+        if market_tag == self.focal_market:
+            return 'focal'
+        if market_tag in self.external_markets:
+            return 'external'
+
+    @property
+    def market_tags(self):
+        return (self.focal_market, ) + self.external_markets
+
+    def subscriptions_for(self, market_tag):
+        return self.json_subscriptions.get(self.market_role(market_tag))
 
     @db.freeze_state()   
-    def handle_JSON(self, message: dict, type_code:str):
+    def handle_JSON(self, message: dict, market_tag:str):
+        type_code = self.market_role(market_tag)
         clean_message = utility.transform_incoming_message(type_code, message,
-            self.external_market_state)
+            self.external_market_state, venue=market_tag)
         msg_type = clean_message['type']
-        log.info('received json message with type --> %s' % msg_type)
+        trace.debug('json_received', self.account_id, market_tag, msg_type)
         if (type_code == 'focal' and msg_type in self.handled_focal_market_events) or (
             type_code == 'external' and msg_type in self.handled_external_market_events):
             msg = IncomingMessage(clean_message)
-            log.info('agent %s:%s --> handling json message %s:%s' % (
-                self.account_id, self.typecode, type_code, msg))
+            trace.info('json_handled', self.account_id, market_tag, msg_type)
             event = self.event_cls(type_code, msg)
             self.model.handle_event(event)
             self.process_event(event)
@@ -57,10 +84,10 @@ class DynamicAgent(BaseMarketAgent):
     @db.freeze_state()           
     def handle_OUCH(self, msg):
         event = self.event_cls('OUCH', msg)
-        log.info('received ouch message with type --> %s' % event.event_type)
+        trace.debug('ouch_received', self.account_id, event.event_type)
         if event.event_type in self.handled_ouch_events:
-            log.info('agent %s:%s --> handling ouch message %s' % (
-                self.account_id ,self.typecode, msg))
+            trace.info('ouch_handled', self.account_id, event.event_type, 
+                       getattr(msg, 'order_token', None))
             self.model.handle_event(event)
             self.process_event(event)
         return event
@@ -70,8 +97,7 @@ class DynamicAgent(BaseMarketAgent):
         clean_message = utility.transform_incoming_message('scheduled event', 
                             event_data)
         clean_message = IncomingMessage(clean_message)
-        log.info('agent %s:%s: received discrete event message %s' % (
-                    self.account_id, self.typecode, clean_message))
+        trace.info('discrete_event', self.account_id, clean_message['type'])
         event = self.event_cls('scheduled event', clean_message)
         self.model.handle_event(event)
         self.process_event(event)
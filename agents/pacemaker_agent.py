@@ -4,9 +4,11 @@ from utility import MockWSMessage
 from discrete_event_emitter import RandomOrderEmitter
 import draw
 from db import db
+import tracing
 import logging
 
 log = logging.getLogger(__name__)
+trace = tracing.get_tracer(__name__)
 
 # this is a passive agent
 # given a random order generator
@@ -32,8 +34,7 @@ class PaceMakerAgent(BaseMarketAgent):
     @db.freeze_state() 
     def handle_OUCH(self, msg):
         event = self.event_cls('exchange', msg)
-        log.info('agent %s:%s --> handling ouch message %s' % (
-                  self.account_id ,self.typecode, event.event_type))
+        trace.info('ouch_handled', self.account_id, event.event_type)
         self.model.handle_event(event)
         return event
 
@@ -0,0 +1,92 @@
+from twisted.internet import reactor, task
+from protocols.ouch_proxy_protocol import (
+    ProxyOuchServerFactory, ProxyOuchClientFactory)
+from protocols.json_line_protocol import (
+    JSONLineServerFactory, JSONLineClientFactory)
+from protocols.ouch_trade_client_protocol import OUCHClientFactory
+from protocols.loopback import connect_loopback
+from builders import build_agent, build_agent_from_manifest, build_market_proxy
+from primitives.base_market_agent import watch_agents
+from utility import get_interactive_agent_count
+import metrics
+import topology
+import logging
+
+log = logging.getLogger(__name__)
+
+# runs proxies, rabbits and interactive agents of a session
+# in a single reactor. proxies talk to the exchanges over tcp,
+# everything else is wired with in memory loopback transports.
+
+
+def run_session(session_code, params: dict, exchanges: dict, random_seed,
+                manifest=None):
+    """
+    given a session code, parameters and a mapping of
+    market tag to (exchange host, exchange port)
+    runs the session until session duration is over,
+    blocks until the reactor stops.
+    agents come from the compiled session `manifest` if there is one
+    """
+    session_duration = params['session_duration']
+    markets = topology.get_markets(params)
+    proxies, ouch_factories, json_factories = {}, {}, {}
+    for market in markets:
+        tag = market['tag']
+        exchange_host, exchange_port = exchanges[tag]
+        proxy = build_market_proxy(
+            tag, session_code, exchange_host, exchange_port, params,
+            market_id=market['market_id'])
+        reactor.connectTCP(exchange_host, exchange_port,
+                           ProxyOuchClientFactory(proxy))
+        proxies[tag] = proxy
+        ouch_factories[tag] = ProxyOuchServerFactory(proxy)
+        json_factories[tag] = JSONLineServerFactory(proxy)
+
+    agents = []
+    # the manifest lists rabbits in topology order
+    for i, (tag, config_num, seed) in enumerate(
+            topology.get_rabbits(markets, random_seed)):
+        if manifest is not None:
+            rabbit = build_agent_from_manifest(manifest, 'rabbit', i)
+        else:
+            rabbit = build_agent(
+                'rabbit', session_code, session_duration, params,
+                config_num=config_num, random_seed=seed)
+        connect_loopback(ouch_factories[tag], OUCHClientFactory(rabbit))
+        agents.append(rabbit)
+
+    for config_num in range(
+            get_interactive_agent_count(params['agent_state_configs'])):
+        if manifest is not None:
+            agent = build_agent_from_manifest(manifest, 'elo', config_num)
+            focal, external = agent.focal_market, list(agent.external_markets)
+        else:
+            focal, external = topology.get_agent_markets(
+                params, config_num, markets)
+            agent = build_agent(
+                'elo', session_code, session_duration, params,
+                config_num=config_num, focal_market=focal, 
+                external_markets=external)
+        connect_loopback(ouch_factories[focal], OUCHClientFactory(agent))
+        for tag in [focal] + external:
+            connect_loopback(json_factories[tag],
+                             JSONLineClientFactory(tag, agent))
+        agents.append(agent)
+
+    for agent in agents:
+        agent.ready()
+    watch_agents(agents)
+    metrics.watch_reactor(reactor)
+    log.info('session %s: %s agents and %s markets in one reactor.' % (
+        session_code, len(agents), len(proxies)))
+
+    def close_session():
+        for agent in agents:
+            agent.close_session()
+        for proxy in proxies.values():
+            proxy.close_session()
+
+    d = task.deferLater(reactor, session_duration, close_session)
+    d.addCallback(lambda _: reactor.stop())
+    reactor.run()
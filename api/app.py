@@ -1,46 +1,199 @@
-from flask import Flask, jsonify, request
-from simulate import run_elo_simulation
-from utility import random_chars, dict_stringify, get_simulation_parameters
-import subprocess
-import sys
+from flask import Flask, Response, jsonify, request, stream_with_context
+from prometheus_client import CONTENT_TYPE_LATEST
+from jobs import JobQueue, SIMULATE_FLAGS, QUEUED, RUNNING, SUCCEEDED
+from metrics import session_metrics_text
+from db.db_commands import models, iter_session_rows
+from utility import dict_stringify, get_simulation_parameters
+import settings
+import datetime
+import atexit
+import json
 
 app = Flask(__name__)
 
-simulator_process = None
-
 """
-endpoint to trigger a simulation
-ensures only one simulation is running at time
-does not block, and responds to client right away.
-runs simulation asyncly
+simulations run as jobs, queued and run `settings.api_job_concurrency`
+at a time. endpoints do not block, jobs are polled by id
+and their results are paged through once they succeed.
 """
 
 success_message = 'scheduled simulation: code --> %s, debug --> %s, note --> %s, \
 parameters --> %s'
 
+job_queue = JobQueue().start()
+atexit.register(job_queue.close)
+
+record_classes = {model_cls.tag: model_cls for model_cls in models}
+
+
+def submit_job(payload: dict, args):
+    """ queues a job as the request describes it, ValueError if invalid """
+    flags = [flag for flag in SIMULATE_FLAGS
+             if payload.get(flag) or args.get(flag)]
+    parameters = payload.get('parameters')
+    if parameters is not None and not isinstance(parameters, dict):
+        raise ValueError('parameters must be an object')
+    return job_queue.submit(note=payload.get('note'), parameters=parameters,
+                            flags=flags)
+
+
+def describe(job):
+    job_dict = job.to_dict()
+    if job.status == QUEUED:
+        job_dict['queue_position'] = job_queue.position(job)
+    return job_dict
+
 
 @app.route('/v1/simulate', methods=['GET', 'POST'])
 def simulate():
     """ simulator end point, normally this should be receiving
     configurations in request payload, but not a requirement for now
     """
-    params = request.args
-    debug = params.get('debug', False)
-    global simulator_process
-    if simulator_process and simulator_process.poll() is None:
-        return respond_with_message('simulator already running', 503)
-    else:
-        session_code = random_chars(8)
-        note = ''
-        payload = request.json
-        if payload:
-            note = payload.get('note')
-        simulator_process = subprocess.Popen(
-            [sys.executable, 'simulate.py', '--session_code', session_code,
-             '--note', note, '--debug' if debug else ''])
-        params_str = dict_stringify(get_simulation_parameters())
-        return respond_with_message(success_message % (
-                                    session_code, debug, note, params_str), 200)
+    payload = request.get_json(silent=True) or {}
+    try:
+        job = submit_job(payload, request.args)
+    except ValueError as e:
+        return respond_with_message(str(e), 400)
+    params_str = dict_stringify(job.parameters or get_simulation_parameters())
+    response = describe(job)
+    response['message'] = success_message % (
+        job.session_code, 'debug' in job.flags, job.note, params_str)
+    return jsonify(response), 202
+
+
+@app.route('/v1/jobs', methods=['POST'])
+def submit_jobs():
+    """
+    queues `sessions` jobs of the same configuration,
+    returns them in submission order
+    """
+    payload = request.get_json(silent=True) or {}
+    sessions = payload.get('sessions', 1)
+    if not isinstance(sessions, int) or sessions < 1:
+        return respond_with_message('sessions must be a positive integer', 400)
+    try:
+        submitted = [submit_job(payload, request.args)
+                     for _ in range(sessions)]
+    except ValueError as e:
+        return respond_with_message(str(e), 400)
+    return jsonify({'jobs': [describe(job) for job in submitted]}), 202
+
+
+@app.route('/v1/jobs', methods=['GET'])
+def list_jobs():
+    status = request.args.get('status')
+    return jsonify({'jobs': [describe(job) for job in job_queue.list(status)]})
+
+
+@app.route('/v1/jobs/<job_id>', methods=['GET'])
+def job_status(job_id):
+    job = job_queue.get(job_id)
+    if job is None:
+        return respond_with_message('no job %s' % job_id, 404)
+    return jsonify(describe(job))
+
+
+@app.route('/v1/jobs/<job_id>', methods=['DELETE'])
+def cancel_job(job_id):
+    job = job_queue.get(job_id)
+    if job is None:
+        return respond_with_message('no job %s' % job_id, 404)
+    if not job_queue.cancel(job):
+        return respond_with_message('job %s already %s' % (
+            job_id, job.status), 409)
+    return jsonify(describe(job))
+
+
+@app.route('/v1/jobs/<job_id>/results/<record_class>', methods=['GET'])
+def job_results(job_id, record_class):
+    """
+    a page of session records, streamed as they are read from the db.
+    `after` and `limit` select the page, the response ends with
+    the `after` cursor of the next page, null on the last one
+    """
+    job = job_queue.get(job_id)
+    if job is None:
+        return respond_with_message('no job %s' % job_id, 404)
+    if job.status != SUCCEEDED:
+        return respond_with_message('job %s is %s, results are ready once '
+                                    'it succeeds' % (job_id, job.status), 409)
+    if record_class not in record_classes:
+        return respond_with_message('record class is one of %s' % ', '.join(
+            sorted(record_classes)), 404)
+    after = request.args.get('after')
+    try:
+        limit = int(request.args.get('limit', settings.api_result_page_size))
+        key = None if after is None else decode_cursor(after)
+    except ValueError:
+        return respond_with_message('limit must be an integer, after a '
+                                    'cursor of an earlier page', 400)
+    if not 0 < limit <= settings.api_result_page_size:
+        return respond_with_message('limit is at most %s' % 
+                                    settings.api_result_page_size, 400)
+    rows = iter_session_rows(
+        job.session_code, record_classes[record_class], after=key,
+        # one more row tells if there is a next page
+        limit=limit + 1, chunk_size=settings.api_result_chunk_size)
+    return Response(stream_with_context(
+        stream_page(job, record_class, rows, after, limit)),
+        mimetype='application/json')
+
+
+CURSOR_TIME_FORMAT = '%Y-%m-%dT%H:%M:%S.%f'
+
+
+def encode_cursor(key):
+    """ the ("timestamp", id) key of a row as a page cursor """
+    timestamp, row_id = key
+    return '%s_%s' % (timestamp.strftime(CURSOR_TIME_FORMAT), row_id)
+
+
+def decode_cursor(cursor):
+    """ a ("timestamp", id) key, ValueError if `cursor` is not one """
+    timestamp, _, row_id = cursor.rpartition('_')
+    return (datetime.datetime.strptime(timestamp, CURSOR_TIME_FORMAT),
+            int(row_id))
+
+
+def stream_page(job, record_class, rows, after, limit):
+    yield '{"job_id": %s, "session_code": %s, "record_class": %s, ' \
+          '"after": %s, "rows": [' % (json.dumps(job.id),
+          json.dumps(job.session_code), json.dumps(record_class), 
+          json.dumps(after))
+    count, last_key, next_cursor = 0, None, None
+    try:
+        for key, row in rows:
+            if count == limit:
+                next_cursor = encode_cursor(last_key)
+                break
+            yield (',\n' if count else '\n') + json.dumps(row, default=str)
+            count, last_key = count + 1, key
+    finally:
+        # releases the cursor if the client leaves early
+        rows.close()
+    yield '\n], "count": %s, "next": %s}\n' % (
+        count, json.dumps(next_cursor))
+
+
+@app.route('/v1/metrics', methods=['GET'])
+def running_metrics():
+    """ live metrics of the sessions of running jobs, prometheus text """
+    return metrics_response(lambda: [
+        job.session_code for job in job_queue.list(RUNNING)])
+
+
+@app.route('/v1/jobs/<job_id>/metrics', methods=['GET'])
+def job_metrics(job_id):
+    """ metrics of a job, the last dumped values once it finished """
+    job = job_queue.get(job_id)
+    if job is None:
+        return respond_with_message('no job %s' % job_id, 404)
+    return metrics_response([job.session_code])
+
+
+def metrics_response(session_codes):
+    return Response(session_metrics_text(session_codes), 
+                    content_type=CONTENT_TYPE_LATEST)
 
 
 def respond_with_message(message: str, response_code):
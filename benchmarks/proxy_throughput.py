@@ -0,0 +1,428 @@
+# proxy throughput benchmark
+# drives a market proxy with synthetic ouch enter / replace / cancel
+# traffic from many connections, the proxy talks to a stub exchange
+# that answers every request. sweeps connection counts and message rates,
+# each point runs in a fresh process and reports sustained messages/sec,
+# round trip latency percentiles, cpu per message and peak memory.
+#
+#   python -m benchmarks.proxy_throughput --connections 1 4 16 --rates 1000 5000
+#
+# load generators and the stub exchange share the process with the proxy,
+# so cpu per message includes their cost too. --baseline connects load
+# generators straight to the stub exchange to measure that part alone.
+import configargparse
+import settings
+from twisted.internet import protocol, reactor, task
+from latency import LatencyHistogram
+from collections import deque
+import subprocess
+import resource
+import struct
+import json
+import time
+import sys
+import logging
+
+log = logging.getLogger(__name__)
+
+p = configargparse.getArgParser()
+p.add('--connections', type=int, nargs='+', default=[1, 4, 16])
+p.add('--rates', type=int, nargs='+', default=[1000, 5000, 20000],
+      help='messages per second, over all connections')
+p.add('--duration', type=float, default=5, help='seconds measured per point')
+p.add('--warmup', type=float, default=1)
+p.add('--json_subscribers', type=int, default=4)
+p.add('--execution_interval', type=int, default=10,
+      help='the stub exchange executes every nth accepted order')
+p.add('--snapshots', choices=('memory', 'db'), default='memory',
+      help='build snapshots only, or write them to the database too')
+p.add('--baseline', action='store_true',
+      help='connect load generators to the stub exchange, without a proxy')
+p.add('--output', help='append results as json lines to this file')
+p.add('--run_one', action='store_true', help='run a single point, used by the sweep')
+p.add('--debug', action='store_true')
+options, args = p.parse_known_args()
+
+# ouch 4.2 layouts, as exchange_server speaks them
+ENTER = struct.Struct('!c14scI8sII4scccIcc')
+REPLACE = struct.Struct('!c14s14sIIIccI')
+CANCEL = struct.Struct('!c14sI')
+ACCEPTED = struct.Struct('!cQ14scI8sII4scQccIccc')
+REPLACED = struct.Struct('!cQ14scI8sII4scQccIcc14sc')
+CANCELED = struct.Struct('!cQ14sIc')
+EXECUTED = struct.Struct('!cQ14sIIcQ')
+BEST_QUOTE = struct.Struct('!cQ8sIIIIII')
+
+inbound_sizes = {b'O': ENTER.size, b'U': REPLACE.size, b'C': CANCEL.size,
+    b'S': 10}
+outbound_sizes = {b'A': ACCEPTED.size, b'U': REPLACED.size,
+    b'C': CANCELED.size, b'E': EXECUTED.size, b'Q': BEST_QUOTE.size, b'S': 10}
+STOCK = b'AMAZGOOG'
+
+
+def exchange_timestamp():
+    """ nanoseconds since midnight """
+    return int(time.time() % 86400 * 1e9)
+
+
+class FrameReceiver(protocol.Protocol):
+    """ splits a stream of fixed size ouch messages """
+    sizes = {}
+
+    def __init__(self):
+        self.buffer = bytearray()
+
+    def connectionMade(self):
+        # no nagle delays on the harness side of the connections
+        self.transport.setTcpNoDelay(True)
+
+    def dataReceived(self, data):
+        buffer = self.buffer
+        buffer.extend(data)
+        offset = 0
+        while offset < len(buffer):
+            header = buffer[offset:offset + 1]
+            size = self.sizes.get(bytes(header))
+            if size is None:
+                log.error('unknown message type %s, dropping connection' % header)
+                self.transport.loseConnection()
+                break
+            if len(buffer) - offset < size:
+                break
+            self.frameReceived(bytes(buffer[offset:offset + size]))
+            offset += size
+        del buffer[:offset]
+
+    def frameReceived(self, frame):
+        raise NotImplementedError()
+
+
+class StubExchange(FrameReceiver):
+    """ accepts, replaces and cancels every order it is asked to """
+    sizes = inbound_sizes
+
+    def __init__(self, factory):
+        super().__init__()
+        self.factory = factory
+
+    def connectionMade(self):
+        super().connectionMade()
+        self.factory.connections.append(self)
+
+    def connectionLost(self, reason):
+        self.factory.connections.remove(self)
+
+    def frameReceived(self, frame):
+        header = frame[:1]
+        orders = self.factory.orders
+        if header == b'O':
+            (_, token, buy_sell, shares, stock, price, time_in_force, firm,
+                display, capacity, iso, min_qty, cross, _) = ENTER.unpack(frame)
+            orders[token] = order = [buy_sell, shares, stock, price,
+                time_in_force, firm, display, capacity, iso, min_qty, cross]
+            self.transport.write(ACCEPTED.pack(
+                b'A', exchange_timestamp(), token, buy_sell, shares, stock,
+                price, time_in_force, firm, display, self.factory.next_ref(),
+                capacity, iso, min_qty, cross, b'L', b' '))
+            self.factory.accepted += 1
+            if self.factory.accepted % self.factory.execution_interval == 0:
+                self.execute(token, order)
+        elif header == b'U':
+            (_, existing_token, token, shares, price, time_in_force, display,
+                iso, min_qty) = REPLACE.unpack(frame)
+            order = orders.pop(existing_token, None)
+            if order is None:
+                return
+            order[1], order[3], order[4], order[6], order[8], order[9] = (
+                shares, price, time_in_force, display, iso, min_qty)
+            orders[token] = order
+            (buy_sell, shares, stock, price, time_in_force, firm, display,
+                capacity, iso, min_qty, cross) = order
+            self.transport.write(REPLACED.pack(
+                b'U', exchange_timestamp(), token, buy_sell, shares, stock,
+                price, time_in_force, firm, display, self.factory.next_ref(),
+                capacity, iso, min_qty, cross, b'L', existing_token, b' '))
+        elif header == b'C':
+            _, token, _ = CANCEL.unpack(frame)
+            order = orders.pop(token, None)
+            if order is not None:
+                self.transport.write(CANCELED.pack(
+                    b'C', exchange_timestamp(), token, order[1], b'U'))
+
+    def execute(self, token, order):
+        # a single share, the order stays live
+        price = order[3]
+        self.transport.write(EXECUTED.pack(
+            b'E', exchange_timestamp(), token, 1, price, b'A',
+            self.factory.next_ref()))
+        quote = BEST_QUOTE.pack(
+            b'Q', exchange_timestamp(), STOCK, price - 1, 1, price + 1, 1,
+            price - 2, price + 2)
+        for conn in self.factory.connections:
+            conn.transport.write(quote)
+
+
+class StubExchangeFactory(protocol.ServerFactory):
+
+    def __init__(self, execution_interval):
+        self.execution_interval = execution_interval
+        self.connections = []
+        self.orders = {}
+        self.accepted = 0
+        self.order_ref = 0
+
+    def next_ref(self):
+        self.order_ref += 1
+        return self.order_ref
+
+    def buildProtocol(self, addr):
+        return StubExchange(self)
+
+
+class LoadStats:
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.sent = 0
+        self.responses = 0
+        self.executions = 0
+        self.quotes = 0
+        self.json_lines = 0
+        self.latency = LatencyHistogram()
+
+
+class LoadGenerator(FrameReceiver):
+    """
+    enters orders, replaces the latest accepted order
+    and cancels the oldest one, in turns
+    """
+    sizes = outbound_sizes
+
+    def __init__(self, firm: bytes, stats: LoadStats):
+        super().__init__()
+        self.firm = firm
+        self.stats = stats
+        self.live = deque()
+        self.sent_at = {}
+        self.order_count = 0
+        self.step = 0
+
+    def next_token(self):
+        self.order_count += 1
+        return b'%s%010d' % (self.firm, self.order_count)
+
+    def send_next(self):
+        step = self.step % 3
+        self.step += 1
+        if step == 1 and self.live:
+            existing_token, token = self.live.pop(), self.next_token()
+            frame = REPLACE.pack(b'U', existing_token, token, 100,
+                                 1000000 + self.step % 100, 5, b'Y', b'N', 0)
+        elif step == 2 and self.live:
+            token = self.live.popleft()
+            frame = CANCEL.pack(b'C', token, 0)
+        else:
+            token = self.next_token()
+            frame = ENTER.pack(
+                b'O', token, b'B' if self.step % 2 else b'S', 100, STOCK,
+                1000000 + self.step % 100, 5, self.firm, b'Y', b'P', b'N', 0,
+                b'N', b'R')
+        self.sent_at[token] = time.monotonic()
+        self.stats.sent += 1
+        self.transport.write(frame)
+
+    def frameReceived(self, frame):
+        header = frame[:1]
+        stats = self.stats
+        if header == b'Q':
+            stats.quotes += 1
+            return
+        token = frame[9:23]
+        if header == b'E':
+            stats.executions += 1
+            return
+        sent_at = self.sent_at.pop(token, None)
+        if sent_at is not None:
+            stats.latency.record(time.monotonic() - sent_at)
+            stats.responses += 1
+        if header in (b'A', b'U'):
+            self.live.append(token)
+
+
+class LoadGeneratorFactory(protocol.ClientFactory):
+
+    def __init__(self, firm, stats, connections):
+        self.firm = firm
+        self.stats = stats
+        self.connections = connections
+
+    def buildProtocol(self, addr):
+        conn = LoadGenerator(self.firm, self.stats)
+        self.connections.append(conn)
+        return conn
+
+
+class JSONSubscriber:
+    """ stands in for a trader, counts public messages """
+
+    def __init__(self, account_id, stats):
+        self.account_id = account_id
+        self.stats = stats
+
+    def handle_JSON(self, message, type_code):
+        self.stats.json_lines += 1
+
+
+class LoadDriver:
+    """ spreads `rate` messages per second over connections """
+    tick = 0.001
+
+    def __init__(self, connections, rate):
+        self.connections = connections
+        self.rate = rate
+        self.credit = 0
+        self.last_tick = None
+        self.turn = 0
+
+    def start(self):
+        self.last_tick = time.monotonic()
+        task.LoopingCall(self.send).start(self.tick, now=False)
+
+    def send(self):
+        now = time.monotonic()
+        self.credit += (now - self.last_tick) * self.rate
+        self.last_tick = now
+        connections = self.connections
+        while self.credit >= 1:
+            self.credit -= 1
+            connections[self.turn % len(connections)].send_next()
+            self.turn += 1
+
+
+def start_proxy(exchange_port, stats):
+    """ returns the proxy and the port load generators connect to """
+    # imported here so a baseline runs without the proxy dependencies
+    from protocols.ouch_proxy_protocol import (
+        ProxyOuchServerFactory, ProxyOuchClientFactory)
+    from protocols.json_line_protocol import (
+        JSONLineServerFactory, JSONLineClientFactory)
+    from builders import build_market_proxy
+    proxy = build_market_proxy(
+        'focal', 'benchmark', '127.0.0.1', exchange_port,
+        dict(settings.default_simulation_parameters))
+    reactor.connectTCP('127.0.0.1', exchange_port,
+                       ProxyOuchClientFactory(proxy))
+    ouch_port = reactor.listenTCP(0, ProxyOuchServerFactory(proxy),
+                                  interface='127.0.0.1').getHost().port
+    json_port = reactor.listenTCP(0, JSONLineServerFactory(proxy),
+                                  interface='127.0.0.1').getHost().port
+    for i in range(options.json_subscribers):
+        reactor.connectTCP('127.0.0.1', json_port, JSONLineClientFactory(
+            'focal', JSONSubscriber('J%03d' % i, stats)))
+    return proxy, ouch_port
+
+
+def run_one(connections, rate):
+    """ runs a single point of the sweep, prints its results as json """
+    if options.snapshots == 'memory':
+        settings.db_dry_run = True
+    stats = LoadStats()
+    exchange_port = reactor.listenTCP(
+        0, StubExchangeFactory(options.execution_interval),
+        interface='127.0.0.1').getHost().port
+    proxy, port = (None, exchange_port) if options.baseline else start_proxy(
+        exchange_port, stats)
+    generators = []
+    for i in range(connections):
+        reactor.connectTCP('127.0.0.1', port, LoadGeneratorFactory(
+            b'%04d' % i, stats, generators))
+    driver = LoadDriver(generators, rate)
+    result = {}
+
+    def start_measuring():
+        stats.reset()
+        result['cpu'] = time.process_time()
+        result['wall'] = time.monotonic()
+
+    def stop():
+        wall = time.monotonic() - result['wall']
+        cpu = time.process_time() - result['cpu']
+        result.clear()
+        result.update({
+            'connections': connections,
+            'offered_rate': rate,
+            'baseline': options.baseline,
+            'snapshots': options.snapshots,
+            'sent_per_sec': round(stats.sent / wall, 1),
+            'messages_per_sec': round(stats.responses / wall, 1),
+            'p50_us': stats.latency.percentile(50),
+            'p99_us': stats.latency.percentile(99),
+            'cpu_per_message_us': round(cpu / stats.responses * 1e6, 2) if
+                stats.responses else None,
+            'max_rss_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+            'executions': stats.executions,
+            'quotes': stats.quotes,
+            'json_lines': stats.json_lines,
+            'unanswered': sum(len(g.sent_at) for g in generators),
+            'flow': proxy.flow_stats() if proxy else None,
+        })
+        reactor.stop()
+
+    # connections are set up during warmup
+    reactor.callLater(0.2, driver.start)
+    reactor.callLater(options.warmup, start_measuring)
+    reactor.callLater(options.warmup + options.duration, stop)
+    reactor.run()
+    print(json.dumps(result))
+
+
+def current_commit():
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', '--short', 'HEAD'],
+            stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def sweep():
+    commit = current_commit()
+    results = []
+    for connections in options.connections:
+        for rate in options.rates:
+            cmd = [sys.executable, '-m', 'benchmarks.proxy_throughput',
+                '--run_one', '--connections', str(connections),
+                '--rates', str(rate),
+                '--duration', str(options.duration),
+                '--warmup', str(options.warmup),
+                '--json_subscribers', str(options.json_subscribers),
+                '--execution_interval', str(options.execution_interval),
+                '--snapshots', options.snapshots]
+            if options.baseline:
+                cmd.append('--baseline')
+            if options.debug:
+                cmd.append('--debug')
+            out = subprocess.check_output(cmd).decode()
+            result = json.loads(out.strip().splitlines()[-1])
+            result['commit'] = commit
+            results.append(result)
+            print('connections: {connections:>4} offered: {offered_rate:>7}/s '
+                  'sustained: {messages_per_sec:>9}/s p50: {p50_us}us '
+                  'p99: {p99_us}us cpu/msg: {cpu_per_message_us}us '
+                  'rss: {max_rss_kb}kb'.format(**result))
+            if options.output:
+                with open(options.output, 'a') as f:
+                    f.write(json.dumps(result) + '\n')
+    return results
+
+
+if __name__ == '__main__':
+    logging.basicConfig(
+        level=logging.DEBUG if options.debug else logging.WARNING,
+        stream=sys.stderr)
+    if options.run_one:
+        run_one(options.connections[0], options.rates[0])
+    else:
+        sweep()
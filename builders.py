@@ -0,0 +1,74 @@
+import draw
+import utility
+from discrete_event_emitter import (
+    RandomOrderEmitter, ELOSliderChangeEmitter, ELOSpeedChangeEmitter)
+from agents.pacemaker_agent import PaceMakerAgent
+from agents.dynamic_agent import DynamicAgent
+from proxies.elo_market_proxy import ELOMarketProxy
+from journal import open_session_journal
+import logging
+
+log = logging.getLogger(__name__)
+
+# constructors shared by the per process entry points
+# (run_agent.py, run_proxy.py) and the all in one session
+# runner, so both modes build identical agents and markets
+
+
+def build_agent(agent_type, session_code, session_duration, conf: dict,
+                config_num=0, random_seed=None, account_id=None,
+                exchange_host=None, exchange_ouch_port=None,
+                focal_market='focal', external_markets=('external',)):
+    agent_parameters = {}
+    if agent_type == 'rabbit':
+        random_orders = draw.elo_draw(
+            session_duration, conf,
+            seed=random_seed, config_num=config_num)
+        event_emitters = [RandomOrderEmitter(source_data=random_orders), ]
+        agent_cls = PaceMakerAgent
+    elif agent_type == 'elo':
+        events = utility.transform_agent_events_array(
+            conf['agent_state_configs'], config_num)
+        event_emitters = [ELOSliderChangeEmitter(source_data=events['slider']), 
+            ELOSpeedChangeEmitter(source_data=events['speed'])]
+        agent_cls = DynamicAgent
+        agent_parameters.update(utility.get_elo_agent_parameters())
+        agent_parameters.update(focal_market=focal_market, 
+                                external_markets=external_markets)
+    else:
+        raise ValueError('invalid agent type %s' % agent_type)
+    return agent_cls(session_code, exchange_host, exchange_ouch_port,
+        event_emitters=event_emitters, account_id=account_id, 
+        **agent_parameters)
+
+
+def build_agent_from_manifest(manifest, agent_type, index, exchange_host=None,
+                              exchange_ouch_port=None):
+    """ an agent of a compiled session manifest, tapes are not redrawn """
+    entry = manifest.agent(agent_type, index)
+    agent_parameters = {}
+    if agent_type == 'rabbit':
+        event_emitters = [
+            RandomOrderEmitter(source_data=manifest.tape(entry['orders'])), ]
+        agent_cls = PaceMakerAgent
+    else:
+        event_emitters = [
+            ELOSliderChangeEmitter(source_data=manifest.tape(entry['slider'])),
+            ELOSpeedChangeEmitter(source_data=manifest.tape(entry['speed']))]
+        agent_cls = DynamicAgent
+        agent_parameters.update(manifest.data['elo_agent_parameters'])
+        agent_parameters.update(focal_market=entry['focal_market'],
+                                external_markets=entry['external_markets'])
+    return agent_cls(manifest.session_code, exchange_host, exchange_ouch_port,
+        event_emitters=event_emitters, account_id=entry['account_id'],
+        **agent_parameters)
+
+
+def build_market_proxy(tag, session_code, exchange_host, exchange_port,
+                       conf: dict, market_proxy_cls=ELOMarketProxy, 
+                       market_id=None):
+    proxy = market_proxy_cls(
+        tag, session_code, exchange_host, exchange_port, 
+        market_id=market_id, **conf)
+    proxy.journal = open_session_journal(session_code, tag)
+    return proxy
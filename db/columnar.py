@@ -0,0 +1,94 @@
+from peewee import CharField, DateTimeField, IntegerField, FloatField
+from numpy.lib.format import open_memmap
+import numpy as np
+import settings
+import glob
+import os
+import logging
+
+log = logging.getLogger(__name__)
+
+# typed, memory mappable session results.
+# one structured numpy array per record class, saved as .npy
+# so loading a session maps the file instead of parsing text
+
+# null integers, integer columns stay int64 in every session
+INT_NULL = np.iinfo(np.int64).min
+# width of text columns, ids and message type names fit in it,
+# longer text is cut
+TEXT_WIDTH = 32
+
+
+def field_dtype(field):
+    if isinstance(field, DateTimeField):
+        return np.dtype('datetime64[us]')
+    if isinstance(field, CharField):
+        return np.dtype('U%d' % TEXT_WIDTH)
+    if isinstance(field, IntegerField):
+        return np.dtype(np.int64)
+    if isinstance(field, FloatField):
+        return np.dtype(np.float64)
+    return np.dtype(object)
+
+
+def session_dtype(record_class, fieldnames):
+    """ the same dtype for every session of a record class """
+    return np.dtype([(name, field_dtype(record_class._meta.fields[name]))
+                     for name in fieldnames])
+
+
+def column_array(field, values: list):
+    """
+    typed array for a column of a db field,
+    nulls become INT_NULL in integer columns, nan in float columns
+    and '' in text columns
+    """
+    dtype = field_dtype(field)
+    if dtype.kind == 'i':
+        values = [INT_NULL if v is None else v for v in values]
+    elif dtype.kind == 'f':
+        values = [np.nan if v is None else v for v in values]
+    elif dtype.kind == 'U':
+        values = ['' if v is None else str(v) for v in values]
+    return np.array(values, dtype=dtype)
+
+
+def fill_rows(array, offset, record_class, rows):
+    """ writes rows, tuples in dtype field order, into array at offset """
+    columns = list(zip(*rows))
+    for name, values in zip(array.dtype.names, columns):
+        array[name][offset:offset + len(rows)] = column_array(
+            record_class._meta.fields[name], list(values))
+    return offset + len(rows)
+
+
+def session_array_path(session_id, record_class, timestamp, dest=None):
+    if not dest:
+        dest = settings.results_columnar_export_path.format(
+            session_id=session_id, record_class=record_class.tag, 
+            timestamp=timestamp)
+    os.makedirs(os.path.dirname(dest), exist_ok=True)
+    return dest
+
+
+def open_session_array(dest, dtype, size):
+    """
+    an .npy file of `size` records mapped for writing,
+    so an export holds one chunk of rows in memory at a time
+    """
+    return open_memmap(dest, mode='w+', dtype=dtype, shape=(size, ))
+
+
+def load_session_arrays(session_id, data_dir=None):
+    """
+    memory maps the latest columnar export of a session,
+    returns a dict of record class tag to structured array
+    """
+    data_dir = data_dir or os.path.dirname(settings.results_columnar_export_path)
+    arrays = {}
+    for record_class_tag in ('market', 'agent'):
+        paths = sorted(glob.glob(os.path.join(
+            data_dir, '%s_%s_accessed_*.npy' % (session_id, record_class_tag))))
+        if paths:
+            arrays[record_class_tag] = np.load(paths[-1], mmap_mode='r')
+    return arrays
@@ -1,8 +1,14 @@
 from peewee import *
 import datetime
-from high_frequency_trading.hft.utility import serialize_in_memo_model
 from .conf import psql_db
+from .writer import snapshot_writer
 from collections import deque
+from operator import attrgetter
+import settings
+import metrics
+import psycopg2
+import atexit
+import select
 import time
 import logging
 
@@ -16,42 +22,186 @@ def get_db_model(entity_tag):
         raise Exception('invalid model tag %s' % entity_tag)
 
 
-def write_to_db(model_class, records=[], flush_on=('market_start', 'market_end'), 
-            ts_field_name='timestamp', **kwargs):
+# virtual clock sessions swap this for virtual time
+timestamp_source = datetime.datetime.now
+
+
+def _insert_records(model_class, records: list, columns=None, 
+                    notifications=None):
+    """
+    records are dicts, or tuples in `columns` order.
+    notification payloads are sent in the same transaction
+    """
+    notifications = notifications if notifications is not None else []
+    if settings.db_dry_run:
+        pass
+    elif settings.db_background_writer:
+        snapshot_writer.submit(model_class, records.copy(), columns, 
+                               notifications.copy())
+    else:
+        fields = None
+        if columns:
+            fields = [model_class._meta.fields[c] for c in columns]
+        database = model_class._meta.database
+        with database.atomic():
+            model_class.insert_many(records, fields=fields).execute()
+            notify_all(database, notifications)
+    records.clear()
+    notifications.clear()
+
+
+def notify_all(database, payloads):
+    for payload in payloads:
+        database.execute_sql('SELECT pg_notify(%s, %s)', (
+            settings.session_complete_channel, payload))
+
+
+def _subproperty_getter(prop_name, subprop_name):
+    def getter(model):
+        subobject = getattr(model, prop_name)
+        try:
+            return getattr(subobject, subprop_name)
+        except AttributeError:
+            return subobject[subprop_name]
+    return getter
+
+
+class SnapshotPlan:
     """
-    each record is a result of an event
-    batch inputs and bulk create objects
+    compiled once per entity tag, reads the serialized 
+    properties of an in memory model straight into a row
+    with a fixed column order.
+    in delta mode, columns that did not change since 
+    the previous row of the same entity are written as null,
+    with a full keyframe row every `keyframe_interval` rows
     """
-    # keys should be identical in all dict for
-    # bulk inserts
-    clean_kwargs = {k: kwargs[k] if k in kwargs else None for k, v in model_class._meta.fields.items()} 
-    del clean_kwargs['id']
-    clean_kwargs[ts_field_name] = datetime.datetime.now()
-    records.append(clean_kwargs)
-    total_items = len(records)
-    if total_items >= 300 or kwargs.get('trigger_msg_type') in flush_on:
-        log.debug('insert %s records to db' % total_items)
-        model_class.insert_many(records).execute()
-        records.clear()
-            
-            
+    flush_on = ('market_start', 'market_end')
+
+    def __init__(self, entity_tag, delta_mode=None, keyframe_interval=None):
+        self.model_class = get_db_model(entity_tag)
+        ftf = get_freezed_fields_by_class(entity_tag)
+        db_fields = self.model_class._meta.fields
+        getters = {}
+        for prop_name in ftf['properties_to_serialize']:
+            if prop_name in db_fields:
+                getters[prop_name] = attrgetter(prop_name)
+        for prop_name, subprops in ftf['subproperties_to_serialize'].items():
+            for subprop_name in subprops:
+                if subprop_name in db_fields:
+                    getters[subprop_name] = _subproperty_getter(
+                        prop_name, subprop_name)
+        self.snapshot_columns = tuple(getters)
+        self.getters = tuple(getters.values())
+        self.columns = self.snapshot_columns + (
+            'trigger_msg_type', 'timestamp', 'keyframe')
+        key_columns = ('subsession_id', ) + self.model_class.entity_key
+        self.delta_mask = tuple(
+            c not in key_columns for c in self.snapshot_columns)
+        self.delta_mode = (settings.snapshot_delta_mode 
+                           if delta_mode is None else delta_mode)
+        self.keyframe_interval = (keyframe_interval or 
+                                  settings.snapshot_keyframe_interval)
+        # entity id -> (last full row, rows since keyframe)
+        self.previous = {}
+        self.pending = []
+        # sent once the pending rows are committed
+        self.notifications = []
+        self.recorded = metrics.counter(
+            'fimsim_db_snapshots_total', 'snapshots recorded', 
+            entity=entity_tag)
+
+    def record(self, entity, trigger_msg_type):
+        row = [getter(entity.model) for getter in self.getters]
+        keyframe = True
+        if self.delta_mode:
+            row, keyframe = self.delta(id(entity), row, trigger_msg_type)
+        row.extend((trigger_msg_type, timestamp_source(), keyframe))
+        self.pending.append(tuple(row))
+        self.recorded.inc()
+        if trigger_msg_type == 'market_end':
+            self.notifications.append(self.completion_payload(entity))
+        if (len(self.pending) >= settings.db_batch_size or 
+                trigger_msg_type in self.flush_on):
+            self.flush()
+
+    def completion_payload(self, entity):
+        entity_id = getattr(entity, 'account_id', None)
+        if entity_id is None:
+            entity_id = entity.market_id
+        return '%s:%s:%s' % (entity.session_id, entity.tag, entity_id)
+
+    def delta(self, entity_id, row, trigger_msg_type):
+        previous_row, since_keyframe = self.previous.get(entity_id, (None, 0))
+        keyframe = (previous_row is None or trigger_msg_type in self.flush_on 
+                    or since_keyframe + 1 >= self.keyframe_interval)
+        delta_row = row
+        if not keyframe:
+            delta_row = []
+            for value, previous_value, maskable in zip(
+                    row, previous_row, self.delta_mask):
+                if not maskable or value != previous_value:
+                    if value is None:
+                        # null means unchanged in a delta row
+                        keyframe = True
+                        break
+                    delta_row.append(value)
+                else:
+                    delta_row.append(None)
+        if keyframe:
+            delta_row = row
+        self.previous[entity_id] = (row, 0 if keyframe else since_keyframe + 1)
+        return list(delta_row), keyframe
+
+    def flush(self):
+        if self.pending:
+            log.debug('insert %s %s snapshots to db' % (
+                len(self.pending), self.model_class.__name__))
+            _insert_records(self.model_class, self.pending, self.columns,
+                            self.notifications)
+
+
+_snapshot_plans = {}
+
+
+def flush_snapshots():
+    """
+    write out every buffered snapshot and wait for the
+    background writer to finish, runs at interpreter exit
+    so snapshots buffered when the reactor stops are not lost.
+    returns the number of records the writer failed to write
+    """
+    for plan in _snapshot_plans.values():
+        plan.flush()
+    snapshot_writer.close()
+    return snapshot_writer.records_lost
+
+
+atexit.register(flush_snapshots)
+metrics.gauge('fimsim_db_writer_queue_batches', snapshot_writer.queue.qsize,
+              'batches waiting for the background writer')
+metrics.gauge('fimsim_db_writer_stalls', lambda: snapshot_writer.stalls,
+              'times snapshots waited for a full writer queue')
+metrics.gauge('fimsim_db_writer_stalled_seconds', 
+              lambda: snapshot_writer.stalled_seconds,
+              'time snapshots waited for a full writer queue')
+
+
+def get_snapshot_plan(entity_tag):
+    try:
+        return _snapshot_plans[entity_tag]
+    except KeyError:
+        plan = _snapshot_plans[entity_tag] = SnapshotPlan(entity_tag)
+        return plan
+
+
 def freeze_state():
-    attr_name = 'model'
 
     def decorator(func):
         def db_recorded(market_entity, *args, **kwargs):
             event = func(market_entity, *args, **kwargs)
             if event:
-                model_to_record = getattr(market_entity, attr_name)
-                ftf = get_freezed_fields_by_class(market_entity.tag)
-                props = ftf['properties_to_serialize']
-                subprops = ftf['subproperties_to_serialize']
-                frozen_model = serialize_in_memo_model(
-                    model_to_record, props, subprops)
-                db_model_class = get_db_model(market_entity.tag)
-                write_to_db(
-                    db_model_class, trigger_msg_type=event.event_type, 
-                    **frozen_model)
+                get_snapshot_plan(market_entity.tag).record(
+                    market_entity, event.event_type)
         return db_recorded
     return decorator
 
@@ -60,6 +210,8 @@ class BaseModel(Model):
 
     timestamp = DateTimeField(default=datetime.datetime.now)
     trigger_msg_type = CharField()
+    # false for delta rows, nulls there mean `unchanged`
+    keyframe = BooleanField(default=True)
 
     class Meta:
         database = psql_db
@@ -67,6 +219,7 @@ class BaseModel(Model):
 
 class ELOMarket(BaseModel):
     tag = 'market'
+    entity_key = ('market_id', )
 
     csv_meta = (
         'timestamp', 'subsession_id', 'market_id', 'trigger_msg_type',
@@ -77,23 +230,32 @@ class ELOMarket(BaseModel):
 
     subsession_id = CharField()
     market_id = IntegerField()
-    reference_price = IntegerField()
-    best_bid = IntegerField()
-    best_offer = IntegerField()
-    next_bid = IntegerField()
-    next_offer = IntegerField()
-    volume_at_best_bid = IntegerField()
-    volume_at_best_offer = IntegerField()
-    e_best_bid = IntegerField()
-    e_best_offer = IntegerField()
-    signed_volume = FloatField()
-    e_signed_volume = FloatField()
+    reference_price = IntegerField(null=True)
+    best_bid = IntegerField(null=True)
+    best_offer = IntegerField(null=True)
+    next_bid = IntegerField(null=True)
+    next_offer = IntegerField(null=True)
+    volume_at_best_bid = IntegerField(null=True)
+    volume_at_best_offer = IntegerField(null=True)
+    e_best_bid = IntegerField(null=True)
+    e_best_offer = IntegerField(null=True)
+    signed_volume = FloatField(null=True)
+    e_signed_volume = FloatField(null=True)
     clearing_price = IntegerField(null=True)
     transacted_volume = IntegerField(null=True)
 
+    class Meta:
+        indexes = (
+            (('subsession_id', 'trigger_msg_type'), False),
+            # paging through results, see db_commands.iter_session_rows
+            (('subsession_id', 'timestamp', 'id'), False),
+            (('subsession_id', 'market_id', 'id'), False),
+        )
+
 
 class ELOAgent(BaseModel):
     tag = 'agent'
+    entity_key = ('account_id', )
 
     csv_meta = (
         'timestamp', 'subsession_id', 'account_id', 'trigger_msg_type',
@@ -108,65 +270,122 @@ class ELOAgent(BaseModel):
     subsession_id = CharField()
     market_id = CharField(default=0)
     account_id = CharField()
-    trader_model_name =  CharField()
-    delay = FloatField()
-    net_worth = IntegerField()
-    cash = IntegerField()
-    cost = IntegerField()
-    speed_cost = IntegerField()
-    tax_paid = IntegerField()
-    reference_price = IntegerField()
-    best_bid = IntegerField()
-    best_offer = IntegerField()
-    next_bid = IntegerField()
-    next_offer = IntegerField()
-    e_best_bid = IntegerField()
-    e_best_offer = IntegerField()
-    inventory = IntegerField()
+    trader_model_name = CharField(null=True)
+    delay = FloatField(null=True)
+    net_worth = IntegerField(null=True)
+    cash = IntegerField(null=True)
+    cost = IntegerField(null=True)
+    speed_cost = IntegerField(null=True)
+    tax_paid = IntegerField(null=True)
+    reference_price = IntegerField(null=True)
+    best_bid = IntegerField(null=True)
+    best_offer = IntegerField(null=True)
+    next_bid = IntegerField(null=True)
+    next_offer = IntegerField(null=True)
+    e_best_bid = IntegerField(null=True)
+    e_best_offer = IntegerField(null=True)
+    inventory = IntegerField(null=True)
     bid = IntegerField(null=True)
     offer = IntegerField(null=True)
     staged_bid = IntegerField(null=True)
     staged_offer = IntegerField(null=True)
     implied_bid = IntegerField(null=True)
     implied_offer = IntegerField(null=True)
-    best_bid = IntegerField()
-    best_offer = IntegerField()
-    best_bid_except_me = IntegerField()
-    best_offer_except_me = IntegerField()
-    next_bid = IntegerField()
-    next_offer = IntegerField()
-    volume_at_best_bid = IntegerField()
-    volume_at_best_offer = IntegerField()
-    e_best_bid = IntegerField()
-    e_best_offer = IntegerField()
-    slider_a_x = FloatField()
-    slider_a_y = FloatField()
-    slider_a_z = FloatField()
-    signed_volume = FloatField()
-    e_signed_volume = FloatField()    
-
-def session_results_ready(session_id, timeout=10):
-    t = 0
-    sleep_dur = 0.5
-    while t < timeout:
-        starters_count = ELOAgent.select().where(
-            (ELOAgent.subsession_id == session_id) &  
-            (ELOAgent.trigger_msg_type == 'market_start')
-        ).count()
-        closers_count = ELOAgent.select().where(
+    best_bid = IntegerField(null=True)
+    best_offer = IntegerField(null=True)
+    best_bid_except_me = IntegerField(null=True)
+    best_offer_except_me = IntegerField(null=True)
+    next_bid = IntegerField(null=True)
+    next_offer = IntegerField(null=True)
+    volume_at_best_bid = IntegerField(null=True)
+    volume_at_best_offer = IntegerField(null=True)
+    e_best_bid = IntegerField(null=True)
+    e_best_offer = IntegerField(null=True)
+    slider_a_x = FloatField(null=True)
+    slider_a_y = FloatField(null=True)
+    slider_a_z = FloatField(null=True)
+    signed_volume = FloatField(null=True)
+    e_signed_volume = FloatField(null=True)    
+
+    class Meta:
+        indexes = (
+            (('subsession_id', 'trigger_msg_type'), False),
+            # paging through results, see db_commands.iter_session_rows
+            (('subsession_id', 'timestamp', 'id'), False),
+            (('subsession_id', 'account_id', 'id'), False),
+        )
+
+
+def session_results_ready(session_id):
+    """
+    one off check that every agent that started
+    the session has written its market_end record
+    """
+    counts = dict(ELOAgent.select(
+            ELOAgent.trigger_msg_type, fn.COUNT(ELOAgent.id)
+        ).where(
             (ELOAgent.subsession_id == session_id) &  
-            (ELOAgent.trigger_msg_type == 'market_end')
-        ).count()
-        if starters_count == closers_count != 0:
-            log.warning('session %s results ready, number of agents %s.' % (
-                    session_id, closers_count))
-            return True
-        else:
-            time.sleep(sleep_dur)
-            t += sleep_dur
-            log.warning('waiting for session %s results. starters: %s, closers %s' % (
-                session_id, starters_count, closers_count))
-    log.warning('error: timeout waiting session %s' % session_id)
+            (ELOAgent.trigger_msg_type.in_(('market_start', 'market_end')))
+        ).group_by(ELOAgent.trigger_msg_type).tuples())
+    starters_count = counts.get('market_start', 0)
+    closers_count = counts.get('market_end', 0)
+    if starters_count == closers_count != 0:
+        log.warning('session %s results ready, number of agents %s.' % (
+                session_id, closers_count))
+        return True
+    log.warning('session %s results not ready. starters: %s, closers %s' % (
+        session_id, starters_count, closers_count))
+    return False
+
+
+class SessionCompletionListener:
+    """
+    listens for the notifications sent along with market_end 
+    snapshots, so session completion needs no polling.
+    start listening before session processes are launched
+    """
+
+    def __init__(self, session_id, channel=None, database=psql_db):
+        self.session_id = session_id
+        self.channel = channel or settings.session_complete_channel
+        self.database = database
+        self.connection = None
+        self.closed_agents = set()
+
+    def __enter__(self):
+        self.connection = psycopg2.connect(
+            dbname=self.database.database, **self.database.connect_params)
+        self.connection.autocommit = True
+        with self.connection.cursor() as cursor:
+            cursor.execute('LISTEN "%s"' % self.channel)
+        return self
+
+    def __exit__(self, *_):
+        self.connection.close()
+
+    def wait(self, num_agents, timeout=10):
+        """
+        block until `num_agents` agents of the session reported
+        their market_end records committed, or timeout
+        """
+        deadline = time.monotonic() + timeout
+        while len(self.closed_agents) < num_agents:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                log.warning('error: timeout waiting session %s, %s of %s '
+                            'agents closed.' % (self.session_id, 
+                            len(self.closed_agents), num_agents))
+                return False
+            if select.select([self.connection], [], [], remaining)[0]:
+                self.connection.poll()
+                while self.connection.notifies:
+                    notification = self.connection.notifies.pop(0)
+                    session_id, tag, entity_id = notification.payload.split(':')
+                    if session_id == self.session_id and tag == ELOAgent.tag:
+                        self.closed_agents.add(entity_id)
+        log.warning('session %s results ready, number of agents %s.' % (
+                self.session_id, len(self.closed_agents)))
+        return True
 
         
 in_memo_to_db_model_table = {
@@ -1,8 +1,13 @@
 from db.db import ELOMarket, ELOAgent
 from db.conf import psql_db
+from db.columnar import (
+    session_dtype, fill_rows, session_array_path, open_session_array)
+from playhouse.migrate import PostgresqlMigrator, migrate
 import settings
-import csv
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
 import datetime
+import gzip
 import logging
 
 log = logging.getLogger(__name__)
@@ -22,30 +27,284 @@ def resetdb(tables=models):
     create_tables()
 
 
+def upgrade_tables(tables=models):
+    """
+    bring tables created before delta snapshots up to date,
+    adds the keyframe column, makes snapshot columns nullable
+    and creates missing indexes
+    """
+    migrator = PostgresqlMigrator(psql_db)
+    operations = []
+    for model_cls in tables:
+        table = model_cls._meta.table_name
+        columns = {c.name: c for c in psql_db.get_columns(table)}
+        if 'keyframe' not in columns:
+            operations.append(migrator.add_column(
+                table, 'keyframe', model_cls.keyframe))
+        for field in model_cls._meta.sorted_fields:
+            column = columns.get(field.column_name)
+            if field.null and column is not None and not column.null:
+                operations.append(migrator.drop_not_null(
+                    table, field.column_name))
+    with psql_db.atomic():
+        migrate(*operations)
+        for model_cls in tables:
+            model_cls._schema.create_indexes(safe=True)
+
+
+def tables_need_upgrade(tables=models):
+    """ whether tables predate delta snapshots or miss indexes """
+    for model_cls in tables:
+        table = model_cls._meta.table_name
+        columns = {c.name: c for c in psql_db.get_columns(table)}
+        if 'keyframe' not in columns:
+            return True
+        for field in model_cls._meta.sorted_fields:
+            column = columns.get(field.column_name)
+            if field.null and column is not None and not column.null:
+                return True
+        indexes = {index.name for index in psql_db.get_indexes(table)}
+        if any(index._name not in indexes for index in 
+               model_cls._meta.fields_to_index()):
+            return True
+    return False
+
+
+def ensure_tables(tables=models):
+    """
+    creates missing tables and upgrades old ones, snapshots
+    of a session would fail to COPY into tables predating them
+    """
+    missing = [model_cls for model_cls in tables if 
+               not psql_db.table_exists(model_cls._meta.table_name)]
+    if missing:
+        log.warning('creating tables %s.' % ', '.join(
+            model_cls._meta.table_name for model_cls in missing))
+        psql_db.create_tables(missing)
+    if tables_need_upgrade(tables):
+        log.warning('upgrading tables to the current snapshot schema.')
+        upgrade_tables(tables)
+
+
 def get_session_data(session_id, model_cls):
     return model_cls.select().where(model_cls.subsession_id == session_id).order_by(
         model_cls.timestamp)
 
 
-def export_csv(session_id, record_class, dest=None):
+def _fill_in_sql(model_cls, fieldnames):
+    """
+    the entity key, group counts and filled in columns of a rehydrating
+    query. a value belongs to the group started by the latest keyframe
+    or non null value of its column, `groups` go in a subquery with
+    an `entity` window, `columns` select from it
+    """
+    entity_key = ', '.join('"%s"' % c for c in model_cls.entity_key)
+    passthrough = ('timestamp', 'subsession_id', 'trigger_msg_type') + (
+        model_cls.entity_key)
+    filled = [name for name in fieldnames if name not in passthrough]
+    groups = ', '.join(
+        'count(CASE WHEN keyframe OR "{0}" IS NOT NULL THEN 1 END) '
+        'OVER entity AS "g_{0}"'.format(name) for name in filled)
+    columns = ', '.join(
+        '"{0}"'.format(name) if name in passthrough else
+        'first_value("{0}") OVER (PARTITION BY {1}, "g_{0}" ORDER BY id) '
+        'AS "{0}"'.format(name, entity_key) for name in fieldnames)
+    return entity_key, groups, columns
+
+
+def rehydrated_session_sql(model_cls, fieldnames):
+    """
+    select session records with delta rows filled in from
+    earlier rows of the same entity
+    """
+    table = model_cls._meta.table_name
+    entity_key, groups, columns = _fill_in_sql(model_cls, fieldnames)
+    return ('SELECT {columns} FROM (SELECT *, {groups} FROM "{table}" '
+            'WHERE subsession_id = %s '
+            'WINDOW entity AS (PARTITION BY {entity_key} ORDER BY id)) AS s '
+            'ORDER BY "timestamp", id').format(
+                columns=columns, groups=groups, table=table, 
+                entity_key=entity_key)
+
+
+def plain_session_sql(model_cls, fieldnames):
+    """ select session records as they were written """
+    return ('SELECT {columns} FROM "{table}" WHERE subsession_id = %s '
+            'ORDER BY "timestamp", id').format(
+                columns=', '.join('"%s"' % name for name in fieldnames),
+                table=model_cls._meta.table_name)
+
+
+def has_delta_rows(cursor, model_cls, session_id):
+    cursor.execute('SELECT EXISTS (SELECT 1 FROM "%s" WHERE subsession_id = %%s '
+                   'AND NOT keyframe)' % model_cls._meta.table_name,
+                   (session_id, ))
+    return cursor.fetchone()[0]
+
+
+def session_sql(cursor, model_cls, fieldnames, session_id):
+    """
+    the export query of a session, rows are rehydrated only if
+    the session was recorded with delta rows (settings.snapshot_delta_mode)
+    """
+    if has_delta_rows(cursor, model_cls, session_id):
+        return rehydrated_session_sql(model_cls, fieldnames)
+    return plain_session_sql(model_cls, fieldnames)
+
+
+def export_csv(session_id, record_class, dest=None, compress=None):
+    """
+    streams session records straight from the server into
+    a csv file with COPY, optionally gzip compressed on the fly
+    returns the path of the written file
+    """
     timestamp = datetime.datetime.now()
     fieldnames = record_class.csv_meta
+    if compress is None:
+        compress = settings.compress_results
     if not dest:
         # then write to file in the system
         dest = settings.results_export_path.format(
                 session_id=session_id, record_class=record_class.tag, 
                 timestamp=timestamp)
-    query = get_session_data(session_id, record_class)
-    with open(dest, 'w') as filelike:
-        log.debug('writing as csv: headers %s: %s' % (fieldnames, dest))
-        writer = csv.DictWriter(filelike, fieldnames=fieldnames, 
-                                extrasaction='ignore')
-        writer.writeheader()
-        for row in query.dicts():
-            writer.writerow(row)
-    return filelike
-
-
-def export_session(session_id):
-    for model_cls in models:
-        export_csv(session_id, model_cls)
+        if compress:
+            dest += '.gz'
+    opener = gzip.open if compress else open
+    with psql_db.connection_context():
+        cursor = psql_db.cursor()
+        sql = session_sql(cursor, record_class, fieldnames, session_id)
+        copy_sql = 'COPY (%s) TO STDOUT WITH CSV HEADER' % (
+            cursor.mogrify(sql, (session_id, )).decode('utf-8'))
+        with opener(dest, 'wt') as filelike:
+            log.debug('writing as csv: headers %s: %s' % (fieldnames, dest))
+            cursor.copy_expert(copy_sql, filelike)
+    return dest
+
+
+def export_columnar(session_id, record_class, dest=None, chunk_size=10000):
+    """
+    writes session records as a typed structured numpy array,
+    rows are read in chunks through a server side cursor and
+    written into a preallocated, memory mapped .npy file
+    returns the path of the written file
+    """
+    timestamp = datetime.datetime.now()
+    fieldnames = record_class.csv_meta
+    dest = session_array_path(session_id, record_class, timestamp, dest)
+    with psql_db.connection_context():
+        connection = psql_db.connection()
+        cursor = psql_db.cursor()
+        sql = session_sql(cursor, record_class, fieldnames, session_id)
+        with psql_db.atomic():
+            cursor.execute('SELECT count(*) FROM "%s" WHERE subsession_id = %%s'
+                           % record_class._meta.table_name, (session_id, ))
+            size = cursor.fetchone()[0]
+            array = open_session_array(
+                dest, session_dtype(record_class, fieldnames), size)
+            offset = fetched = 0
+            with connection.cursor(name='export_%s' % record_class.tag) as cursor:
+                cursor.itersize = chunk_size
+                cursor.execute(sql, (session_id, ))
+                for chunk in iter(lambda: cursor.fetchmany(chunk_size), []):
+                    fetched += len(chunk)
+                    offset = fill_rows(array, offset, record_class, 
+                                       chunk[:size - offset])
+    array.flush()
+    if fetched != size:
+        # rows were written to the session while it was exported
+        log.warning('session %s: counted %s %s records, read %s' % (
+            session_id, size, record_class.tag, fetched))
+        if offset < size:
+            trimmed = np.array(array[:offset])
+            del array
+            np.save(dest, trimmed)
+    log.debug('wrote %s %s records as npy: %s' % (
+        offset, record_class.tag, dest))
+    return dest
+
+
+def session_page_sql(model_cls, fieldnames):
+    """
+    a page of rehydrated session records after a ("timestamp", id) key.
+    delta rows are filled in from the latest keyframe of each entity
+    on the page, so a page reads about as many rows as it returns,
+    however deep into the session it is
+    """
+    table = model_cls._meta.table_name
+    entity_key, groups, columns = _fill_in_sql(model_cls, fieldnames)
+    same_entity = ' AND '.join(
+        'k."{0}" = p."{0}"'.format(c) for c in model_cls.entity_key)
+    return (
+        # rows of an entity are in id order, a page holds a run of them
+        'WITH page AS (SELECT id, {entity_key} FROM "{table}" '
+        'WHERE subsession_id = %(session_id)s '
+        'AND ("timestamp", id) > (%(after_timestamp)s, %(after_id)s) '
+        'ORDER BY "timestamp", id LIMIT %(limit)s), '
+        'runs AS (SELECT {entity_key}, min(id) AS first_id, '
+        'max(id) AS last_id FROM page GROUP BY {entity_key}), '
+        'spans AS (SELECT p.*, coalesce((SELECT max(k.id) FROM "{table}" k '
+        'WHERE k.subsession_id = %(session_id)s AND {same_entity} '
+        'AND k.keyframe AND k.id <= p.first_id), 0) AS keyframe_id '
+        'FROM runs p) '
+        # rows before the key fill in the page, filtered out after
+        'SELECT * FROM (SELECT {columns}, id FROM (SELECT t.*, {groups} '
+        'FROM "{table}" t JOIN spans USING ({entity_key}) '
+        'WHERE t.subsession_id = %(session_id)s '
+        'AND t.id BETWEEN spans.keyframe_id AND spans.last_id '
+        'WINDOW entity AS (PARTITION BY {entity_key} ORDER BY t.id)) AS s'
+        ') AS r WHERE ("timestamp", id) > (%(after_timestamp)s, %(after_id)s) '
+        'ORDER BY "timestamp", id LIMIT %(limit)s').format(
+            columns=columns, groups=groups, table=table,
+            entity_key=entity_key, same_entity=same_entity)
+
+
+def plain_page_sql(model_cls, fieldnames):
+    """ a page of session records as they were written """
+    return ('SELECT {columns}, id FROM "{table}" '
+            'WHERE subsession_id = %(session_id)s '
+            'AND ("timestamp", id) > (%(after_timestamp)s, %(after_id)s) '
+            'ORDER BY "timestamp", id LIMIT %(limit)s').format(
+                columns=', '.join('"%s"' % name for name in fieldnames),
+                table=model_cls._meta.table_name)
+
+
+def iter_session_rows(session_id, record_class, after=None, limit=None,
+                      chunk_size=1000):
+    """
+    yields the ("timestamp", id) key and a dict of each session record
+    after the key `after`, in export order, read in chunks through
+    a server side cursor. pass the last key to get the next page
+    """
+    fieldnames = record_class.csv_meta
+    after_timestamp, after_id = after or (datetime.datetime.min, 0)
+    with psql_db.connection_context():
+        connection = psql_db.connection()
+        page_sql = session_page_sql if has_delta_rows(
+            psql_db.cursor(), record_class, session_id) else plain_page_sql
+        with psql_db.atomic():
+            with connection.cursor(name='rows_%s' % record_class.tag) as cursor:
+                cursor.itersize = chunk_size
+                cursor.execute(page_sql(record_class, fieldnames), {
+                    'session_id': session_id,
+                    'after_timestamp': after_timestamp,
+                    'after_id': after_id,
+                    'limit': limit,
+                })
+                for chunk in iter(lambda: cursor.fetchmany(chunk_size), []):
+                    for row in chunk:
+                        record = dict(zip(fieldnames, row))
+                        yield (record['timestamp'], row[-1]), record
+
+
+def export_session(session_id, compress=None):
+    """ 
+    export market and agent records of a session concurrently,
+    as csv and if enabled as memory mappable arrays
+    """
+    jobs = [(export_csv, dict(compress=compress))]
+    if settings.export_columnar:
+        jobs.append((export_columnar, {}))
+    with ThreadPoolExecutor(max_workers=len(models) * len(jobs)) as executor:
+        futures = [executor.submit(export, session_id, model_cls, **kwargs) 
+                   for export, kwargs in jobs for model_cls in models]
+        return [f.result() for f in futures]
@@ -0,0 +1,162 @@
+from .conf import psql_db
+import settings
+import datetime
+import io
+import queue
+import threading
+import time
+import logging
+
+log = logging.getLogger(__name__)
+
+# moves snapshot inserts off the reactor thread.
+# batches of records are handed over a bounded queue
+# to a writer thread that bulk loads them with COPY,
+# a full queue holds up the caller until the writer catches up.
+# a failed COPY is retried, batches that still fail are counted
+# as lost and the session process exits with an error
+
+
+def _copy_text(value):
+    """ render a value in postgres COPY text format """
+    if value is None:
+        return '\\N'
+    if value is True:
+        return 't'
+    if value is False:
+        return 'f'
+    if isinstance(value, datetime.datetime):
+        return value.isoformat(' ')
+    return str(value).replace('\\', '\\\\').replace('\t', '\\t').replace(
+        '\n', '\\n').replace('\r', '\\r')
+
+
+class SnapshotWriter:
+    stop_signal = None
+
+    def __init__(self, database=psql_db, max_batches=None):
+        self.database = database
+        self.queue = queue.Queue(
+            maxsize=max_batches or settings.db_writer_queue_size)
+        self.thread = None
+        self.batches_written = 0
+        self.records_written = 0
+        self.records_lost = 0
+        # times submitting waited for a full queue
+        self.stalls = 0
+        self.stalled_seconds = 0.
+
+    @property
+    def running(self):
+        return self.thread is not None and self.thread.is_alive()
+
+    def start(self):
+        if not self.running:
+            self.thread = threading.Thread(
+                target=self._run, name='snapshot-writer', daemon=True)
+            self.thread.start()
+
+    def submit(self, model_class, records: list, columns=None, 
+               notifications=()):
+        """
+        hand a batch of records over to the writer thread.
+        if the queue is full the caller waits for the writer,
+        stalls are counted and logged while they last.
+        records are dicts, or tuples in `columns` order,
+        notification payloads are sent once the batch is committed
+        """
+        self.start()
+        batch = (model_class, records, columns, notifications)
+        try:
+            self.queue.put_nowait(batch)
+            return
+        except queue.Full:
+            pass
+        started = time.monotonic()
+        self.stalls += 1
+        while True:
+            try:
+                self.queue.put(batch, timeout=settings.db_writer_stall_warning)
+                break
+            except queue.Full:
+                log.warning('snapshot writer is behind, waited %.1fs to '
+                            'queue a batch of %s records.' % (
+                                time.monotonic() - started, len(records)))
+        self.stalled_seconds += time.monotonic() - started
+
+    def close(self, timeout=None):
+        """ write everything in the queue and stop the writer thread """
+        if self.running:
+            self.queue.put(self.stop_signal)
+            self.thread.join(timeout)
+        log.debug('snapshot writer closed: %s batches, %s records written.' % (
+            self.batches_written, self.records_written))
+        if self.stalls:
+            log.warning('snapshot writer stalled %s times, %.1fs in total.' % (
+                self.stalls, self.stalled_seconds))
+        if self.records_lost:
+            log.error('snapshot writer lost %s records.' % self.records_lost)
+
+    def _run(self):
+        while True:
+            batch = self.queue.get()
+            if batch is self.stop_signal:
+                break
+            self.write(*batch)
+        self.database.close()
+
+    def write(self, model_class, records: list, columns=None,
+              notifications=()):
+        """ copies a batch, retrying with backoff, False if it is lost """
+        delay = settings.db_writer_retry_delay
+        for attempt in range(settings.db_writer_retries + 1):
+            try:
+                self.copy(model_class, records, columns, notifications)
+            except Exception:
+                log.exception('failed to write %s %s records, attempt %s.' % (
+                    len(records), model_class.__name__, attempt + 1))
+                # reconnects on the next attempt
+                try:
+                    self.database.close()
+                except Exception:
+                    pass
+                if attempt < settings.db_writer_retries:
+                    time.sleep(delay)
+                    delay *= 2
+            else:
+                self.batches_written += 1
+                self.records_written += len(records)
+                return True
+        self.records_lost += len(records)
+        return False
+
+    def copy(self, model_class, records: list, columns=None, 
+             notifications=()):
+        payload = io.StringIO()
+        if columns:
+            fields = [model_class._meta.fields[c] for c in columns]
+            for record in records:
+                payload.write('\t'.join(_copy_text(v) for v in record))
+                payload.write('\n')
+        else:
+            fields = [f for f in model_class._meta.sorted_fields 
+                      if f.name != 'id']
+            for record in records:
+                payload.write('\t'.join(
+                    _copy_text(record.get(f.name)) for f in fields))
+                payload.write('\n')
+        payload.seek(0)
+        sql = 'COPY "%s" (%s) FROM STDIN' % (
+            model_class._meta.table_name, 
+            ', '.join('"%s"' % f.column_name for f in fields))
+        with self.database.atomic():
+            cursor = self.database.cursor()
+            cursor.copy_expert(sql, payload)
+            for notification in notifications:
+                cursor.execute('SELECT pg_notify(%s, %s)', (
+                    settings.session_complete_channel, notification))
+        log.debug('copied %s records to %s' % (
+            len(records), model_class._meta.table_name))
+
+
+snapshot_writer = SnapshotWriter()
@@ -1,6 +1,5 @@
-from twisted.internet import reactor
-import csv
-import utility
+from itertools import count
+import heapq
 import logging
 
 log = logging.getLogger(__name__)
@@ -12,26 +11,126 @@ class DiscreteEventEmitter:
 
     def __init__(self, source_data):
         self.owner = None
+        # record arrays stay as they are, rows are
+        # decoded one at a time when they are due
         self.data = source_data
+        self.cursor = 0
         self.previous_state = None
+        if not is_sorted_by_time(source_data):
+            log.warning('%s events are not sorted by arrival time, sorting.' % 
+                        self.name)
+            self.data = sorted(source_data, key=lambda row: float(row[0]))
+
+    def row(self, ix):
+        row = self.data[ix]
+        # rows of record arrays index and slice as tuples
+        return row.item() if hasattr(row, 'item') else row
+
+    def next_event(self):
+        """
+        advances the cursor to the next row that passes has_changed
+        returns its arrival time and the row, None when the tape is over
+        """
+        while self.cursor < len(self.data):
+            row = self.row(self.cursor)
+            self.cursor += 1
+            if self.has_changed(row):
+                self.previous_state = row
+                return float(row[0]), row
+
+    def decode(self, row):
+        row_as_dict = {
+            self.fieldnames[ix]: self.fieldprocessors[ix](value) for ix, 
+                value in enumerate(row[1:])}
+        row_as_dict['type'] = self.name
+        return row_as_dict
+
+    def emit(self, row):
+        self.owner.handle_discrete_event(self.decode(row))
 
     def register_events(self):
+        """ streams this emitter alone, prefer a shared scheduler """
         if not self.owner:
             raise Exception('owner agent not set.')
-        for row in self.data:
-            if self.has_changed(row):
-                arrival_time = float(row[0])
-                row_as_dict = {
-                    self.fieldnames[ix]: self.fieldprocessors[ix](value) for ix, 
-                        value in enumerate(row[1:])}
-                row_as_dict['type'] = self.name
-                reactor.callLater(arrival_time, self.owner.handle_discrete_event, row_as_dict)
-                self.previous_state = row
+        scheduler = DiscreteEventScheduler([self])
+        scheduler.start()
+        return scheduler
     
     def has_changed(self, incoming_row):
         return True
 
 
+def is_sorted_by_time(source_data):
+    names = getattr(getattr(source_data, 'dtype', None), 'names', None)
+    if names:
+        times = source_data[names[0]]
+        return bool((times[1:] >= times[:-1]).all())
+    previous = None
+    for row in source_data:
+        if previous is not None and float(row[0]) < previous:
+            return False
+        previous = float(row[0])
+    return True
+
+
+class DiscreteEventScheduler:
+    """
+    merges the event streams of emitters through a heap,
+    only the earliest due event is on the reactor at any time.
+    arrival times are seconds since start
+    """
+
+    def __init__(self, emitters, clock=None):
+        if clock is None:
+            # whichever reactor is installed by now, virtual or not
+            from twisted.internet import reactor as clock
+        self.emitters = emitters
+        self.clock = clock
+        self.heap = []
+        self.start_time = None
+        self.delayed_call = None
+        # breaks ties in the order emitters are given
+        self._sequence = count()
+
+    def start(self):
+        for em in self.emitters:
+            if not em.owner:
+                raise Exception('owner agent not set.')
+        self.start_time = self.clock.seconds()
+        for em in self.emitters:
+            self.push(em)
+        self.schedule()
+
+    def stop(self):
+        if self.delayed_call is not None and self.delayed_call.active():
+            self.delayed_call.cancel()
+        self.delayed_call = None
+        self.heap = []
+
+    def push(self, emitter):
+        event = emitter.next_event()
+        if event is not None:
+            arrival_time, row = event
+            heapq.heappush(self.heap, (arrival_time, next(self._sequence), 
+                                       emitter, row))
+
+    def schedule(self):
+        self.delayed_call = None
+        if self.heap:
+            delay = self.start_time + self.heap[0][0] - self.clock.seconds()
+            self.delayed_call = self.clock.callLater(max(0, delay), self.fire)
+
+    def fire(self):
+        # clock arithmetic may land a hair before the arrival time
+        elapsed = self.clock.seconds() - self.start_time + 1e-9
+        heap = self.heap
+        while heap and heap[0][0] <= elapsed:
+            _, _, emitter, row = heapq.heappop(heap)
+            self.push(emitter)
+            emitter.emit(row)
+        self.schedule()
+
+
 class RandomOrderEmitter(DiscreteEventEmitter):
     fieldnames = ('fundamental_price', 'price', 'buy_sell_indicator', 'time_in_force')
     fieldprocessors = (float, int, str, int)
@@ -25,25 +25,14 @@ class ContextSeed:
 def asof(a, b):
     """
     assumes a and b are sorted array of times
-    return indexes of a 
+    return indexes of a
     so values of b at such indexes
     are 'as of' a, commonly used
     when dealing with timeseries data
-    (so the closest numpy gets to this is via searchsorted,
-     which is still not the tool, wtf numpy folks ?)
+    -1 for times in b earlier than a[0]
     """
-    current_index = 0
-    last_a_index = len(a) - 1
-    result = np.zeros(b.size, dtype=int)
-    for ix, t in enumerate(b):
-        try:
-            while t >= a[current_index]:
-                current_index += 1
-        except IndexError:
-            current_index = last_a_index + 1
-        result[ix] = current_index - 1
-    return result 
-         
+    return np.searchsorted(a, b, side='right') - 1
+
 
 def draw_arrival_times(size, period_length, distribution=np.random.uniform, **kwargs):
     """
@@ -67,49 +56,83 @@ def draw_noise(size, period_length, distribution=np.random.normal,
 
 
 def _elo_asset_value_arr(initial_price, period_length, loc_delta, scale_delta, 
-                         lambdaJ):
+                         lambdaJ, random_state=np.random):
     """
     generate a sequence of asset values and asset value jump times
+    as an array of (time, asset value) rows
     """
     f_size = int(lambdaJ * period_length)
     f_price_change_times = draw_arrival_times(
-        f_size, period_length, low=0.0, high=period_length)
+        f_size, period_length, distribution=random_state.uniform, 
+        low=0.0, high=period_length)
     num_f_price_changes = f_price_change_times.size
-    f_prices = np.random.normal(
+    f_prices = random_state.normal(
         size=num_f_price_changes, loc=loc_delta, 
         scale=scale_delta).cumsum() + initial_price
-    return np.vstack((f_price_change_times, f_prices)).round(3)
-    
+    return np.column_stack((f_price_change_times, f_prices)).round(3)
+
+
+random_order_dtype = np.dtype([
+    ('arrival_time', np.float64),
+    ('fundamental_price', np.float64),
+    ('price', np.int64),
+    ('buy_sell_indicator', 'U1'),
+    ('time_in_force', np.int64),
+])
+
+
+def grid_prices(prices):
+    """
+    apply the price grid to an array of prices,
+    falls back to element-wise calls if price_grid
+    only handles scalars
+    """
+    try:
+        gridded = np.asarray(price_grid(prices))
+    except (TypeError, ValueError):
+        gridded = None
+    if gridded is None or gridded.shape != prices.shape:
+        gridded = np.fromiter((price_grid(p) for p in prices.tolist()),
+                              dtype=np.int64, count=prices.size)
+    return gridded.astype(np.int64)
+
 
 def elo_random_order_sequence(
         asset_value_arr, period_length, loc_noise, scale_noise, bid_ask_offset, 
-        lambdaI, time_in_force, buy_prob=0.5):
+        lambdaI, time_in_force, buy_prob=0.5, random_state=np.random):
     """
     draws bid/ask prices around fundamental value,
-    generate input sequnce for random orders with arrival times as array
+    generate input sequnce for random orders with arrival times
+    as a record array of `random_order_dtype`
     """
-    orders_size = np.random.poisson(lam=(1 / lambdaI) * period_length, size=1)
+    orders_size = int(random_state.poisson(lam=(1 / lambdaI) * period_length))
     order_times = draw_arrival_times(
-        orders_size, period_length, low=0.0, high=period_length)
-    unstacked_asset_values = np.swapaxes(asset_value_arr, 0, 1)
-    asset_value_jump_times, asset_values = unstacked_asset_values[0], unstacked_asset_values[1]
+        orders_size, period_length, distribution=random_state.uniform, 
+        low=0.0, high=period_length)
+    asset_value_arr = np.asarray(asset_value_arr, dtype=np.float64)
+    asset_value_jump_times, asset_values = asset_value_arr[:, 0], asset_value_arr[:, 1]
     asset_value_indexes = asof(asset_value_jump_times, order_times)
     asset_value_asof = asset_values[asset_value_indexes]
-    order_directions = np.random.binomial(1, buy_prob, orders_size)
-    noise_by_order_side = np.vectorize(
-        lambda x: np.random.normal(loc_noise - bid_ask_offset, scale_noise
-            ) if x == 0 else np.random.normal(loc_noise + bid_ask_offset, scale_noise))
-    noise_around_asset_value = noise_by_order_side(order_directions)
-    order_prices = (asset_value_asof + noise_around_asset_value).astype(int)
-    grid = np.vectorize(price_grid)
-    gridded_order_prices = grid(order_prices)
-    orders_tif = np.full(orders_size, time_in_force).astype(int)
-    convert_to_string = np.vectorize(lambda x: 'B' if x is 0 else 'S')
-    order_directions = convert_to_string(order_directions)
-    stacked = np.vstack((
-        order_times, asset_value_asof, gridded_order_prices, order_directions, 
-            orders_tif))
-    return stacked
+    # an order is a buy with probability buy_prob
+    is_buy = random_state.binomial(1, buy_prob, order_times.size) == 1
+    noise_around_asset_value = random_state.normal(
+        loc_noise + np.where(is_buy, -bid_ask_offset, bid_ask_offset), 
+        scale_noise)
+    order_prices = (asset_value_asof + noise_around_asset_value).astype(np.int64)
+    random_orders = np.empty(order_times.size, dtype=random_order_dtype)
+    random_orders['arrival_time'] = order_times
+    random_orders['fundamental_price'] = asset_value_asof
+    random_orders['price'] = grid_prices(order_prices)
+    random_orders['buy_sell_indicator'] = np.where(is_buy, 'B', 'S')
+    random_orders['time_in_force'] = time_in_force
+    return random_orders
+
+
+def _fundamental_values_from_conf(conf: dict):
+    fundamental_values = [list(row) for row in conf['fundamental_values']]
+    fundamental_values.insert(0, [0, conf['initial_price']])
+    return np.array(fundamental_values, dtype=np.float64)
+
 
 def elo_draw(period_length, conf: dict, seed=np.random.randint(0, high=2 ** 8),
         config_num=0):
@@ -119,10 +142,7 @@ def elo_draw(period_length, conf: dict, seed=np.random.randint(0, high=2 ** 8),
     then pipes this sequence to random order producer function
     """
     if conf['read_fundamental_values_from_array']:
-        fundamental_values = conf['fundamental_values'].copy()
-        fundamental_values.insert(0, [0, conf['initial_price']])
-        print(fundamental_values)
-        fundamental_values = np.array(fundamental_values)
+        fundamental_values = _fundamental_values_from_conf(conf)
     else:
         with ContextSeed(seed):
             fundamental_values = _elo_asset_value_arr(
@@ -135,8 +155,10 @@ def elo_draw(period_length, conf: dict, seed=np.random.randint(0, high=2 ** 8),
                      '%s jumps per second.' % (
                         conf['initial_price'],
                         round(len(fundamental_values) / period_length, 2)))
-    log.info('fundamental values: %s' % (', '.join('{0}:{1}'.format(t, v) 
-                                            for t, v in fundamental_values)))
+    # full tapes are long, only joined when someone reads them
+    if log.isEnabledFor(logging.DEBUG):
+        log.debug('fundamental values: %s' % (', '.join('{0}:{1}'.format(t, v) 
+                                                for t, v in fundamental_values)))
     random_orders = elo_random_order_sequence(
         fundamental_values, 
         period_length, 
@@ -145,18 +167,55 @@ def elo_draw(period_length, conf: dict, seed=np.random.randint(0, high=2 ** 8),
         conf['bid_ask_offset'],
         conf['lambdaI'][config_num],    # so rabbits differ in arrival rate..
         conf['time_in_force'])
-    random_orders = np.swapaxes(random_orders, 0, 1)
     log.info(
         '%s random orders generated. period length: %s, per second: %s.' % (
-            random_orders.shape[0], 
+            random_orders.size, 
             period_length, 
-            round(random_orders.shape[0] / period_length, 2)))
-    log.info('random orders (format: [fundamental price]:[order price]:[order direction]:[time in force]): %s' % (
-                ', '.join('{0}:{1}:{2}:{3}'.format(row[1], row[2], row[3], row[4]) for 
-                            row in random_orders)))
+            round(random_orders.size / period_length, 2)))
+    if log.isEnabledFor(logging.DEBUG):
+        log.debug('random orders (format: [fundamental price]:[order price]:[order direction]:[time in force]): %s' % (
+                    ', '.join('{0}:{1}:{2}:{3}'.format(row[1], row[2], row[3], row[4]) for 
+                                row in random_orders.tolist())))
     return random_orders
 
 
+def elo_draw_each(period_length, scenarios):
+    """
+    draws an order tape per scenario, a convenience loop:
+    each tape is drawn vectorized, scenarios one after another.
+    each scenario is a (seed, conf, config_num) tuple,
+    every scenario gets its own random state so tapes
+    are reproducible by seed and independent of each other
+    and of the global numpy random state
+    returns a list of random order record arrays
+    """
+    tapes = []
+    for seed, conf, config_num in scenarios:
+        random_state = np.random.RandomState(seed)
+        if conf['read_fundamental_values_from_array']:
+            fundamental_values = _fundamental_values_from_conf(conf)
+        else:
+            fundamental_values = _elo_asset_value_arr(
+                conf['initial_price'], 
+                period_length, 
+                conf['fundamental_value_noise_mean'], 
+                conf['fundamental_value_noise_std'], 
+                conf['lambdaJ'],
+                random_state=random_state)
+        tapes.append(elo_random_order_sequence(
+            fundamental_values, 
+            period_length, 
+            conf['exogenous_order_price_noise_mean'], 
+            conf['exogenous_order_price_noise_std'], 
+            conf['bid_ask_offset'],
+            conf['lambdaI'][config_num],
+            conf['time_in_force'],
+            random_state=random_state))
+    log.info('drew %s random order sequences, period length: %s.' % (
+        len(tapes), period_length))
+    return tapes
+
+
 if __name__ == '__main__':
     d = elo_draw(20, utility.get_simulation_parameters())
     for r in d:
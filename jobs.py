@@ -0,0 +1,241 @@
+import settings
+from utility import random_chars, get_simulation_parameters
+from manifest import validate_parameters
+import topology
+from collections import OrderedDict, deque
+import subprocess
+import threading
+import datetime
+import signal
+import yaml
+import sys
+import os
+import logging
+
+log = logging.getLogger(__name__)
+
+# simulation jobs of the web api. a job is a simulate.py process,
+# jobs wait in a queue and `concurrency` of them run at a time.
+# jobs live in memory of the api process, session results in the db.
+
+QUEUED = 'queued'
+RUNNING = 'running'
+SUCCEEDED = 'succeeded'
+FAILED = 'failed'
+CANCELLED = 'cancelled'
+FINISHED = (SUCCEEDED, FAILED, CANCELLED)
+
+# simulate.py flags a job may set
+SIMULATE_FLAGS = ('debug', 'inprocess', 'virtual_clock', 'agent_host',
+                  'zygote', 'journal')
+
+
+def merge_parameters(overrides: dict):
+    """ parameters.yaml with `overrides`, raises ValueError on unknown keys """
+    params = get_simulation_parameters()
+    unknown = set(overrides) - set(params)
+    if unknown:
+        raise ValueError('unknown parameters: %s' % ', '.join(sorted(unknown)))
+    params.update(overrides)
+    return params
+
+
+class Job:
+
+    def __init__(self, note='', parameters=None, flags=()):
+        self.id = random_chars(12)
+        self.session_code = random_chars(8)
+        self.note = note or ''
+        self.flags = tuple(flag for flag in flags if flag in SIMULATE_FLAGS)
+        if 'virtual_clock' in self.flags and 'inprocess' not in self.flags:
+            raise ValueError('virtual_clock needs inprocess')
+        self.status = QUEUED
+        self.exit_code = None
+        self.submitted_at = datetime.datetime.now()
+        self.started_at = None
+        self.finished_at = None
+        self.proc = None
+        # overrides of parameters.yaml, the session gets all of them
+        self.parameters = None if parameters is None else (
+            merge_parameters(parameters))
+        params = self.parameters or get_simulation_parameters()
+        validate_parameters(params, topology.get_markets(params))
+        self.session_duration = params['session_duration']
+
+    def command(self):
+        cmd = [sys.executable, 'simulate.py', '--session_code',
+               self.session_code, '--note', self.note]
+        cmd.extend('--' + flag for flag in self.flags)
+        return cmd
+
+    def progress(self):
+        """
+        share of the session done, estimated from its duration,
+        sessions on a virtual clock finish early
+        """
+        if self.status in FINISHED:
+            return 1.0
+        if self.status == QUEUED:
+            return 0.0
+        elapsed = (datetime.datetime.now() - self.started_at).total_seconds()
+        # leaves room for exporting results
+        return round(min(0.99, elapsed / max(self.session_duration, 1)), 3)
+
+    def to_dict(self):
+        def isoformat(dt):
+            return dt.isoformat() if dt else None
+        return {
+            'job_id': self.id,
+            'session_code': self.session_code,
+            'status': self.status,
+            'progress': self.progress(),
+            'exit_code': self.exit_code,
+            'note': self.note,
+            'flags': list(self.flags),
+            'submitted_at': isoformat(self.submitted_at),
+            'started_at': isoformat(self.started_at),
+            'finished_at': isoformat(self.finished_at),
+        }
+
+
+class JobQueue:
+    """ runs jobs first come first served, `concurrency` at a time """
+
+    def __init__(self, concurrency=None, history=None, job_dir=None):
+        self.concurrency = concurrency or settings.api_job_concurrency
+        self.history = history or settings.api_job_history
+        self.job_dir = job_dir or settings.api_job_dir
+        self.jobs = OrderedDict()
+        self.pending = deque()
+        self.lock = threading.Condition()
+        self.threads = []
+        self.closed = False
+
+    def start(self):
+        for i in range(self.concurrency):
+            thread = threading.Thread(target=self.run_jobs, daemon=True,
+                                      name='job_runner_%s' % i)
+            thread.start()
+            self.threads.append(thread)
+        return self
+
+    def submit(self, **kwargs):
+        job = Job(**kwargs)
+        with self.lock:
+            self.jobs[job.id] = job
+            self.pending.append(job)
+            self.forget_finished()
+            self.lock.notify()
+        log.info('queued job %s, session %s, %s waiting.' % (
+            job.id, job.session_code, len(self.pending)))
+        return job
+
+    def get(self, job_id):
+        return self.jobs.get(job_id)
+
+    def list(self, status=None):
+        with self.lock:
+            return [job for job in self.jobs.values()
+                    if status is None or job.status == status]
+
+    def position(self, job):
+        """ jobs ahead of a queued job """
+        with self.lock:
+            try:
+                return self.pending.index(job)
+            except ValueError:
+                return None
+
+    def cancel(self, job):
+        """ dequeues a job, or terminates it if it runs """
+        with self.lock:
+            if job.status == QUEUED:
+                self.pending.remove(job)
+                self.finish(job, CANCELLED)
+                return True
+            if job.status != RUNNING:
+                return False
+            job.status = CANCELLED
+            proc = job.proc
+        if proc is not None:
+            # simulate.py runs in its own process group with its exchanges
+            try:
+                os.killpg(proc.pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+        return True
+
+    def forget_finished(self):
+        """ keeps the `history` most recent finished jobs """
+        finished = [job_id for job_id, job in self.jobs.items()
+                    if job.status in FINISHED]
+        for job_id in finished[:max(0, len(finished) - self.history)]:
+            del self.jobs[job_id]
+
+    def finish(self, job, status):
+        job.status = status
+        job.finished_at = datetime.datetime.now()
+        log.info('job %s %s, exit code %s.' % (job.id, status, job.exit_code))
+
+    def next_job(self):
+        with self.lock:
+            while not self.pending and not self.closed:
+                self.lock.wait()
+            if self.closed:
+                return None
+            job = self.pending.popleft()
+            job.status = RUNNING
+            job.started_at = datetime.datetime.now()
+            return job
+
+    def run_jobs(self):
+        while True:
+            job = self.next_job()
+            if job is None:
+                return
+            try:
+                self.run(job)
+            except Exception:
+                log.exception('job %s failed to run' % job.id)
+                with self.lock:
+                    self.finish(job, FAILED)
+
+    def run(self, job):
+        env = dict(os.environ)
+        if job.parameters is not None:
+            # simulate.py and its session processes read these parameters
+            path = os.path.join(self.job_dir, '%s_parameters.yaml' % job.id)
+            os.makedirs(self.job_dir, exist_ok=True)
+            with open(path, 'w') as f:
+                yaml.safe_dump(job.parameters, f)
+            env['PARAMETERS_PATH'] = path
+        with self.lock:
+            if job.status != RUNNING:
+                # cancelled before it started
+                self.finish(job, CANCELLED)
+                return
+            job.proc = subprocess.Popen(job.command(), env=env,
+                                        start_new_session=True)
+        log.info('running job %s: %s' % (job.id, ' '.join(job.proc.args)))
+        timeout = job.session_duration + 2 * settings.session_timeout_grace
+        try:
+            job.exit_code = job.proc.wait(timeout=timeout)
+        except subprocess.TimeoutExpired:
+            log.error('job %s passed its deadline, killing it.' % job.id)
+            os.killpg(job.proc.pid, signal.SIGKILL)
+            job.exit_code = job.proc.wait()
+        with self.lock:
+            if job.status == CANCELLED:
+                self.finish(job, CANCELLED)
+            else:
+                self.finish(job, SUCCEEDED if job.exit_code == 0 else FAILED)
+
+    def close(self):
+        """ stops taking jobs, terminates running ones """
+        with self.lock:
+            self.closed = True
+            running = [job for job in self.jobs.values()
+                       if job.status == RUNNING]
+            self.lock.notify_all()
+        for job in running:
+            self.cancel(job)
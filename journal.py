@@ -0,0 +1,189 @@
+from collections import namedtuple
+import settings
+import metrics
+import atexit
+import struct
+import mmap
+import glob
+import time
+import sys
+import os
+import logging
+
+log = logging.getLogger(__name__)
+
+# append only journal of the raw ouch frames a proxy routes.
+# a journal is a series of segment files, pre-allocated to
+# `settings.journal_segment_size` and written through mmap,
+#
+#   <journal_dir>/<session_code>/<market_tag>.<n>.journal
+#
+# a segment starts with a header, then records follow back to back
+#
+#   segment header  magic, version, wall clock and monotonic time at open
+#   record header   monotonic timestamp, direction, frame length  (<dBH)
+#   frame           the ouch frame as it was on the wire
+#
+# direction is 1 for frames from the exchange, 2 for frames from agents.
+# unwritten space is zeros, a record header with direction 0 ends
+# a segment. the payload of a record is written before its header,
+# so a record is either complete or not there at all.
+
+SEGMENT_HEADER = struct.Struct('<4sHdd')
+RECORD_HEADER = struct.Struct('<dBH')
+MAGIC = b'FJNL'
+VERSION = 1
+FROM_EXCHANGE = 1
+FROM_AGENTS = 2
+
+JournalRecord = namedtuple('JournalRecord', 'timestamp direction frame')
+
+# replays swap this for virtual time
+timestamp_source = time.monotonic
+
+
+def segment_path(directory, tag, number):
+    return os.path.join(directory, '%s.%05d.journal' % (tag, number))
+
+
+class JournalWriter:
+
+    def __init__(self, directory, tag, segment_size=None, clock=None):
+        self.directory = directory
+        self.tag = tag
+        self.clock = clock or timestamp_source
+        self.segment_size = segment_size or settings.journal_segment_size
+        self.segment_number = -1
+        self.file = None
+        self.map = None
+        self.offset = 0
+        self.records = metrics.counter(
+            'fimsim_journal_records_total', 'frames journaled', market=tag)
+        self.bytes = metrics.counter(
+            'fimsim_journal_bytes_total', 'bytes journaled', market=tag)
+        os.makedirs(directory, exist_ok=True)
+        self.open_segment()
+
+    def open_segment(self):
+        self.close_segment()
+        self.segment_number += 1
+        path = segment_path(self.directory, self.tag, self.segment_number)
+        self.file = open(path, 'w+b')
+        # allocated up front, appends never grow the file
+        try:
+            os.posix_fallocate(self.file.fileno(), 0, self.segment_size)
+        except (AttributeError, OSError):
+            self.file.truncate(self.segment_size)
+        self.map = mmap.mmap(self.file.fileno(), self.segment_size)
+        SEGMENT_HEADER.pack_into(self.map, 0, MAGIC, VERSION, time.time(),
+                                 time.monotonic())
+        self.offset = SEGMENT_HEADER.size
+        log.info('journaling %s to %s.' % (self.tag, path))
+
+    def append(self, direction, frame, timestamp=None):
+        size = len(frame)
+        offset = self.offset
+        end = offset + RECORD_HEADER.size + size
+        # room for the header ending the segment
+        if end + RECORD_HEADER.size > self.segment_size:
+            if offset == SEGMENT_HEADER.size:
+                raise ValueError('frame of %s bytes does not fit a segment' %
+                                 size)
+            self.open_segment()
+            return self.append(direction, frame, timestamp)
+        self.map[offset + RECORD_HEADER.size:end] = frame
+        RECORD_HEADER.pack_into(
+            self.map, offset, self.clock() if timestamp is None else
+            timestamp, direction, size)
+        self.offset = end
+        self.records.value += 1
+        self.bytes.value += end - offset
+
+    def close_segment(self):
+        if self.map is None:
+            return
+        self.map.flush()
+        self.map.close()
+        # room left in the last segment is given back
+        self.file.truncate(self.offset + RECORD_HEADER.size)
+        self.file.close()
+        self.map = self.file = None
+
+    def close(self):
+        self.close_segment()
+
+
+def session_journal_dir(session_code, journal_dir=None):
+    return os.path.join(journal_dir or settings.journal_dir, session_code)
+
+
+def open_session_journal(session_code, tag):
+    """ a journal of the market `tag`, None unless journaling is on """
+    if not settings.record_journal:
+        return None
+    writer = JournalWriter(session_journal_dir(session_code), tag)
+    atexit.register(writer.close)
+    return writer
+
+
+class JournalSegment:
+    """ a segment file, mapped read only """
+
+    def __init__(self, path):
+        self.path = path
+        with open(path, 'rb') as f:
+            self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, self.opened_at, self.opened_monotonic = (
+            SEGMENT_HEADER.unpack_from(self.map, 0))
+        if magic != MAGIC or version != VERSION:
+            raise ValueError('%s is not a version %s journal segment' % (
+                path, VERSION))
+
+    def __iter__(self):
+        """ records, frames are memoryviews into the mapped file """
+        view = memoryview(self.map)
+        offset, end = SEGMENT_HEADER.size, len(self.map)
+        while offset + RECORD_HEADER.size <= end:
+            timestamp, direction, size = RECORD_HEADER.unpack_from(
+                self.map, offset)
+            if direction == 0:
+                break
+            offset += RECORD_HEADER.size
+            yield JournalRecord(timestamp, direction, view[offset:offset + size])
+            offset += size
+
+    def wall_time(self, timestamp):
+        """ a monotonic timestamp of this host as wall clock time """
+        return self.opened_at + timestamp - self.opened_monotonic
+
+
+def journal_segments(directory, tag):
+    """ segment paths of a journal, in order """
+    return sorted(glob.glob(os.path.join(directory, '%s.*.journal' % tag)))
+
+
+def read_journal(directory, tag):
+    """ records of a journal across its segments, copied to bytes """
+    for path in journal_segments(directory, tag):
+        for record in JournalSegment(path):
+            yield record._replace(frame=bytes(record.frame))
+
+
+def journal_tags(directory):
+    """ market tags with a journal in `directory` """
+    return sorted({os.path.basename(path).split('.')[0] for path in
+                   glob.glob(os.path.join(directory, '*.journal'))})
+
+
+if __name__ == '__main__':
+    # python journal.py <session code>
+    # frame counts by market, direction and message type
+    directory = session_journal_dir(sys.argv[1])
+    for tag in journal_tags(directory):
+        counts = {}
+        for record in read_journal(directory, tag):
+            key = (record.direction, chr(record.frame[0]))
+            counts[key] = counts.get(key, 0) + 1
+        for (direction, header), count in sorted(counts.items()):
+            print('%s\t%s\t%s\t%s' % (tag, 'exchange' if direction ==
+                  FROM_EXCHANGE else 'agents', header, count))
@@ -0,0 +1,202 @@
+from collections import OrderedDict, defaultdict
+import atexit
+import glob
+import json
+import time
+import logging
+
+log = logging.getLogger(__name__)
+
+# per hop order latency histograms.
+# messages are matched across hops by order token,
+# every process keeps its own histograms and dumps them at exit,
+# the session manager merges the dumps with the session results.
+
+# log-linear buckets as in hdr histograms, values are microseconds.
+# values below 2 ** (SUB_BUCKET_BITS + 1) are exact,
+# larger ones are kept within 1 / 2 ** SUB_BUCKET_BITS relative error
+SUB_BUCKET_BITS = 5
+
+
+def bucket_index(value: int):
+    shift = value.bit_length() - SUB_BUCKET_BITS - 1
+    if shift <= 0:
+        return value
+    return (shift << SUB_BUCKET_BITS) + (value >> shift)
+
+
+def bucket_value(index: int):
+    """ lowest value of a bucket """
+    shift = (index >> SUB_BUCKET_BITS) - 1
+    if shift <= 0:
+        return index
+    return (index - (shift << SUB_BUCKET_BITS)) << shift
+
+
+class LatencyHistogram:
+
+    def __init__(self):
+        self.counts = defaultdict(int)
+        self.count = 0
+        self.total = 0
+        self.min = None
+        self.max = None
+
+    def record(self, seconds):
+        value = max(0, int(seconds * 1e6))
+        self.counts[bucket_index(value)] += 1
+        self.count += 1
+        self.total += value
+        if self.min is None or value < self.min:
+            self.min = value
+        if self.max is None or value > self.max:
+            self.max = value
+
+    def merge(self, other):
+        for index, count in other.counts.items():
+            self.counts[index] += count
+        self.count += other.count
+        self.total += other.total
+        for attr, pick in (('min', min), ('max', max)):
+            values = [v for v in (getattr(self, attr), getattr(other, attr))
+                if v is not None]
+            setattr(self, attr, pick(values) if values else None)
+        return self
+
+    def percentile(self, q):
+        """ value in microseconds at percentile q (0 - 100) """
+        if not self.count:
+            return None
+        threshold = self.count * q / 100
+        seen = 0
+        for index in sorted(self.counts):
+            seen += self.counts[index]
+            if seen >= threshold:
+                return min(bucket_value(index), self.max)
+        return self.max
+
+    def summary(self):
+        return {
+            'count': self.count,
+            'mean_us': self.total / self.count if self.count else None,
+            'min_us': self.min,
+            'p50_us': self.percentile(50),
+            'p90_us': self.percentile(90),
+            'p99_us': self.percentile(99),
+            'p999_us': self.percentile(99.9),
+            'max_us': self.max,
+        }
+
+    def to_dict(self):
+        return {
+            'counts': {str(k): v for k, v in self.counts.items()},
+            'count': self.count, 'total': self.total,
+            'min': self.min, 'max': self.max,
+        }
+
+    @classmethod
+    def from_dict(cls, d):
+        histogram = cls()
+        for k, v in d['counts'].items():
+            histogram.counts[int(k)] = v
+        histogram.count = d['count']
+        histogram.total = d['total']
+        histogram.min = d['min']
+        histogram.max = d['max']
+        return histogram
+
+
+class LatencyRecorder:
+    """
+    keeps a histogram per hop and the time
+    outstanding orders were last seen, by order token
+    """
+    max_pending = 10000
+
+    def __init__(self):
+        self.enabled = False
+        self.histograms = defaultdict(LatencyHistogram)
+        self.pending = defaultdict(OrderedDict)
+        self.path = None
+
+    def configure(self, path):
+        self.enabled = True
+        self.path = path
+
+    def observe(self, hop, seconds):
+        self.histograms[hop].record(seconds)
+
+    def stamp(self, stage, token, at=None):
+        """ remember when the order `token` left `stage` """
+        pending = self.pending[stage]
+        pending[token] = time.monotonic() if at is None else at
+        if len(pending) > self.max_pending:
+            # orders that never got a response
+            pending.popitem(last=False)
+
+    def match(self, stage, token, hop, now=None):
+        """
+        record the time since `token` left `stage` under `hop`
+        returns the current time
+        """
+        now = time.monotonic() if now is None else now
+        sent_at = self.pending[stage].pop(token, None)
+        if sent_at is not None:
+            self.observe(hop, now - sent_at)
+        return now
+
+    def dump(self):
+        if self.enabled and self.histograms:
+            with open(self.path, 'w') as f:
+                json.dump({hop: h.to_dict() for hop, h in
+                    self.histograms.items()}, f)
+
+
+recorder = LatencyRecorder()
+atexit.register(recorder.dump)
+
+
+def merge_latency_dumps(paths):
+    histograms = defaultdict(LatencyHistogram)
+    for path in paths:
+        with open(path) as f:
+            for hop, d in json.load(f).items():
+                histograms[hop].merge(LatencyHistogram.from_dict(d))
+    return histograms
+
+
+def export_session_latency(session_id, logs_dir, dest):
+    """
+    merges latency dumps of all processes of a session,
+    writes the merged histograms with a percentile summary per hop
+    """
+    paths = glob.glob('%s/session_%s_*.latency.json' % (
+        logs_dir.rstrip('/'), session_id))
+    if not paths:
+        return None
+    histograms = merge_latency_dumps(paths)
+    with open(dest, 'w') as f:
+        json.dump({hop: dict(h.summary(), histogram=h.to_dict()) for
+            hop, h in sorted(histograms.items())}, f, indent=2)
+    log.info('latency histograms of %s processes written to %s.' % (
+        len(paths), dest))
+    return dest
+
+
+# ouch request and response types that carry the token of a pending order
+REQUEST_TYPES = (b'O', b'U', b'C')
+RESPONSE_TYPES = (b'A', b'U', b'C')
+
+
+def request_token(msg: bytes):
+    header = msg[:1]
+    if header == b'U':
+        # responses to replace requests carry the replacement token
+        return bytes(msg[15:29])
+    if header in REQUEST_TYPES:
+        return bytes(msg[1:15])
+
+
+def response_token(msg: bytes):
+    if msg[:1] in RESPONSE_TYPES:
+        return bytes(msg[9:23])
@@ -0,0 +1,382 @@
+import settings
+from zygote import ZygoteProcess
+from collections import defaultdict
+import subprocess
+import threading
+import socket
+import queue
+import atexit
+import json
+import time
+import sys
+import logging
+
+log = logging.getLogger(__name__)
+
+# launchers start the processes of a session, on this host or on
+# worker daemons (worker.py). commands are argument lists run by the
+# python interpreter, with placeholders the launcher fills in:
+#   {<name>_port} {<name>_fd}  listening socket bound by the launcher
+#                              and inherited by the process
+#   {<name>_port}              a free port the process binds itself
+#   {bind_host}                interface servers should listen on
+# launched processes look like subprocess.Popen objects, plus
+# the host they run on and their ports.
+
+
+def bind_listening_socket(host=''):
+    """
+    a listening socket on a port assigned by the os,
+    handed over to a child process as is, so nothing
+    can take the port between choosing and binding it
+    """
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind((host, 0))
+    sock.listen(socket.SOMAXCONN)
+    return sock
+
+
+# gets a list of `num_ports` ports assigned by the os,
+# for servers that can only be told a port number
+def get_available_ports(num_ports):
+    sockets = [bind_listening_socket() for _ in range(num_ports)]
+    ports = [sock.getsockname()[1] for sock in sockets]
+    for sock in sockets:
+        sock.close()
+    return ports
+
+
+def port_accepts_connections(port, host='127.0.0.1'):
+    try:
+        socket.create_connection((host, port), timeout=1).close()
+    except OSError:
+        return False
+    return True
+
+
+def prepare_command(cmd, listen=(), ports=(), bind_host='localhost'):
+    """
+    binds sockets and picks ports for a command,
+    returns the formatted command, the sockets and port numbers
+    """
+    sockets = {name: bind_listening_socket() for name in listen}
+    port_numbers = {name: sock.getsockname()[1] for name, sock in
+                    sockets.items()}
+    port_numbers.update(zip(ports, get_available_ports(len(ports))))
+    fields = {'bind_host': bind_host}
+    fields.update({name + '_port': port for name, port in
+                   port_numbers.items()})
+    fields.update({name + '_fd': sock.fileno() for name, sock in
+                   sockets.items()})
+    return [arg.format(**fields) for arg in cmd], sockets, port_numbers
+
+
+class LocalProcess:
+    """ a process on this host, a subprocess.Popen or ZygoteProcess """
+
+    host = '127.0.0.1'
+
+    def __init__(self, process_id, proc, ports, ready_port=None):
+        self.process_id = process_id
+        self.proc = proc
+        self.pid = proc.pid
+        self.ports = ports
+        self.ready_port = ready_port
+
+    @property
+    def returncode(self):
+        return self.proc.returncode
+
+    def poll(self):
+        return self.proc.poll()
+
+    def wait(self, timeout=None):
+        return self.proc.wait(timeout=timeout)
+
+    def terminate(self):
+        self.proc.terminate()
+
+    def kill(self):
+        self.proc.kill()
+
+    def ready(self):
+        if self.ready_port is None:
+            return True
+        return port_accepts_connections(self.ports[self.ready_port])
+
+
+def start_process(cmd, pass_fds=(), env=None, zygote=None):
+    """
+    runs a command with the python interpreter, forked
+    from the zygote at `zygote` if there is one
+    """
+    if zygote and not cmd[0].startswith('-'):
+        try:
+            return ZygoteProcess(cmd, path=zygote, pass_fds=pass_fds, env=env)
+        except OSError as e:
+            log.warning('zygote at %s failed, starting %s: %s' % (
+                zygote, cmd[0], e))
+    return subprocess.Popen([sys.executable] + cmd, pass_fds=pass_fds, 
+                            env=env)
+
+
+class LocalLauncher:
+
+    remote = False
+
+    def __init__(self, zygote=None):
+        self.zygote = zygote
+
+    def share_manifest(self, manifest):
+        """ where processes of this launcher find `manifest` """
+        return manifest.directory
+
+    def launch(self, process_id, cmd, kind, listen=(), ports=(),
+               ready_port=None, env=None, weight=None):
+        cmd, sockets, port_numbers = prepare_command(cmd, listen, ports)
+        proc = start_process(
+            cmd, [sock.fileno() for sock in sockets.values()],
+            zygote=self.zygote)
+        # the process owns the listening sockets now
+        for sock in sockets.values():
+            sock.close()
+        # make sure this process is eventually killed
+        atexit.register(proc.terminate)
+        return LocalProcess(process_id, proc, port_numbers, ready_port)
+
+    def close(self):
+        pass
+
+
+def wait_until_ready(processes, timeout):
+    """ polls until every process is ready to take connections """
+    deadline = time.monotonic() + timeout
+    waiting = list(processes)
+    while waiting:
+        for proc in list(waiting):
+            if proc.poll() is not None:
+                raise RuntimeError('%s exited with %s' % (
+                    proc.process_id, proc.returncode))
+            if proc.ready():
+                waiting.remove(proc)
+        if waiting:
+            if time.monotonic() > deadline:
+                raise RuntimeError('not ready in time: %s' % ', '.join(
+                    proc.process_id for proc in waiting))
+            time.sleep(0.05)
+
+
+class RemoteProcess:
+    """ a process on a worker, driven like subprocess.Popen """
+
+    def __init__(self, process_id, worker):
+        self.process_id = process_id
+        self.worker = worker
+        self.host = worker.host
+        self.ports = {}
+        self.pid = None
+        self.returncode = None
+        self.error = None
+        self.launched = threading.Event()
+        self.is_ready = threading.Event()
+        self.exited = threading.Event()
+
+    def ready(self):
+        return self.is_ready.is_set()
+
+    def poll(self):
+        return self.returncode
+
+    def wait(self, timeout=None):
+        if not self.exited.wait(timeout):
+            raise subprocess.TimeoutExpired(self.process_id, timeout)
+        return self.returncode
+
+    def send_signal(self, signal_name):
+        if self.returncode is None:
+            try:
+                self.worker.send(type='signal', id=self.process_id,
+                                 signal=signal_name)
+            except OSError:
+                # the worker kills it once the connection drops
+                log.warning('worker %s is gone, cannot signal %s' % (
+                    self.worker.address, self.process_id))
+
+    def terminate(self):
+        self.send_signal('TERM')
+
+    def kill(self):
+        self.send_signal('KILL')
+
+
+class WorkerClient:
+    """
+    a connection to a worker daemon, messages are json lines.
+    a reader thread hands replies to waiting callers
+    and process events to their RemoteProcess
+    """
+
+    def __init__(self, address):
+        host, port = address.rsplit(':', 1)
+        self.address = address
+        self.sock = socket.create_connection((host, int(port)))
+        self.file = self.sock.makefile('rwb')
+        self.write_lock = threading.Lock()
+        self.replies = queue.Queue()
+        self.processes = {}
+        self.info = None
+        self.reader = threading.Thread(target=self._read, daemon=True,
+                                       name='worker-%s' % address)
+        self.reader.start()
+        self.send(type='info')
+        self.info = self.replies.get(timeout=settings.worker_timeout)
+        # where the worker's servers can be reached
+        self.host = self.info['host']
+        self.cpus = self.info['cpus']
+
+    def send(self, **msg):
+        msg['token'] = settings.worker_token
+        line = json.dumps(msg).encode('utf-8') + b'\n'
+        with self.write_lock:
+            self.file.write(line)
+            self.file.flush()
+
+    def share_manifest(self, manifest):
+        """ copies a session manifest to the worker, returns its path there """
+        self.send(type='manifest', session=manifest.session_code,
+                  files=manifest.pack())
+        reply = self.replies.get(timeout=settings.worker_timeout)
+        if reply.get('error'):
+            raise RuntimeError('worker %s failed to take the manifest: %s' % (
+                self.address, reply['error']))
+        return reply['directory']
+
+    def launch(self, process_id, cmd, kind, listen=(), ports=(),
+               ready_port=None, env=None):
+        proc = self.processes[process_id] = RemoteProcess(process_id, self)
+        self.send(type='launch', id=process_id, cmd=list(cmd), kind=kind,
+                  listen=list(listen), ports=list(ports),
+                  ready_port=ready_port, env=env or {})
+        if not proc.launched.wait(settings.worker_timeout):
+            raise RuntimeError('worker %s did not launch %s' % (
+                self.address, process_id))
+        if proc.error:
+            raise RuntimeError('worker %s failed to launch %s: %s' % (
+                self.address, process_id, proc.error))
+        return proc
+
+    def _read(self):
+        for line in self.file:
+            msg = json.loads(line.decode('utf-8'))
+            proc = self.processes.get(msg.get('id'))
+            if msg['type'] in ('info', 'manifest'):
+                self.replies.put(msg)
+            elif msg['type'] == 'launched':
+                proc.pid = msg.get('pid')
+                proc.ports = msg.get('ports', {})
+                proc.error = msg.get('error')
+                proc.launched.set()
+            elif msg['type'] == 'ready':
+                proc.is_ready.set()
+            elif msg['type'] == 'exit':
+                proc.returncode = msg['code']
+                proc.exited.set()
+        # worker is gone, so are its processes
+        for proc in self.processes.values():
+            if not proc.exited.is_set():
+                proc.returncode = -1
+                proc.exited.set()
+
+    def close(self):
+        # the worker kills processes of a closed connection
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        self.sock.close()
+
+
+class WorkerLauncher:
+    """
+    places processes on workers by cpu capacity, every process
+    kind weighs as settings.process_cpu_weights says unless its
+    launch gives a weight, each launch goes to the worker with
+    the lowest weight per cpu after it
+    """
+
+    remote = True
+
+    def __init__(self, addresses):
+        self.workers = [WorkerClient(address) for address in addresses]
+        # start from the load workers already have
+        self.assigned = {worker: worker.info.get('load', 0) for worker in
+                         self.workers}
+        self.placement = defaultdict(list)
+
+    def place(self, kind, weight=None):
+        if weight is None:
+            weight = settings.process_cpu_weights.get(kind, 1)
+        worker = min(self.workers, key=lambda w: (
+            (self.assigned[w] + weight) / w.cpus))
+        self.assigned[worker] += weight
+        return worker
+
+    def share_manifest(self, manifest):
+        """
+        copies a session manifest to every worker,
+        returns the path workers find it at
+        """
+        directories = {worker.share_manifest(manifest) for worker in
+                       self.workers}
+        if len(directories) > 1:
+            raise RuntimeError('workers keep manifests in different '
+                               'directories: %s' % ', '.join(directories))
+        return directories.pop()
+
+    def launch(self, process_id, cmd, kind, listen=(), ports=(),
+               ready_port=None, env=None, weight=None):
+        worker = self.place(kind, weight)
+        self.placement[worker.address].append(process_id)
+        return worker.launch(process_id, cmd, kind, listen, ports,
+                             ready_port, env)
+
+    def close(self):
+        for address, process_ids in self.placement.items():
+            log.info('worker %s ran %s' % (address, ', '.join(process_ids)))
+        for worker in self.workers:
+            worker.close()
+
+
+def exchange_command(market, debug=False):
+    cmd = [
+        'exchange_server/run_exchange_server.py',
+        '--host', '{bind_host}',
+        '--port', '{exchange_port}',
+        '--mechanism', market['format'].lower(),
+    ]
+    if market['format'] == 'FBA':
+        cmd.extend([
+            '--interval', str(market['fba_interval']),
+        ])
+    if debug:
+        cmd.append('--debug')
+    return cmd
+
+
+def start_exchanges(markets, launcher, debug=False):
+    """
+    starts an exchange per market all at once, 
+    returns their processes and (host, port) by market tag
+    """
+    procs, exchanges = {}, {}
+    for market in markets:
+        tag = market['tag']
+        proc = procs[tag] = launcher.launch(
+            '%s_exchange' % tag, exchange_command(market, debug), 'exchange',
+            ports=('exchange',), ready_port='exchange')
+        # on a worker the exchange runs where the worker says
+        host = proc.host if launcher.remote else market['exchange_host']
+        exchanges[tag] = (host, proc.ports['exchange'])
+    wait_until_ready(procs.values(), settings.exchange_start_timeout)
+    return procs, exchanges
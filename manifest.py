@@ -0,0 +1,256 @@
+import settings
+import draw
+import utility
+import topology
+import numpy as np
+import numbers
+import base64
+import json
+import os
+import re
+import shutil
+import logging
+
+log = logging.getLogger(__name__)
+
+# a session manifest is compiled once by simulate.py and read by
+# every session process instead of parameters.yaml. it is a directory
+#
+#   manifest.json       validated parameters, markets, agents
+#                       with their account ids and tape files
+#   rabbit_<i>.npy      order tape of rabbit i
+#   elo_<i>_speed.npy   speed and slider events of interactive agent i
+#   elo_<i>_slider.npy
+#
+# tapes are numpy record arrays, processes map them read only.
+# files are read only once written, so all processes see the same inputs.
+# sessions run on workers ship the manifest to each worker first.
+
+MANIFEST_FILE = 'manifest.json'
+# session codes and file names of manifests shipped to workers
+SAFE_NAME = re.compile(r'^\w[\w.-]*$')
+
+speed_event_dtype = np.dtype([
+    ('arrival_time', np.float64),
+    ('technology_on', np.float64),
+])
+slider_event_dtype = np.dtype([
+    ('arrival_time', np.float64),
+    ('a_x', np.float64),
+    ('a_y', np.float64),
+    ('a_z', np.float64),
+])
+
+
+def validate_parameters(params: dict, markets: list):
+    """
+    checks parameters a session can not run without,
+    returns a copy with lambdaI as a list, one rate per market
+    """
+    params = dict(params)
+    errors = []
+    duration = params.get('session_duration')
+    if not isinstance(duration, numbers.Number) or duration <= 0:
+        errors.append('session_duration must be a positive number')
+    lambda_i = params.get('lambdaI')
+    if isinstance(lambda_i, numbers.Number):
+        lambda_i = [lambda_i] * len(markets)
+    if not isinstance(lambda_i, list) or len(lambda_i) < len(markets):
+        errors.append('lambdaI needs a rate per market, %s markets' % (
+            len(markets)))
+    elif any(not isinstance(rate, numbers.Number) or rate <= 0 for rate in
+             lambda_i):
+        errors.append('lambdaI rates must be positive numbers')
+    params['lambdaI'] = lambda_i
+    for ix, row in enumerate(params.get('agent_state_configs') or ()):
+        if len(row) != 6 or not all(isinstance(v, numbers.Number) for v in row):
+            errors.append('agent_state_configs row %s is not 6 numbers' % ix)
+        elif int(row[1]) < 1:
+            errors.append('agent_state_configs row %s: agents count from 1' %
+                          ix)
+    for market in markets:
+        if market['format'] not in ('CDA', 'FBA'):
+            errors.append('market %s has unknown format %s' % (
+                market['tag'], market['format']))
+    if errors:
+        raise ValueError('invalid parameters: %s' % '; '.join(errors))
+    return params
+
+
+def agent_event_tapes(agent_events, num_agents):
+    """
+    speed and slider events of each interactive agent as record arrays,
+    partitioned in one pass over the agent state configs
+    """
+    rows = [[] for _ in range(num_agents)]
+    for arrival_time, agent_num, tech_subsc, a_x, a_y, a_z in agent_events:
+        rows[int(agent_num) - 1].append((arrival_time, tech_subsc, a_x, a_y, a_z))
+    tapes = []
+    for agent_rows in rows:
+        speed = np.array([row[:2] for row in agent_rows], dtype=speed_event_dtype)
+        slider = np.array([(row[0], ) + row[2:] for row in agent_rows],
+                          dtype=slider_event_dtype)
+        tapes.append((speed, slider))
+    return tapes
+
+
+def unique_account_ids(count):
+    account_ids = set()
+    while len(account_ids) < count:
+        account_ids.add(utility.generate_account_id())
+    return sorted(account_ids)
+
+
+def compile_manifest(session_code, params: dict, random_seed, directory=None):
+    """
+    validates parameters, draws tapes and writes the manifest
+    of a session, returns the manifest directory
+    """
+    directory = directory or os.path.join(settings.manifest_dir, session_code)
+    markets = topology.get_markets(params)
+    params = validate_parameters(params, markets)
+    duration = params['session_duration']
+    rabbits = topology.get_rabbits(markets, random_seed)
+    num_agents = utility.get_interactive_agent_count(
+        params['agent_state_configs']) if params['agent_state_configs'] else 0
+    account_ids = iter(unique_account_ids(len(rabbits) + num_agents))
+
+    # written next to the final directory, moved in place when complete
+    staging = directory.rstrip(os.sep) + '.tmp'
+    shutil.rmtree(staging, ignore_errors=True)
+    os.makedirs(staging)
+    files = []
+
+    def save(name, array):
+        np.save(os.path.join(staging, name), array)
+        files.append(name)
+        return name
+
+    manifest = {
+        'session_code': session_code,
+        'random_seed': random_seed,
+        'params': params,
+        'markets': markets,
+        'initial_market_view': utility.get_traders_initial_market_view(params),
+        'elo_agent_parameters': utility.get_elo_agent_parameters(
+            params=params),
+        'rabbits': [],
+        'agents': [],
+    }
+    for i, (tag, config_num, seed) in enumerate(rabbits):
+        tape = draw.elo_draw(duration, params, seed=seed, config_num=config_num)
+        manifest['rabbits'].append({
+            'market': tag,
+            'config_num': config_num,
+            'random_seed': seed,
+            'account_id': next(account_ids),
+            'orders': save('rabbit_%s.npy' % i, tape),
+        })
+    event_tapes = agent_event_tapes(params['agent_state_configs'], num_agents)
+    for config_num, (speed, slider) in enumerate(event_tapes):
+        focal, external = topology.get_agent_markets(params, config_num,
+                                                     markets)
+        manifest['agents'].append({
+            'config_num': config_num,
+            'focal_market': focal,
+            'external_markets': external,
+            'account_id': next(account_ids),
+            'speed': save('elo_%s_speed.npy' % config_num, speed),
+            'slider': save('elo_%s_slider.npy' % config_num, slider),
+        })
+    with open(os.path.join(staging, MANIFEST_FILE), 'w') as f:
+        json.dump(manifest, f, indent=1)
+    seal(staging, directory, files + [MANIFEST_FILE])
+    log.info('compiled manifest of session %s: %s rabbits, %s agents, %s.' % (
+        session_code, len(rabbits), num_agents, directory))
+    return directory
+
+
+def seal(staging, directory, names):
+    """ makes staged files read only and moves them in place """
+    for name in names:
+        os.chmod(os.path.join(staging, name), 0o444)
+    if os.path.exists(directory):
+        shutil.rmtree(directory)
+    os.rename(staging, directory)
+
+
+def unpack_manifest(session_code, files: dict, directory=None):
+    """
+    writes a manifest shipped by simulate.py to a worker,
+    `files` maps file names to base64 contents.
+    returns the manifest directory
+    """
+    names = [session_code] + list(files)
+    if MANIFEST_FILE not in files or not all(
+            isinstance(name, str) and SAFE_NAME.match(name) for name in names):
+        raise ValueError('invalid manifest of session %s: %s' % (
+            session_code, ', '.join(map(str, files))))
+    directory = directory or os.path.join(settings.manifest_dir, session_code)
+    contents = {name: base64.b64decode(data) for name, data in files.items()}
+    path = os.path.join(directory, MANIFEST_FILE)
+    if os.path.exists(path):
+        with open(path, 'rb') as f:
+            # a worker on the host that compiled it
+            if f.read() == contents[MANIFEST_FILE]:
+                return directory
+    staging = directory.rstrip(os.sep) + '.tmp'
+    shutil.rmtree(staging, ignore_errors=True)
+    os.makedirs(staging)
+    for name, content in contents.items():
+        with open(os.path.join(staging, name), 'wb') as f:
+            f.write(content)
+    seal(staging, directory, list(contents))
+    log.info('unpacked manifest of session %s: %s.' % (
+        session_code, directory))
+    return directory
+
+
+class Manifest:
+    """ a compiled session manifest, opened read only """
+
+    def __init__(self, directory):
+        self.directory = directory
+        with open(os.path.join(directory, MANIFEST_FILE)) as f:
+            self.data = json.load(f)
+        self.session_code = self.data['session_code']
+        self.params = self.data['params']
+        self.markets = self.data['markets']
+        self.rabbits = self.data['rabbits']
+        self.agents = self.data['agents']
+
+    def tape(self, name):
+        return np.load(os.path.join(self.directory, name), mmap_mode='r')
+
+    def agent(self, agent_type, index):
+        """ manifest entry of rabbit or interactive agent `index` """
+        if agent_type == 'rabbit':
+            return self.rabbits[index]
+        if agent_type == 'elo':
+            return self.agents[index]
+        raise ValueError('invalid agent type %s' % agent_type)
+
+    def files(self):
+        """ names of the manifest's files """
+        names = [MANIFEST_FILE]
+        names.extend(rabbit['orders'] for rabbit in self.rabbits)
+        for agent in self.agents:
+            names.extend((agent['speed'], agent['slider']))
+        return names
+
+    def pack(self):
+        """ the manifest's files as base64, for unpack_manifest """
+        files = {}
+        for name in self.files():
+            with open(os.path.join(self.directory, name), 'rb') as f:
+                files[name] = base64.b64encode(f.read()).decode('ascii')
+        return files
+
+    def install(self):
+        """ parameters come from the manifest from now on """
+        utility.use_parameters(self.params, self.data['initial_market_view'])
+        return self
+
+
+def open_manifest(directory):
+    return Manifest(directory).install()
@@ -0,0 +1,63 @@
+import configargparse
+import settings
+import heapq
+import glob
+import json
+import sys
+import logging
+
+log = logging.getLogger(__name__)
+
+# merges the trace files of all processes of a session
+# into a single stream ordered by wall clock time. every trace
+# file relates its monotonic event times to wall time in a clock
+# line, so traces of processes on different hosts line up as
+# well as the hosts' clocks agree
+
+p = configargparse.getArgParser()
+p.add('--session_code', required=True)
+p.add('--traces_dir', default=settings.logs_dir)
+p.add('--output', help='file to write merged trace to, defaults to stdout')
+options, args = p.parse_known_args()
+
+
+def read_trace(path):
+    """ records of a trace file, timed in wall clock seconds """
+    offset = None
+    with open(path) as f:
+        for line in f:
+            if not line.strip():
+                continue
+            record = json.loads(line)
+            if isinstance(record, dict):
+                # a clock line, written whenever tracing starts
+                offset = record['wall'] - record['monotonic']
+                continue
+            if offset is None:
+                log.warning('%s has no clock line, its times stay '
+                            'monotonic.' % path)
+                offset = 0.
+            record[0] += offset
+            yield record
+
+
+def merge_traces(session_code, traces_dir):
+    paths = sorted(glob.glob('%s/session_%s_*.trace' % (
+        traces_dir.rstrip('/'), session_code)))
+    return heapq.merge(*[read_trace(path) for path in paths], 
+                       key=lambda record: record[0])
+
+
+def main():
+    out = open(options.output, 'w') if options.output else sys.stdout
+    try:
+        for record in merge_traces(options.session_code, options.traces_dir):
+            out.write(json.dumps(record))
+            out.write('\n')
+    finally:
+        if out is not sys.stdout:
+            out.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,270 @@
+from prometheus_client.core import (
+    CollectorRegistry, CounterMetricFamily, GaugeMetricFamily)
+from prometheus_client.exposition import generate_latest, make_wsgi_app
+from collections import OrderedDict
+from wsgiref.simple_server import make_server, WSGIRequestHandler
+import virtual_clock
+import threading
+import atexit
+import glob
+import json
+import time
+import os
+import logging
+
+log = logging.getLogger(__name__)
+
+# live counters and gauges of session processes.
+# counters are plain attributes bumped on the hot path, gauges are
+# sampled when the process dumps its metrics, every
+# `settings.metrics_interval` seconds from a background thread, to
+#
+#   <logs_dir>/session_<code>_<process>.metrics.json
+#
+# a SessionMetricsCollector reads the dumps of a session and serves
+# them in prometheus text format, from simulate.py --metrics_port and
+# the web api. processes on worker hosts dump to their own logs_dir.
+
+
+class Counter:
+    __slots__ = ('value', )
+
+    def __init__(self):
+        self.value = 0
+
+    def inc(self, amount=1):
+        self.value += amount
+
+
+class MetricsRegistry:
+
+    def __init__(self):
+        self.enabled = False
+        self.path = None
+        self.process_tag = ''
+        # (name, labels) -> Counter or a function sampling a gauge
+        self.counters = OrderedDict()
+        self.gauges = OrderedDict()
+        self.help = {}
+        self.dumper = None
+        self.lag = None
+
+    def counter(self, name, help='', **labels):
+        """ the counter `name` with `labels`, created once """
+        key = (name, tuple(sorted(labels.items())))
+        self.help.setdefault(name, help)
+        try:
+            return self.counters[key]
+        except KeyError:
+            counter = self.counters[key] = Counter()
+            return counter
+
+    def gauge(self, name, sample, help='', **labels):
+        """ `sample` is called at every dump, returns a number """
+        self.help.setdefault(name, help)
+        self.gauges[(name, tuple(sorted(labels.items())))] = sample
+
+    def configure(self, path, process_tag='', interval=1.0):
+        self.enabled = True
+        self.path = path
+        self.process_tag = process_tag
+        self.dumper = MetricsDumper(self, interval)
+        self.dumper.start()
+
+    def snapshot(self):
+        samples = [(name, 'counter', dict(labels), counter.value) for
+                   (name, labels), counter in list(self.counters.items())]
+        for (name, labels), sample in list(self.gauges.items()):
+            try:
+                value = sample()
+            except Exception:
+                # sampled off the reactor thread, may race a mutation
+                log.debug('failed to sample %s' % name, exc_info=True)
+                continue
+            samples.append((name, 'gauge', dict(labels), value))
+        return {
+            'process': self.process_tag,
+            'timestamp': time.time(),
+            'help': self.help,
+            'samples': samples,
+        }
+
+    def dump(self):
+        if not self.enabled:
+            return
+        # readers never see a partially written dump
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(self.snapshot(), f)
+        os.replace(tmp_path, self.path)
+
+    def close(self):
+        if self.dumper is not None:
+            self.dumper.stop()
+            self.dumper = None
+        self.dump()
+
+    def watch_reactor(self, reactor, interval=0.1):
+        """ gauges of reactor lag and pending delayed calls """
+        if not self.enabled:
+            return
+        self.gauge('fimsim_reactor_delayed_calls',
+                   lambda: len(reactor.getDelayedCalls()),
+                   'calls scheduled on the reactor')
+        # lag is wall clock time, meaningless on a virtual clock
+        if isinstance(reactor, virtual_clock.VirtualClockReactor):
+            return
+        self.lag = ReactorLag(reactor, interval)
+        self.gauge('fimsim_reactor_lag_seconds', lambda: self.lag.last,
+                   'how late the last lag probe ran')
+        self.gauge('fimsim_reactor_lag_max_seconds', lambda: self.lag.max,
+                   'latest a lag probe ran')
+        reactor.callWhenRunning(self.lag.start)
+
+
+class ReactorLag:
+    """ a call every `interval` seconds, measures how late it runs """
+
+    def __init__(self, reactor, interval):
+        self.reactor = reactor
+        self.interval = interval
+        self.last = 0.
+        self.max = 0.
+        self.expected = None
+
+    def start(self):
+        self.expected = time.monotonic() + self.interval
+        self.reactor.callLater(self.interval, self.probe)
+
+    def probe(self):
+        now = time.monotonic()
+        self.last = max(0., now - self.expected)
+        if self.last > self.max:
+            self.max = self.last
+        self.expected = now + self.interval
+        self.reactor.callLater(self.interval, self.probe)
+
+
+class MetricsDumper(threading.Thread):
+
+    def __init__(self, registry, interval):
+        super().__init__(daemon=True, name='metrics_dumper')
+        self.registry = registry
+        self.interval = interval
+        self.stopped = threading.Event()
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            try:
+                self.registry.dump()
+            except Exception:
+                log.exception('failed to dump metrics')
+
+    def stop(self):
+        self.stopped.set()
+        self.join()
+
+
+registry = MetricsRegistry()
+counter = registry.counter
+gauge = registry.gauge
+atexit.register(registry.close)
+
+
+def configure_from_settings(path, process_tag=''):
+    import settings
+    if settings.record_metrics:
+        registry.configure(path, process_tag=process_tag,
+                           interval=settings.metrics_interval)
+
+
+def watch_reactor(reactor):
+    import settings
+    registry.watch_reactor(reactor, interval=settings.metrics_lag_interval)
+
+
+def dump_paths(session_code, logs_dir):
+    return glob.glob('%s/session_%s_*.metrics.json' % (
+        logs_dir.rstrip('/'), session_code))
+
+
+class SessionMetricsCollector:
+    """
+    prometheus collector over the metrics dumps of sessions,
+    `session_codes` is a list or a function returning one
+    """
+
+    def __init__(self, session_codes, logs_dir=None):
+        import settings
+        self.session_codes = session_codes
+        self.logs_dir = logs_dir or settings.logs_dir
+
+    def dumps(self):
+        codes = self.session_codes
+        for session_code in (codes() if callable(codes) else codes):
+            for path in dump_paths(session_code, self.logs_dir):
+                try:
+                    with open(path) as f:
+                        yield session_code, json.load(f)
+                except (OSError, ValueError):
+                    # the process may be starting
+                    continue
+
+    def collect(self):
+        families = OrderedDict()
+        now = time.time()
+        age = GaugeMetricFamily(
+            'fimsim_metrics_age_seconds', 'seconds since a process dumped',
+            labels=['session', 'process'])
+        for session_code, dump in self.dumps():
+            process = dump['process']
+            age.add_metric([session_code, process], now - dump['timestamp'])
+            for name, kind, labels, value in dump['samples']:
+                if value is None:
+                    continue
+                names = sorted(labels)
+                family = families.get(name)
+                if family is None:
+                    family_cls = CounterMetricFamily if kind == 'counter' else (
+                        GaugeMetricFamily)
+                    family = families[name] = family_cls(
+                        name, dump['help'].get(name) or name,
+                        labels=['session', 'process'] + names)
+                family.add_metric([session_code, process] + [
+                    str(labels[label]) for label in names], value)
+        yield age
+        for family in families.values():
+            yield family
+
+
+def session_metrics_registry(session_codes, logs_dir=None):
+    metrics_registry = CollectorRegistry(auto_describe=False)
+    metrics_registry.register(
+        SessionMetricsCollector(session_codes, logs_dir))
+    return metrics_registry
+
+
+def session_metrics_text(session_codes, logs_dir=None):
+    """ prometheus text format """
+    return generate_latest(session_metrics_registry(session_codes, logs_dir))
+
+
+class _QuietHandler(WSGIRequestHandler):
+
+    def log_message(self, *args):
+        pass
+
+
+def serve_session_metrics(session_code, port=0, host='127.0.0.1'):
+    """
+    serves metrics of a session from a background thread,
+    returns the http server, its port is server.server_port
+    """
+    app = make_wsgi_app(session_metrics_registry([session_code]))
+    server = make_server(host, port, app, handler_class=_QuietHandler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True,
+                              name='metrics_server')
+    thread.start()
+    log.info('serving metrics of session %s on http://%s:%s/metrics' % (
+        session_code, host, server.server_port))
+    return server
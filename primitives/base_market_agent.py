@@ -3,12 +3,16 @@ from random import choice
 import string
 from high_frequency_trading.hft.incoming_message import IncomingOuchMessage
 from high_frequency_trading.hft.event import ELOEvent
+from discrete_event_emitter import DiscreteEventScheduler
 from db import db
 from collections import deque
 import utility
+import metrics
+import tracing
 import logging
 
 log = logging.getLogger(__name__)
+trace = tracing.get_tracer(__name__)
 
 
 class BaseMarketAgent:
@@ -26,6 +30,7 @@ class BaseMarketAgent:
         self.trader_model = None
         self._exchange_connection = None
         self.event_emitters = event_emitters
+        self.event_scheduler = None
         self.outgoing_msg = deque()
 
     @property
@@ -54,8 +59,8 @@ class BaseMarketAgent:
     def process_event(self, event):
         while event.exchange_msgs:
             e_msg = event.exchange_msgs.pop()
-            log.info('responding %s event with message ---> %s' % (event.event_type,
-                e_msg))
+            trace.info('order_out', self.account_id, event.event_type, 
+                       getattr(e_msg, 'type', None), e_msg.delay)
             self.exchange_connection.sendMessage(e_msg.translate(), e_msg.delay)
 
     @db.freeze_state()
@@ -63,7 +68,8 @@ class BaseMarketAgent:
         if self.event_emitters:
             for em in self.event_emitters:
                 em.owner = self
-                em.register_events() 
+            self.event_scheduler = DiscreteEventScheduler(self.event_emitters)
+            self.event_scheduler.start()
         msg = utility.get_mock_market_msg(
                     utility.get_traders_initial_market_view(), 'market_start')
         event = self.event_cls('initial state', msg)
@@ -72,6 +78,8 @@ class BaseMarketAgent:
 
     @db.freeze_state()       
     def close_session(self):
+        if self.event_scheduler is not None:
+            self.event_scheduler.stop()
         msg = utility.get_mock_market_msg({}, 'market_end')
         event = self.event_cls('market close', msg)
         self.model.handle_event(event)
@@ -79,3 +87,11 @@ class BaseMarketAgent:
             self.account_id, self.typecode, self.session_id))
         return event
 
+
+def watch_agents(agents):
+    """ gauges over the agents running in this process """
+    metrics.gauge('fimsim_agents', lambda: len(agents), 
+                  'agents in the process')
+    metrics.gauge('fimsim_agent_outgoing_queue', 
+                  lambda: sum(len(agent.outgoing_msg) for agent in agents),
+                  'orders waiting for an exchange connection')
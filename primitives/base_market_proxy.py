@@ -2,13 +2,19 @@ from twisted.internet import reactor
 from high_frequency_trading.hft.incoming_message import IncomingOuchMessage
 from high_frequency_trading.hft.market import BaseMarket
 from high_frequency_trading.hft.event import Event
+from protocols.flow_control import BoundedSender, FlowCounters, UpstreamGate
 from db import db
-from collections import deque
+import settings
 import utility
 import json
+import latency
+import metrics
+import tracing
+import time
 import logging
 
 log = logging.getLogger(__name__)
+trace = tracing.get_tracer(__name__)
 
 
 class BaseMarketProxy:
@@ -19,62 +25,176 @@ class BaseMarketProxy:
     event_cls = Event
 
     def __init__(self, tag, session_id, exchange_host, exchange_port, 
-                    **kwargs):
-        self.market_id = 0 if tag == 'focal' else 1
+                    market_id=None, **kwargs):
+        if market_id is None:
+            market_id = 0 if tag == 'focal' else 1
+        self.market_id = market_id
         self.session_id = session_id
         self.model = self.market_cls(self.market_id, 0, session_id, 
                 exchange_host, exchange_port, **kwargs)
         self.exchange_connection = None
+        # requests awaiting the exchange, tracked on a virtual clock only
+        self.in_flight = getattr(reactor, 'in_flight', None)
+        # journal.JournalWriter, if frames are journaled
+        self.journal = None
         self.json_server_factory = None
         self.ouch_server_factory = None
-        # queue to store messages 
-        # when ouch channel to exchange is down.
-        self.outgoing_queue = deque(maxlen=100)
+        self.flow_counters = {name: FlowCounters() for name in (
+            'exchange', 'agents', 'json')}
+        # reading from agents stops while orders back up toward
+        # the exchange, reading from the exchange stops while
+        # market data backs up toward subscribers
+        self.agents_gate = UpstreamGate(self.agent_transports)
+        self.exchange_gate = UpstreamGate(self.exchange_transports)
+        # holds orders while the exchange is down or slow
+        self.exchange_sender = BoundedSender(
+            self.send_to_exchange, settings.exchange_buffer_limit,
+            settings.exchange_buffer_policy, self.flow_counters['exchange'],
+            upstream=self.agents_gate)
+        self.register_metrics(tag)
+
+    def register_metrics(self, tag):
+        self.ouch_frames = {
+            direction: metrics.counter(
+                'fimsim_proxy_ouch_frames_total', 'ouch frames routed', 
+                market=tag, source=source) 
+            for direction, source in ((1, 'exchange'), (2, 'agents'))}
+        self.json_messages = metrics.counter(
+            'fimsim_proxy_json_messages_total', 'market data broadcasts',
+            market=tag)
+        metrics.gauge('fimsim_proxy_agent_connections', 
+                      lambda: len(self.agent_transports()),
+                      'ouch connections of agents', market=tag)
+        for consumer, counters in self.flow_counters.items():
+            metrics.gauge('fimsim_flow_buffered_frames', 
+                          lambda consumer=consumer: self.buffered(consumer),
+                          'frames waiting for a consumer', market=tag, 
+                          consumer=consumer)
+            metrics.gauge('fimsim_flow_dropped_frames', 
+                          lambda counters=counters: counters.dropped,
+                          'frames dropped by flow control', market=tag,
+                          consumer=consumer)
+            metrics.gauge('fimsim_flow_pauses', 
+                          lambda counters=counters: counters.pauses,
+                          'times a consumer paused us', market=tag,
+                          consumer=consumer)
+
+    def buffered(self, consumer):
+        """ frames waiting in the buffers of a kind of consumer """
+        if consumer == 'exchange':
+            return len(self.exchange_sender.buffer)
+        factory = (self.ouch_server_factory if consumer == 'agents' else 
+                   self.json_server_factory)
+        if factory is None:
+            return 0
+        connections = (factory.connections if consumer == 'agents' else 
+                       factory.users.values())
+        return sum(len(conn.sender.buffer) for conn in list(connections))
+
+    def agent_transports(self):
+        if self.ouch_server_factory is None:
+            return []
+        return [conn.transport for conn in self.ouch_server_factory.connections]
+
+    def exchange_transports(self):
+        conn = self.exchange_connection
+        if conn is None or conn.transport is None:
+            return []
+        return [conn.transport]
+
+    def send_to_exchange(self, frame):
+        self.exchange_connection.sendMessage(frame, 0)
+
+    def exchange_connected(self, conn):
+        self.exchange_connection = conn
+        self.exchange_gate.admit(conn.transport)
+        # orders held while disconnected go out here
+        self.exchange_sender.attach(conn.transport)
+
+    def exchange_disconnected(self, conn):
+        log.warning('lost connection to exchange, holding orders.')
+        self.exchange_sender.pauseProducing()
+        self.exchange_connection = None
+
+    def flow_stats(self):
+        return {name: counters.as_dict() for name, counters in 
+                self.flow_counters.items()}
     
-    @db.freeze_state()     
-    def handle_OUCH(self, message: IncomingOuchMessage, original_msg: bytes, direction: int):
+    def route_OUCH(self, frame, direction: int, channel):
+        """
+        forwards a raw ouch frame, reading only its type and firm.
+        the frame is copied to bytes once to be forwarded, it is
+        decoded through `channel` only when the market model handles it
+        """
+        if self.journal is not None:
+            self.journal.append(direction, frame)
+        header = chr(frame[0])
+        recorder = latency.recorder
+        if recorder.enabled:
+            received_at = time.monotonic()
         # outbound message
-        if direction is 1:
+        if direction == 1:
+            self.ouch_frames[1].inc()
+            if recorder.enabled:
+                token = latency.response_token(frame)
+                recorder.match('proxy_to_exchange', token, 
+                               'exchange_round_trip', received_at)
+                trace.debug('proxy_from_exchange', token)
+            if self.in_flight is not None:
+                self.in_flight.answered(latency.response_token(frame))
             # assume public messages will be broadcasted over
             # a separate channel, and filtered by a market model.
             # so only handle private messages here, ignore the rest
-            if message.type in self.private_exchange_message_headers:
-                try:
-                    account_id = message.firm
-                except AttributeError:
-                    firm = utility.extract_firm_from_message(message)
-                    if firm:
-                        account_id = firm
-                    else:
-                        raise Exception('unable to determine recipient for: %s' % message)
+            if header in self.private_exchange_message_headers:
+                account_id = channel.firm_of(frame)
+                if not account_id:
+                    raise Exception('unable to determine recipient for: %s' % 
+                                    bytes(frame))
                 try:
                     account_conn = self.ouch_server_factory.users[account_id]
                 except KeyError:
                     log.error('connection for account id %s not found.' % account_id)
                 else:
-                    account_conn.sendMessage(original_msg, 0)
+                    # frames are views into read chunks, transports
+                    # take bytes only and a buffered view would keep
+                    # its chunk alive, so every forwarded frame is copied
+                    account_conn.sender.write(bytes(frame))
+                    if recorder.enabled:
+                        recorder.observe('proxy_outbound', 
+                                         time.monotonic() - received_at)
         # inbound message
-        elif direction is 2:
-            if self.exchange_connection is None:
-                self.outgoing_queue.append(message)
-                log.debug('message %s in queue..' % message)
-            else:
-                while self.outgoing_queue:
-                    earlier_msg = self.outgoing_queue.popleft()
-                    self.exchange_connection.sendMessage(earlier_msg, 0)
-                self.exchange_connection.sendMessage(original_msg, 0)
+        elif direction == 2:
+            self.ouch_frames[2].inc()
+            self.exchange_sender.write(bytes(frame))
+            if self.in_flight is not None:
+                token = latency.request_token(frame)
+                if token is not None:
+                    self.in_flight.sent(token)
+            if recorder.enabled:
+                token = latency.request_token(frame)
+                if token is not None:
+                    # held orders are timed from here as well
+                    recorder.observe('proxy_inbound', 
+                                     time.monotonic() - received_at)
+                    recorder.stamp('proxy_to_exchange', token)
+                    trace.debug('proxy_to_exchange', token)
         else:
             log.error('invalid message direction %s' % direction)
-        if hasattr(message, 'type') and message.type in self.market_event_headers:
+        if header in self.market_event_headers:
             # the message should be handled by the market model
-            event = self.event_cls('OUCH', message)
-            self.model.handle_event(event)
-            while event.broadcast_msgs:
-                broadcast_msg = event.broadcast_msgs.pop()
-                self.json_server_factory.broadcast(broadcast_msg)
-                log.info('broadcast after handling %s event: %s' % (
-                    event.event_type, broadcast_msg))
-            return event
+            return self.handle_market_event(channel.decode(frame))
+
+    @db.freeze_state()
+    def handle_market_event(self, message: IncomingOuchMessage):
+        event = self.event_cls('OUCH', message)
+        self.model.handle_event(event)
+        while event.broadcast_msgs:
+            broadcast_msg = event.broadcast_msgs.pop()
+            self.json_server_factory.broadcast(broadcast_msg)
+            self.json_messages.inc()
+            trace.info('broadcast', self.market_id, event.event_type, 
+                       broadcast_msg.data.get('type'))
+        return event
     
     @db.freeze_state()
     def handle_JSON(self):
@@ -86,6 +206,10 @@ class BaseMarketProxy:
         msg = utility.get_mock_market_msg({}, 'market_end')
         event = self.event_cls('market close', msg)
         self.model.handle_event(event)
+        log.info('flow control: %s' % self.flow_stats())
+        if self.journal is not None:
+            self.journal.close()
+            self.journal = None
         return event
 
 
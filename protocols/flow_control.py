@@ -0,0 +1,198 @@
+from twisted.internet.interfaces import IPushProducer
+from zope.interface import implementer
+from collections import deque
+from weakref import WeakKeyDictionary
+import time
+import logging
+
+log = logging.getLogger(__name__)
+
+# bounded buffers between the proxy and its consumers
+# (the exchange, agents, json subscribers).
+# a sender is registered as the producer of its consumer's transport,
+# twisted pauses it when the transport buffer fills up, frames wait
+# in the sender's buffer meanwhile. what happens when that buffer is
+# full is up to the policy:
+#   block       pause reading from whoever feeds the buffer, never drop
+#   drop_oldest discard the oldest waiting frame
+#   drop_newest discard the incoming frame
+
+POLICIES = ('block', 'drop_oldest', 'drop_newest')
+
+
+class FlowCounters:
+
+    def __init__(self):
+        self.queued = 0
+        self.dropped = 0
+        self.pauses = 0
+        self.paused_seconds = 0.
+        self.max_depth = 0
+
+    def as_dict(self):
+        return {
+            'queued': self.queued,
+            'dropped': self.dropped,
+            'pauses': self.pauses,
+            'paused_seconds': round(self.paused_seconds, 6),
+            'max_depth': self.max_depth,
+        }
+
+
+class UpstreamGate:
+    """
+    stops reading from a set of transports
+    for as long as any sender holds the gate
+    """
+
+    def __init__(self, transports):
+        self.transports = transports
+        self.holds = 0
+
+    @property
+    def closed(self):
+        return self.holds > 0
+
+    def hold(self):
+        self.holds += 1
+        if self.holds == 1:
+            for transport in self.transports():
+                _pause(transport)
+
+    def release(self):
+        self.holds -= 1
+        if self.holds == 0:
+            for transport in self.transports():
+                _resume(transport)
+
+    def admit(self, transport):
+        """ a new transport starts paused if the gate is closed """
+        if self.closed:
+            _pause(transport)
+
+
+# gates closed on each transport, a transport
+# behind more than one gate reads once all are open
+_paused_by = WeakKeyDictionary()
+
+
+def _pause(transport):
+    count = _paused_by.get(transport, 0)
+    _paused_by[transport] = count + 1
+    if not count:
+        _call(transport, 'pauseProducing')
+
+
+def _resume(transport):
+    count = _paused_by.pop(transport, 0)
+    if count > 1:
+        _paused_by[transport] = count - 1
+    elif count:
+        _call(transport, 'resumeProducing')
+
+
+def _call(transport, method):
+    # in memory transports do not pause
+    method = getattr(transport, method, None)
+    if method is not None:
+        method()
+
+
+@implementer(IPushProducer)
+class BoundedSender:
+
+    def __init__(self, send, limit, policy, counters, upstream=None,
+                 send_many=None):
+        if policy not in POLICIES:
+            raise ValueError('invalid flow control policy %s' % policy)
+        self.send = send
+        self.send_many = send_many
+        self.limit = limit
+        self.policy = policy
+        self.counters = counters
+        self.upstream = upstream
+        self.buffer = deque()
+        # not writable until attached to a transport
+        self.writable = False
+        self.paused_at = None
+        self.holding = False
+
+    def attach(self, transport):
+        transport.registerProducer(self, True)
+        self.resumeProducing()
+
+    def write(self, frame):
+        if self.writable and not self.buffer:
+            self.send(frame)
+        else:
+            self.enqueue(frame)
+
+    def extend(self, frames):
+        if self.writable and not self.buffer and self.send_many:
+            self.send_many(frames)
+        else:
+            for frame in frames:
+                self.write(frame)
+
+    def enqueue(self, frame):
+        buffer, counters = self.buffer, self.counters
+        counters.queued += 1
+        if len(buffer) >= self.limit:
+            if self.policy == 'drop_newest':
+                self.dropped()
+                return
+            if self.policy == 'drop_oldest':
+                buffer.popleft()
+                self.dropped()
+        buffer.append(frame)
+        if len(buffer) > counters.max_depth:
+            counters.max_depth = len(buffer)
+        if (self.policy == 'block' and not self.holding and
+                len(buffer) >= self.limit and self.upstream is not None):
+            self.holding = True
+            self.upstream.hold()
+
+    def dropped(self):
+        if not self.counters.dropped:
+            log.warning('flow control: buffer of %s frames is full, '
+                        'dropping frames (%s).' % (self.limit, self.policy))
+        self.counters.dropped += 1
+
+    def drain(self):
+        buffer = self.buffer
+        if self.send_many and self.writable and buffer:
+            frames = list(buffer)
+            buffer.clear()
+            self.send_many(frames)
+        while self.writable and buffer:
+            # sending may pause us again
+            self.send(buffer.popleft())
+        if self.holding and len(buffer) <= self.limit // 2:
+            self.holding = False
+            self.upstream.release()
+
+    def pauseProducing(self):
+        if self.writable:
+            self.writable = False
+            self.paused_at = time.monotonic()
+            self.counters.pauses += 1
+
+    def resumeProducing(self):
+        if not self.writable:
+            if self.paused_at is not None:
+                self.counters.paused_seconds += time.monotonic() - self.paused_at
+            self.paused_at = None
+            self.writable = True
+        self.drain()
+
+    def stopProducing(self):
+        self.pauseProducing()
+
+    def close(self):
+        """ the consumer is gone, waiting frames are dropped """
+        self.pauseProducing()
+        self.counters.dropped += len(self.buffer)
+        self.buffer.clear()
+        if self.holding:
+            self.holding = False
+            self.upstream.release()
@@ -1,11 +1,19 @@
 from twisted.internet import protocol, reactor
 from twisted.protocols import basic
 from high_frequency_trading.hft.outbound_message_primitives import OutboundMessage
+from protocols.flow_control import BoundedSender
+from collections import defaultdict
+import settings
 import json
 import random
+import metrics
+import tracing
 import logging
 
 log = logging.getLogger(__name__)
+trace = tracing.get_tracer(__name__)
+json_received = metrics.counter('fimsim_agent_json_messages_total',
+                                'market data messages received by agents')
 
 # well this is a quick solution to send
 # json over network, a line oriented protocol
@@ -18,16 +26,34 @@ log = logging.getLogger(__name__)
 class JSONLineServerProtocol(basic.LineReceiver):
     name = 'public JSON channel'
 
-    def __init__(self, market, users):
+    def __init__(self, market, factory):
         self.market = market
-        self.users = users
+        self.factory = factory
         self.account_id = None
+        # None means all message types
+        self.subscriptions = None
+        self.pending = []
         self.state = 'GETACCOUNTID'
+        # slow subscribers fall behind here, not in the transport
+        self.sender = BoundedSender(
+            self.write, settings.json_buffer_limit, 
+            settings.json_buffer_policy, market.flow_counters['json'],
+            upstream=market.exchange_gate, send_many=self.write_many)
+
+    def write(self, frame):
+        self.transport.write(frame)
+
+    def write_many(self, frames):
+        self.transport.writeSequence(frames)
+
+    def connectionMade(self):
+        self.sender.attach(self.transport)
 
     def connectionLost(self, reason):
-        if self.account_id in self.users:
+        self.sender.close()
+        if self.account_id in self.factory.users:
             log.info('user %s disconnected' % self.account_id)
-            del self.users[self.account_id]
+            self.factory.unregister(self)
     
     def lineReceived(self, line):
         str_line = line
@@ -41,11 +67,14 @@ class JSONLineServerProtocol(basic.LineReceiver):
             if self.state == 'GETACCOUNTID': 
                 if 'account_id' in dict_msg:
                     account_id = dict_msg['account_id']
-                    if account_id not in self.users:
+                    if account_id not in self.factory.users:
                         self.account_id = account_id
-                        self.users[account_id] = self
-                        log.info('account %s registered to %s.' % (account_id, 
-                            self.name))
+                        if dict_msg.get('subscriptions') is not None:
+                            self.subscriptions = frozenset(
+                                dict_msg['subscriptions'])
+                        self.factory.register(self)
+                        log.info('account %s registered to %s, subscriptions: %s.' % (
+                            account_id, self.name, self.subscriptions or 'all'))
                     else:
                         log.error('Account id %s is already taken..' % account_id)
                         return 
@@ -53,7 +82,12 @@ class JSONLineServerProtocol(basic.LineReceiver):
                 else:
                     log.error('account id is not set..ignoring message %s' % dict_msg)
             else:
-                self.market.handle_JSON(dict_msg, account_id)
+                self.market.handle_JSON(dict_msg, self.account_id)
+
+    def flush(self):
+        if self.pending and self.transport is not None:
+            self.sender.extend(self.pending)
+        self.pending = []
 
 
 class JSONLineServerFactory(protocol.ServerFactory):
@@ -65,30 +99,69 @@ class JSONLineServerFactory(protocol.ServerFactory):
         self.market = market
         market.json_server_factory = self
         self.users = {}
+        # message type -> {account id: connection}
+        self.subscribers = defaultdict(dict)
+        # connections that did not declare subscriptions
+        self.unfiltered = {}
+        # connections with frames waiting for the end of the reactor tick
+        self.dirty = []
+        self.flush_call = None
     
     def buildProtocol(self, addr):
-        return self.protocol(self.market, self.users)
+        return self.protocol(self.market, self)
+
+    def register(self, conn):
+        self.users[conn.account_id] = conn
+        if conn.subscriptions is None:
+            self.unfiltered[conn.account_id] = conn
+        else:
+            for msg_type in conn.subscriptions:
+                self.subscribers[msg_type][conn.account_id] = conn
+
+    def unregister(self, conn):
+        del self.users[conn.account_id]
+        self.unfiltered.pop(conn.account_id, None)
+        for subscribers in self.subscribers.values():
+            subscribers.pop(conn.account_id, None)
     
     def broadcast(self, msg: OutboundMessage, shuffle=True):
         if isinstance(msg, OutboundMessage):
+            # subscriptions filter on the type the message is built with
+            msg_type = msg.data.get('type')
             try:
                 json_msg = msg.to_json()
             except:
-                log.exception('failed to convert json: %s' % json_msg)
+                log.exception('failed to convert json: %s' % msg)
+                raise
         else:
             raise TypeError('invalid msg type %s' % msg.__class__)
         if '\n' in json_msg:
             raise ValueError('new line character is not allowed: %s' % json_msg)
-        connections = [conn for conn in self.users.values()]
-        bytes_json_msg = bytes(json_msg, 'utf-8')
-        log.info('broadcasting to: %s --> %s ' % (':'.join(c.account_id 
-                  for c in connections), msg))
-        if connections:
-            if shuffle:
-                random.shuffle(connections)
-            for c in connections:
-                c.sendLine(bytes_json_msg)
-
+        # encoded once, shared by all recipients
+        frame = bytes(json_msg, 'utf-8') + self.protocol.delimiter
+        trace.debug('broadcast', msg_type, len(self.unfiltered), 
+                    len(self.subscribers.get(msg_type, ())))
+        for recipients in (self.unfiltered, self.subscribers.get(msg_type)):
+            if recipients:
+                for conn in recipients.values():
+                    if not conn.pending:
+                        self.dirty.append(conn)
+                    conn.pending.append(frame)
+        if self.dirty and self.flush_call is None:
+            self.flush_call = reactor.callLater(0, self.flush, shuffle)
+
+    def flush(self, shuffle=True):
+        """
+        writes frames queued during a reactor tick, 
+        one write per connection, in random order 
+        so no user is consistently served first
+        """
+        self.flush_call = None
+        dirty, self.dirty = self.dirty, []
+        if shuffle:
+            random.shuffle(dirty)
+        for conn in dirty:
+            conn.flush()
 
 
 class JSONLineClientProtocol(basic.LineReceiver):
@@ -98,7 +171,13 @@ class JSONLineClientProtocol(basic.LineReceiver):
         self.trader = trader
     
     def connectionMade(self):
-        msg = json.dumps({'type': 'greet', 'account_id': self.trader.account_id})
+        greeting = {'type': 'greet', 'account_id': self.trader.account_id}
+        subscriptions_for = getattr(self.trader, 'subscriptions_for', None)
+        subscriptions = subscriptions_for(self.type_code) if (
+            subscriptions_for is not None) else None
+        if subscriptions is not None:
+            greeting['subscriptions'] = list(subscriptions)
+        msg = json.dumps(greeting)
         log.info('registering with account id %s' % self.trader.account_id)
         self.sendLine(bytes(msg, 'utf-8'))
         
@@ -111,6 +190,7 @@ class JSONLineClientProtocol(basic.LineReceiver):
         except:
             log.warning('failed to convert line to json, ignoring: %s' % line)
         else:
+            json_received.inc()
             self.trader.handle_JSON(dict_msg, self.type_code)
 
 
@@ -0,0 +1,24 @@
+from twisted.internet.address import IPv4Address
+from twisted.protocols.loopback import loopbackAsync
+import logging
+
+log = logging.getLogger(__name__)
+
+# in memory transports between a server and a client factory
+# living in the same reactor, the protocols on both ends
+# are the very same classes used over tcp
+
+loopback_address = IPv4Address('TCP', '127.0.0.1', 0)
+
+
+def connect_loopback(server_factory, client_factory):
+    """
+    builds a protocol pair from given factories and
+    connects them over an in memory transport
+    returns a deferred that fires when the connection is lost
+    """
+    server = server_factory.buildProtocol(loopback_address)
+    client = client_factory.buildProtocol(loopback_address)
+    log.debug('loopback connection %s <--> %s' % (
+        server.__class__.__name__, client.__class__.__name__))
+    return loopbackAsync(server, client)
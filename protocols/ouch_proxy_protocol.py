@@ -4,13 +4,83 @@ from utility import incoming_message_defaults
 from exchange_server.OuchServer import ouch_messages
 from high_frequency_trading.hft.exchange import OUCH
 from high_frequency_trading.hft.exchange_message import ResetMessage
+from protocols.flow_control import BoundedSender, UpstreamGate
+import settings
 import random
 import logging
 
 log = logging.getLogger(__name__)
 
 
-class ProxyOuchServerProtocol(OUCH):
+# where the firm sits in exchange responses, responses
+# without a firm field carry it as the order token prefix
+RESPONSE_FIRM_SLICES = {
+    'A': slice(44, 48),
+    'U': slice(44, 48),
+    'C': slice(9, 13),
+    'E': slice(9, 13),
+}
+
+
+class FrameRouter:
+    """
+    splits the byte stream into ouch frames without decoding them,
+    frames are memoryview slices of the received bytes, read for
+    their type and firm only. frames split across reads are joined,
+    and every frame is copied to bytes once, when the proxy forwards it
+    """
+    bytes_needed = {}
+    # where the firm sits in frames of each type
+    firm_slices = {}
+    message_cls = None
+
+    partial = None
+
+    def dataReceived(self, data):
+        view = memoryview(data)
+        offset = 0
+        if self.partial:
+            partial = self.partial
+            size = self.bytes_needed[chr(partial[0])]
+            offset = min(size - len(partial), len(view))
+            partial += view[:offset]
+            if len(partial) < size:
+                return
+            self.partial = None
+            self.frame_received(memoryview(bytes(partial)))
+        end = len(view)
+        while offset < end:
+            header = chr(view[offset])
+            try:
+                size = self.bytes_needed[header]
+            except KeyError:
+                log.error('unknown message type %s, dropping connection.' % 
+                          header)
+                self.transport.loseConnection()
+                return
+            if offset + size > end:
+                self.partial = bytearray(view[offset:])
+                return
+            self.frame_received(view[offset:offset + size])
+            offset += size
+
+    def frame_received(self, frame):
+        raise NotImplementedError()
+
+    def firm_of(self, frame):
+        try:
+            firm_slice = self.firm_slices[chr(frame[0])]
+        except KeyError:
+            return None
+        return bytes(frame[firm_slice]).decode('ascii')
+
+    def decode(self, frame):
+        return IncomingOuchMessage(
+            bytes(frame), message_cls=self.message_cls, 
+            **incoming_message_defaults)
+
+
+class ProxyOuchServerProtocol(FrameRouter, OUCH):
     name = 'private OUCH channel'
     bytes_needed = {
         'S': 10,
@@ -18,34 +88,59 @@ class ProxyOuchServerProtocol(OUCH):
         'O': 49,
         'U': 47,
     }
+    firm_slices = {'O': slice(36, 40)}
     message_cls = ouch_messages.OuchClientMessages
 
     def __init__(self, market, users):
         super().__init__()
         self.market = market 
         self.users = users
-        self.account_id = None
+        # a connection may carry orders of many firms,
+        # agent hosts multiplex their agents over one
+        self.account_ids = set()
         self.state = 'GETACCOUNTID'
+        # responses routed to this account. a connection that falls
+        # behind stops being read from, it holds up no one else
+        self.sender = BoundedSender(
+            lambda frame: self.sendMessage(frame, 0),
+            settings.agent_buffer_limit, settings.agent_buffer_policy,
+            market.flow_counters['agents'], 
+            upstream=UpstreamGate(lambda: [self.transport]))
 
-    def handle_incoming_data(self, header):
-        original_msg = bytes(self.buffer)
-        msg = IncomingOuchMessage(
-            original_msg, message_cls=self.message_cls, 
-            **incoming_message_defaults)
-        if self.state == 'GETACCOUNTID':
-            try:
-                account_id = msg.firm
-            except AttributeError:
-                log.error('account id is not set..ignoring message %s' % msg)
-            else:
-                if account_id not in self.users:
-                    self.users[account_id] = self
-                    self.state = 'TRADE'
-                    log.info('registered account id %s to %s.' % (account_id, 
-                        self.name))
-                else:
-                    log.error('account id is already taken..ignoring message %s' % msg)
-        self.market.handle_OUCH(msg, original_msg, 2)
+    def connectionMade(self):
+        super().connectionMade()
+        self.factory.connections.append(self)
+        self.market.agents_gate.admit(self.transport)
+        self.sender.attach(self.transport)
+
+    def connectionLost(self, reason):
+        self.sender.close()
+        self.factory.connections.remove(self)
+        for account_id in self.account_ids:
+            if self.users.get(account_id) is self:
+                del self.users[account_id]
+
+    def register(self, frame):
+        account_id = self.firm_of(frame)
+        if account_id is None or account_id in self.account_ids:
+            return
+        if account_id not in self.users:
+            self.users[account_id] = self
+            self.account_ids.add(account_id)
+            self.state = 'TRADE'
+            log.info('registered account id %s to %s.' % (account_id, 
+                self.name))
+        else:
+            log.error('account id is already taken..ignoring message %s' % 
+                      bytes(frame))
+
+    def frame_received(self, frame):
+        if frame[0] == 79:    # O, orders register their firm
+            self.register(frame)
+        elif self.state == 'GETACCOUNTID':
+            log.error('account id is not set..ignoring message %s' % 
+                      bytes(frame))
+        self.market.route_OUCH(frame, 2, self)
 
 
 class ProxyOuchServerFactory(protocol.ServerFactory): 
@@ -56,21 +151,25 @@ class ProxyOuchServerFactory(protocol.ServerFactory):
         self.market = market
         market.ouch_server_factory = self
         self.users = {}
+        # registered or not
+        self.connections = []
 
     def buildProtocol(self, addr):
         conn = self.protocol(self.market, self.users)
+        conn.factory = self
         self.market.ouch_server_factory = self
         return conn
 
     def broadcast(self, msg, shuffle=True):
-        connections = [conn for conn in self.users.values()]
+        # once per connection, however many firms it carries
+        connections = list(set(self.users.values()))
         if connections:
             if shuffle:
                 random.shuffle(connections)
             for c in connections:
-                c.sendMessage(msg, 0)
+                c.sender.write(msg)
 
-class ProxyOuchClient(OUCH):
+class ProxyOuchClient(FrameRouter, OUCH):
     bytes_needed = {
         'S': 10,
         'E': 40,
@@ -80,6 +179,7 @@ class ProxyOuchClient(OUCH):
         'Q': 41,
         'Z': 49,
     }
+    firm_slices = RESPONSE_FIRM_SLICES
     message_cls = ouch_messages.OuchServerMessages
 
     def __init__(self, factory, market):
@@ -87,11 +187,8 @@ class ProxyOuchClient(OUCH):
         self.factory = factory
         self.market = market 
 
-    def handle_incoming_data(self, header):
-        original_msg = bytes(self.buffer)
-        msg = IncomingOuchMessage(
-            original_msg, message_cls=self.message_cls, **incoming_message_defaults)
-        self.market.handle_OUCH(msg, original_msg, 1)     
+    def frame_received(self, frame):
+        self.market.route_OUCH(frame, 1, self)
 
     def connectionMade(self):
         log.info('connected to exchange')
@@ -102,6 +199,10 @@ class ProxyOuchClient(OUCH):
                 event_code='S', timestamp=0, subsession_id=0)
             self.sendMessage(msg.translate(), 0)
             self.factory.reset_message_sent = True
+        self.market.exchange_connected(self)
+
+    def connectionLost(self, reason):
+        self.market.exchange_disconnected(self)
 
 
 
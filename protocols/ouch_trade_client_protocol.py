@@ -1,10 +1,21 @@
 from high_frequency_trading.hft.exchange import OUCH
 from twisted.internet.protocol import ClientFactory
 from high_frequency_trading.hft.incoming_message import IncomingOuchMessage
+from twisted.internet import reactor
 from utility import incoming_message_defaults
+from protocols.ouch_proxy_protocol import RESPONSE_FIRM_SLICES
+import latency
+import metrics
+import tracing
+import time
 import logging
 
 log = logging.getLogger(__name__)
+trace = tracing.get_tracer(__name__)
+ouch_sent = metrics.counter('fimsim_agent_ouch_messages_total', 
+                            'ouch messages of agents', direction='sent')
+ouch_received = metrics.counter('fimsim_agent_ouch_messages_total', 
+                                'ouch messages of agents', direction='received')
 
 class OUCHClientProtocol(OUCH):
 
@@ -16,13 +27,82 @@ class OUCHClientProtocol(OUCH):
         super()
         self.trader.exchange_connection = self
 
+    def sendMessage(self, msg, delay):
+        ouch_sent.inc()
+        if not latency.recorder.enabled:
+            return super().sendMessage(msg, delay)
+        # delay here so the overshoot of the deliberate delay is measured
+        if delay:
+            reactor.callLater(delay, self.send_stamped, msg, delay, 
+                              reactor.seconds())
+        else:
+            self.send_stamped(msg, 0, reactor.seconds())
+
+    def send_stamped(self, msg, delay, scheduled_at):
+        recorder = latency.recorder
+        recorder.observe('agent_delay_overshoot', 
+                         reactor.seconds() - scheduled_at - delay)
+        super().sendMessage(msg, 0)
+        token = latency.request_token(msg)
+        if token is not None:
+            recorder.stamp('agent_sent', token)
+            trace.debug('agent_sent', token)
+
     def handle_incoming_data(self, header):
         original_msg = bytes(self.buffer)
+        ouch_received.inc()
+        recorder = latency.recorder
+        if recorder.enabled:
+            token = latency.response_token(original_msg)
+            received_at = recorder.match('agent_sent', token, 
+                                         'agent_round_trip')
+            trace.debug('agent_received', token)
+        self.dispatch(original_msg)
+        if recorder.enabled:
+            recorder.observe('agent_handling', time.monotonic() - received_at)
+
+
+    def dispatch(self, original_msg):
         msg = IncomingOuchMessage(
             original_msg, **incoming_message_defaults)
         self.trader.handle_OUCH(msg)
 
 
+class MultiplexOUCHClientProtocol(OUCHClientProtocol):
+    """
+    one connection carries orders of many agents,
+    responses go to the agent whose firm they carry,
+    everything else goes to all of them
+    """
+
+    def __init__(self, traders):
+        super().__init__(None)
+        self.traders = {trader.account_id: trader for trader in traders}
+
+    def connectionMade(self):
+        for trader in self.traders.values():
+            trader.exchange_connection = self
+
+    def dispatch(self, original_msg):
+        firm_slice = RESPONSE_FIRM_SLICES.get(chr(original_msg[0]))
+        if firm_slice is None:
+            # agents may change the message they handle,
+            # each gets a message of its own
+            for trader in self.traders.values():
+                trader.handle_OUCH(IncomingOuchMessage(
+                    original_msg, **incoming_message_defaults))
+            return
+        firm = original_msg[firm_slice].decode('ascii')
+        try:
+            trader = self.traders[firm]
+        except KeyError:
+            log.error('no agent for firm %s, dropping %s' % (
+                firm, original_msg))
+        else:
+            trader.handle_OUCH(IncomingOuchMessage(
+                original_msg, **incoming_message_defaults))
+
+
 class OUCHClientFactory(ClientFactory):
 
     protocol = OUCHClientProtocol
@@ -35,3 +115,17 @@ class OUCHClientFactory(ClientFactory):
         log.info('connecting to the exchange at %s' % addr)
         conn = self.protocol(self.trader)
         return conn
+
+
+class MultiplexOUCHClientFactory(ClientFactory):
+
+    protocol = MultiplexOUCHClientProtocol
+
+    def __init__(self, traders):
+        super()
+        self.traders = traders
+
+    def buildProtocol(self, addr):
+        log.info('connecting %s agents to the exchange at %s' % (
+            len(self.traders), addr))
+        return self.protocol(self.traders)
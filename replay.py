@@ -0,0 +1,283 @@
+import virtual_clock
+# replays always run on the virtual clock,
+# before anything imports the twisted reactor
+virtual_clock.install()
+import configargparse
+from twisted.internet import reactor, protocol, defer
+import settings
+from builders import build_market_proxy
+from launchers import LocalLauncher, start_exchanges
+from manifest import open_manifest
+from protocols.ouch_proxy_protocol import (
+    ProxyOuchServerFactory, ProxyOuchClientFactory, ProxyOuchServerProtocol,
+    RESPONSE_FIRM_SLICES)
+from protocols.json_line_protocol import JSONLineServerFactory
+from protocols.loopback import connect_loopback
+import journal
+import latency
+import shutil
+import json
+import sys
+import os
+import logging
+
+log = logging.getLogger(__name__)
+
+# replays a recorded session as fast as the virtual clock goes.
+#
+#   open    frames journaled from agents of the session (simulate.py
+#           --journal) are played into fresh proxies and exchanges
+#           at their recorded offsets, agents are not run
+#   closed  proxies and agents are rebuilt from the session manifest,
+#           rabbit order tapes and speed and slider events included,
+#           and run in one reactor as simulate.py --inprocess does
+#
+# either way the proxies journal what they route, the journal is
+# exported as json lines, one frame a line, ordered by market and
+# sequence in the market. times and exchange timestamps differ
+# between runs, leave them out to diff
+#
+#   python replay.py --session_code abc --export_only --no_times
+#   python replay.py --session_code abc --mode open --no_times
+#   diff app/data/abc_events.jsonl app/data/abc_replay_events.jsonl
+#
+# exchanges run on the wall clock, the virtual clock holds still
+# while proxies wait for their responses (see virtual_clock.py)
+
+p = configargparse.getArgParser()
+p.add('--session_code', required=True, help='session to replay')
+p.add('--mode', choices=('open', 'closed'), default='open',
+      help='open replays journaled agent frames, '
+           'closed reruns agents from the session manifest')
+p.add('--manifest', help='session manifest, defaults to the one '
+      'simulate.py compiled in settings.manifest_dir')
+p.add('--exchange', action='append', default=[],
+      help='tag:host:port of a running exchange to replay against, '
+           'repeatable, by default an exchange is started per market')
+p.add('--drain', type=float, default=settings.replay_drain,
+      help='virtual seconds to wait for responses after the last frame')
+p.add('--export_only', action='store_true',
+      help='export the journal of the session as json lines, no replay')
+p.add('--no_times', action='store_true',
+      help='leave frame times out of the export, so replays diff clean')
+p.add('--debug', action='store_true')
+options, args = p.parse_known_args()
+
+
+# exchange responses carry the exchange time after the type
+EXCHANGE_TIME_MASK = bytes(8)
+
+
+def frame_event(seq, timestamp, tag, direction, frame):
+    """
+    a journaled frame as a json lines event,
+    without a time if `timestamp` is None
+    """
+    header = chr(frame[0])
+    if direction == journal.FROM_AGENTS:
+        token = latency.request_token(frame)
+        firm_slice = ProxyOuchServerProtocol.firm_slices.get(header)
+    else:
+        token = latency.response_token(frame)
+        firm_slice = RESPONSE_FIRM_SLICES.get(header)
+    event = {
+        'seq': seq,
+        'market': tag,
+        'from': 'agents' if direction == journal.FROM_AGENTS else 'exchange',
+        'type': header,
+        'firm': frame[firm_slice].decode('ascii') if firm_slice else None,
+        'token': token.decode('ascii', 'replace') if token else None,
+        'frame': frame.hex(),
+    }
+    if timestamp is not None:
+        event['t'] = round(timestamp, 6)
+    elif direction != journal.FROM_AGENTS:
+        event['frame'] = (frame[:1] + EXCHANGE_TIME_MASK + 
+                          frame[9:]).hex()
+    return event
+
+
+def export_events(directory, dest, times=True):
+    """
+    writes the journals of all markets in `directory` as json lines,
+    ordered by market and the sequence number of the frame in its
+    market, times relative to the first frame of the session.
+    without `times` two runs of a session export the same
+    lines if their proxies routed the same frames in the same order.
+    returns the number of events
+    """
+    tags = journal.journal_tags(directory)
+    origin = None
+    if times:
+        firsts = [next(journal.read_journal(directory, tag), None) 
+                  for tag in tags]
+        origin = min((record.timestamp for record in firsts if record), 
+                     default=None)
+    count = 0
+    with open(dest, 'w') as f:
+        for tag in tags:
+            for seq, record in enumerate(journal.read_journal(directory, tag)):
+                timestamp = record.timestamp - origin if times else None
+                f.write(json.dumps(frame_event(
+                    seq, timestamp, tag, record.direction, record.frame),
+                    sort_keys=True) + '\n')
+                count += 1
+    log.info('exported %s events of %s to %s.' % (count, directory, dest))
+    return count
+
+
+class JournalFeed(protocol.Protocol):
+    """
+    plays frames journaled from agents of a market into the proxy
+    at their recorded offsets from `origin`, responses are dropped
+    """
+
+    def __init__(self, records, origin, start_at):
+        self.records = records
+        self.origin = origin
+        self.start_at = start_at
+        self.done = defer.Deferred()
+
+    def connectionMade(self):
+        self.schedule()
+
+    def dataReceived(self, data):
+        pass
+
+    def schedule(self):
+        record = next(self.records, None)
+        if record is None:
+            self.done.callback(None)
+            return
+        delay = self.start_at + record.timestamp - self.origin - (
+            reactor.seconds())
+        reactor.callLater(max(0., delay), self.send, record.frame)
+
+    def send(self, frame):
+        self.transport.write(frame)
+        self.schedule()
+
+
+class JournalFeedFactory(protocol.ClientFactory):
+
+    def __init__(self, feed):
+        self.feed = feed
+
+    def buildProtocol(self, addr):
+        return self.feed
+
+
+def agent_records(directory, tag):
+    return (record for record in journal.read_journal(directory, tag)
+            if record.direction == journal.FROM_AGENTS)
+
+
+def replay_open(replay_code, manifest, exchanges, source_dir):
+    tags = journal.journal_tags(source_dir)
+    if not tags:
+        raise RuntimeError('no journal in %s, record the session with '
+                           'simulate.py --journal' % source_dir)
+    # earliest frame of the session, offsets are kept relative to it
+    firsts = [next(agent_records(source_dir, tag), None) for tag in tags]
+    if not any(firsts):
+        raise RuntimeError('no frames from agents in %s' % source_dir)
+    origin = min(record.timestamp for record in firsts if record)
+    proxies = {}
+    for market in manifest.markets:
+        tag = market['tag']
+        exchange_host, exchange_port = exchanges[tag]
+        proxy = proxies[tag] = build_market_proxy(
+            tag, replay_code, exchange_host, exchange_port, manifest.params,
+            market_id=market['market_id'])
+        reactor.connectTCP(exchange_host, exchange_port,
+                           ProxyOuchClientFactory(proxy))
+        JSONLineServerFactory(proxy)
+
+    def close_session():
+        try:
+            for proxy in proxies.values():
+                proxy.close_session()
+        finally:
+            reactor.stop()
+
+    def start():
+        if not all(proxy.exchange_transports() for proxy in proxies.values()):
+            reactor.callLater(0.001, start)
+            return
+        start_at = reactor.seconds()
+        feeds = []
+        for tag in tags:
+            if tag not in proxies:
+                log.warning('market %s of the journal is not in the '
+                            'manifest, skipping it.' % tag)
+                continue
+            feed = JournalFeed(agent_records(source_dir, tag), origin,
+                               start_at)
+            connect_loopback(ProxyOuchServerFactory(proxies[tag]),
+                             JournalFeedFactory(feed))
+            feeds.append(feed.done)
+        log.info('replaying %s markets from %s.' % (len(feeds), source_dir))
+        d = defer.DeferredList(feeds)
+        d.addCallback(lambda _: reactor.callLater(options.drain, close_session))
+
+    reactor.callWhenRunning(start)
+    reactor.run()
+
+
+def replay_closed(replay_code, manifest, exchanges):
+    # imported here, builds agents as the session did
+    from all_in_one import run_session
+    run_session(replay_code, manifest.params, exchanges,
+                manifest.data['random_seed'], manifest=manifest)
+
+
+def main():
+    session_code = options.session_code
+    source_dir = journal.session_journal_dir(session_code)
+    if options.export_only:
+        export_events(source_dir, settings.events_export_path.format(
+            session_id=session_code), times=not options.no_times)
+        return 0
+
+    replay_code = '%s_replay' % session_code
+    replay_dir = journal.session_journal_dir(replay_code)
+    shutil.rmtree(replay_dir, ignore_errors=True)
+    # proxies journal what they route, on virtual time
+    settings.record_journal = True
+    journal.timestamp_source = reactor.seconds
+    # replays leave the session results alone
+    settings.db_dry_run = True
+    settings.record_latency = False
+
+    manifest = open_manifest(options.manifest or os.path.join(
+        settings.manifest_dir, session_code))
+    exchange_procs = {}
+    if options.exchange:
+        exchanges = {}
+        for exchange in options.exchange:
+            tag, host, port = exchange.split(':')
+            exchanges[tag] = (host, int(port))
+    else:
+        exchange_procs, exchanges = start_exchanges(
+            manifest.markets, LocalLauncher(), debug=options.debug)
+    try:
+        if options.mode == 'open':
+            replay_open(replay_code, manifest, exchanges, source_dir)
+        else:
+            replay_closed(replay_code, manifest, exchanges)
+    finally:
+        for proc in exchange_procs.values():
+            proc.terminate()
+    export_events(replay_dir, settings.events_export_path.format(
+        session_id=replay_code), times=not options.no_times)
+    return 0
+
+
+if __name__ == '__main__':
+    logging.basicConfig(
+        level=logging.DEBUG if options.debug else logging.INFO,
+        filename=settings.logs_dir + 'replay_%s.log' % options.session_code,
+        format="[%(asctime)s.%(msecs)03d] %(levelname)s \
+        [%(name)s.%(funcName)s:%(lineno)d] %(message)s",
+        datefmt='%H:%M:%S')
+    sys.exit(main())
@@ -1,14 +1,18 @@
 import configargparse
 from twisted.internet import reactor, task
-import draw
 import settings
-from discrete_event_emitter import *
-from agents.pacemaker_agent import PaceMakerAgent
-from agents.dynamic_agent import DynamicAgent 
+from builders import build_agent, build_agent_from_manifest
+from manifest import open_manifest
 from protocols.ouch_trade_client_protocol import OUCHClientFactory
 from protocols.json_line_protocol import JSONLineClientFactory
 from utility import (
     random_chars, generate_account_id, get_simulation_parameters)
+from primitives.base_market_agent import watch_agents
+from db.db import flush_snapshots
+import latency
+import metrics
+import tracing
+import sys
 import logging as log
 
 
@@ -20,58 +24,72 @@ p.add('--session_code', default=random_chars(8))
 p.add('--exchange_host', default='127.0.0.1', help='Address of matching engine')
 p.add('--exchange_ouch_port', required=True, type=int)
 p.add('--exchange_json_port', type=int)
+p.add('--market_tag', default='focal', 
+      help='tag of the market the agent trades on')
 p.add('--external_exchange_host')
 p.add('--external_exchange_json_port', type=int)
+p.add('--external_feed', action='append', default=[], 
+      help='tag:host:json_port of an external market, repeatable')
 p.add('--agent_type', choices=['rabbit', 'elo'], required=True)
 p.add('--config_num', default=0, type=int, help='The configuration number, \
        index in the list of discrete event configurations')
 p.add('--random_seed', type=int)
+p.add('--manifest', help='compiled session manifest to build the agent from')
+p.add('--agent_index', type=int, 
+      help='index of the agent of its type in the manifest')
 options, args = p.parse_known_args()
         
         
-def main(account_id):
-    agent_type = options.agent_type
-    session_duration = options.session_duration
-    agent_parameters = {}
-    conf = get_simulation_parameters()
-    if agent_type == 'rabbit':
-        random_orders = draw.elo_draw(
-            session_duration, conf,
-            seed=options.random_seed, config_num=options.config_num)
-        event_emitters = [RandomOrderEmitter(source_data=random_orders), ]
-        agent_cls = PaceMakerAgent
+def external_feeds():
+    feeds = [feed.split(':') for feed in options.external_feed]
+    if options.external_exchange_host:
+        feeds.append(('external', options.external_exchange_host, 
+                      options.external_exchange_json_port))
+    return [(tag, host, int(port)) for tag, host, port in feeds]
 
-    elif agent_type == 'elo':
-        events = utility.transform_agent_events_array(conf['agent_state_configs'], options.config_num)
-        event_emitters = [ELOSliderChangeEmitter(source_data=events['slider']), 
-            ELOSpeedChangeEmitter(source_data=events['speed'])]
-        agent_cls = DynamicAgent
-        agent_parameters.update(utility.get_elo_agent_parameters())
- 
-    agent = agent_cls(options.session_code, options.exchange_host, 
-        options.exchange_ouch_port, event_emitters=event_emitters, 
-        account_id=account_id, **agent_parameters)
+
+def main(account_id, manifest=None):
+    session_duration = options.session_duration
+    feeds = external_feeds()
+    if manifest is not None:
+        agent = build_agent_from_manifest(
+            manifest, options.agent_type, options.agent_index,
+            exchange_host=options.exchange_host,
+            exchange_ouch_port=options.exchange_ouch_port)
+    else:
+        agent = build_agent(
+            options.agent_type, options.session_code, session_duration,
+            get_simulation_parameters(), config_num=options.config_num,
+            random_seed=options.random_seed, account_id=account_id,
+            exchange_host=options.exchange_host, 
+            exchange_ouch_port=options.exchange_ouch_port,
+            focal_market=options.market_tag,
+            external_markets=[tag for tag, _, _ in feeds])
 
     reactor.connectTCP(options.exchange_host, options.exchange_ouch_port,
         OUCHClientFactory(agent))
    
     if options.exchange_json_port:
         reactor.connectTCP(options.exchange_host, options.exchange_json_port,
-            JSONLineClientFactory('focal', agent))
+            JSONLineClientFactory(options.market_tag, agent))
     
-    if options.external_exchange_host:
-        reactor.connectTCP(options.external_exchange_host, 
-            options.external_exchange_json_port,  
-            JSONLineClientFactory('external', agent))
+    for tag, host, port in feeds:
+        reactor.connectTCP(host, port, JSONLineClientFactory(tag, agent))
 
     agent.ready()
+    watch_agents([agent])
+    metrics.watch_reactor(reactor)
 
     d = task.deferLater(reactor, session_duration, agent.close_session)
     d.addCallback(lambda _ : reactor.stop())
     reactor.run()
 
 if __name__ == '__main__':
-    account_id = generate_account_id()
+    manifest, account_id = None, generate_account_id()
+    if options.manifest:
+        manifest = open_manifest(options.manifest)
+        account_id = manifest.agent(
+            options.agent_type, options.agent_index)['account_id']
     log.basicConfig(
         level=log.DEBUG if options.debug else log.INFO, 
         filename=settings.logs_dir + 'session_%s_trader_%s.log' % (
@@ -79,7 +97,21 @@ if __name__ == '__main__':
         format = "[%(asctime)s.%(msecs)03d] %(levelname)s \
             [%(name)s.%(funcName)s:%(lineno)d] %(message)s",
         datefmt = '%H:%M:%S')
+    tracing.configure_from_settings(
+        settings.logs_dir + 'session_%s_trader_%s.trace' % (
+            options.session_code, account_id), 
+        process_tag='trader_%s' % account_id)
+    metrics.configure_from_settings(
+        settings.logs_dir + 'session_%s_trader_%s.metrics.json' % (
+            options.session_code, account_id), 
+        process_tag='trader_%s' % account_id)
+    if settings.record_latency:
+        latency.recorder.configure(
+            settings.logs_dir + 'session_%s_trader_%s.latency.json' % (
+                options.session_code, account_id))
     if options.random_seed:
         log.debug('%s agent started using random seed %d', options.agent_type, options.random_seed)
-    main(account_id)
+    main(account_id, manifest)
+    # a session missing snapshot rows must not look complete
+    sys.exit(1 if flush_snapshots() else 0)
     
\ No newline at end of file
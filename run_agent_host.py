@@ -0,0 +1,181 @@
+import configargparse
+from twisted.internet import reactor, task
+import settings
+from builders import build_agent, build_agent_from_manifest
+from manifest import open_manifest
+from agents.agent_group import AgentGroup
+from primitives.base_market_agent import watch_agents
+from db.db import flush_snapshots
+from protocols.ouch_trade_client_protocol import MultiplexOUCHClientFactory
+from protocols.json_line_protocol import JSONLineClientFactory
+from utility import (
+    random_chars, generate_account_id, get_simulation_parameters)
+from collections import defaultdict
+import subprocess
+import topology
+import latency
+import metrics
+import tracing
+import atexit
+import signal
+import sys
+import os
+import logging as log
+
+# runs many agents in one process instead of a run_agent.py each.
+# agents are sharded over `--shards` processes, agents of a shard
+# share a reactor, one OUCH connection per market they trade on
+# and one json subscription per market they watch.
+
+p = configargparse.getArgParser()
+p.add('--session_duration', required=True, type=int,
+    help='required: session duration in seconds')
+p.add('--debug', action='store_true')
+p.add('--session_code', default=random_chars(8))
+p.add('--market', action='append', default=[],
+      help='tag:host:ouch_port:json_port of a market proxy, repeatable')
+p.add('--rabbit', action='append', default=[],
+      help='market_tag:config_num:random_seed of a rabbit, repeatable')
+p.add('--elo', action='append', default=[], type=int,
+      help='config number of an interactive agent, repeatable')
+p.add('--manifest', help='compiled session manifest, '
+      'runs all of its agents, --rabbit and --elo are ignored')
+p.add('--shards', default=os.cpu_count(), type=int,
+      help='number of processes to run agents in')
+p.add('--shard', type=int, help='run only this shard of the agents')
+options, args = p.parse_known_args()
+
+
+def agent_specs(manifest=None):
+    """ (agent type, market tag or None, config num, random seed) """
+    if manifest is not None:
+        # indexes into the manifest stand in for config numbers
+        return [('rabbit', rabbit['market'], i, None) for i, rabbit in 
+                enumerate(manifest.rabbits)] + [
+                ('elo', None, i, None) for i in range(len(manifest.agents))]
+    specs = []
+    for rabbit in options.rabbit:
+        tag, config_num, seed = rabbit.split(':')
+        specs.append(('rabbit', tag, int(config_num),
+                      int(seed) if seed else None))
+    for config_num in options.elo:
+        specs.append(('elo', None, config_num, None))
+    return specs
+
+
+def shard_account_id(taken, shard, num_shards):
+    """ shards draw from disjoint account ids """
+    while True:
+        account_id = generate_account_id()
+        if sum(map(ord, account_id)) % num_shards == shard and (
+                account_id not in taken):
+            taken.add(account_id)
+            return account_id
+
+
+def run_shards(num_shards):
+    """ a process per shard, returns the worst exit code """
+    procs = []
+    for shard in range(num_shards):
+        proc = subprocess.Popen([sys.executable] + sys.argv + [
+            '--shard', str(shard), '--shards', str(num_shards)])
+        # make sure this process is eventually killed
+        atexit.register(proc.terminate)
+        procs.append(proc)
+    return max(abs(proc.wait()) for proc in procs)
+
+
+def main(shard, num_shards, manifest=None):
+    session_duration = options.session_duration
+    params = get_simulation_parameters()
+    markets = topology.get_markets(params)
+    proxies = {}
+    for market in options.market:
+        tag, host, ouch_port, json_port = market.split(':')
+        proxies[tag] = (host, int(ouch_port), int(json_port))
+
+    agents, taken = [], set()
+    # market tag -> agents trading there
+    traders = defaultdict(list)
+    specs = agent_specs(manifest)[shard::num_shards]
+    for agent_type, tag, config_num, seed in specs:
+        if manifest is not None:
+            if agent_type == 'elo':
+                tag = manifest.agents[config_num]['focal_market']
+            host, ouch_port, _ = proxies[tag]
+            agent = build_agent_from_manifest(
+                manifest, agent_type, config_num, exchange_host=host,
+                exchange_ouch_port=ouch_port)
+        else:
+            kwargs = {}
+            if agent_type == 'elo':
+                tag, external = topology.get_agent_markets(
+                    params, config_num, markets)
+                kwargs.update(focal_market=tag, external_markets=external)
+            host, ouch_port, _ = proxies[tag]
+            agent = build_agent(
+                agent_type, options.session_code, session_duration, params,
+                config_num=config_num, random_seed=seed,
+                account_id=shard_account_id(taken, shard, num_shards),
+                exchange_host=host, exchange_ouch_port=ouch_port, **kwargs)
+        agents.append(agent)
+        traders[tag].append(agent)
+
+    for tag, market_traders in traders.items():
+        host, ouch_port, _ = proxies[tag]
+        reactor.connectTCP(host, ouch_port,
+                           MultiplexOUCHClientFactory(market_traders))
+
+    # json account ids of groups must not collide across shards either
+    group = AgentGroup(agents, account_id=shard_account_id(
+        taken, shard, num_shards))
+    for tag in group.venues:
+        host, _, json_port = proxies[tag]
+        reactor.connectTCP(host, json_port, JSONLineClientFactory(tag, group))
+
+    for agent in agents:
+        agent.ready()
+    watch_agents(agents)
+    metrics.watch_reactor(reactor)
+    log.info('shard %s of %s: %s agents on %s markets.' % (
+        shard, num_shards, len(agents), len(proxies)))
+
+    def close_session():
+        for agent in agents:
+            agent.close_session()
+
+    d = task.deferLater(reactor, session_duration, close_session)
+    d.addCallback(lambda _ : reactor.stop())
+    reactor.run()
+
+
+if __name__ == '__main__':
+    manifest = open_manifest(options.manifest) if options.manifest else None
+    num_shards = max(1, min(options.shards, len(agent_specs(manifest))))
+    if options.shard is None and num_shards > 1:
+        # so atexit handlers run on sigterm too
+        signal.signal(signal.SIGTERM, lambda *_: sys.exit(1))
+        sys.exit(run_shards(num_shards))
+    shard = options.shard or 0
+    log.basicConfig(
+        level=log.DEBUG if options.debug else log.INFO,
+        filename=settings.logs_dir + 'session_%s_agent_host_%s.log' % (
+        options.session_code, shard),
+        format = "[%(asctime)s.%(msecs)03d] %(levelname)s \
+            [%(name)s.%(funcName)s:%(lineno)d] %(message)s",
+        datefmt = '%H:%M:%S')
+    tracing.configure_from_settings(
+        settings.logs_dir + 'session_%s_agent_host_%s.trace' % (
+            options.session_code, shard),
+        process_tag='agent_host_%s' % shard)
+    metrics.configure_from_settings(
+        settings.logs_dir + 'session_%s_agent_host_%s.metrics.json' % (
+            options.session_code, shard),
+        process_tag='agent_host_%s' % shard)
+    if settings.record_latency:
+        latency.recorder.configure(
+            settings.logs_dir + 'session_%s_agent_host_%s.latency.json' % (
+                options.session_code, shard))
+    main(shard, num_shards, manifest)
+    # a session missing snapshot rows must not look complete
+    sys.exit(1 if flush_snapshots() else 0)
@@ -0,0 +1,120 @@
+import configargparse
+import settings
+from utility import random_chars, get_simulation_parameters
+from zygote import zygote_available
+from concurrent.futures import ThreadPoolExecutor
+import subprocess
+import signal
+import sys
+import os
+import time
+import logging
+
+log = logging.getLogger(__name__)
+
+# runs many simulation sessions side by side.
+# every session is a simulate.py process in its own process group
+# with its own exchanges, os assigned ports and session code,
+# so sessions share nothing but the database.
+
+p = configargparse.getArgParser()
+p.add('--sessions', default=1, type=int, help='number of sessions to run')
+p.add('--concurrency', default=os.cpu_count(), type=int,
+      help='maximum number of sessions running at a time')
+p.add('--timeout', type=float,
+      help='seconds a session may run before it is killed, defaults to '
+           'session duration plus settings.session_timeout_grace')
+p.add('--debug', action='store_true')
+p.add('--inprocess', action='store_true')
+p.add('--virtual_clock', action='store_true', help='needs --inprocess')
+p.add('--agent_host', action='store_true')
+p.add('--zygote', action='store_true',
+      help='fork session processes from a zygote (zygote.py), '
+           'started for the batch unless one is running')
+p.add('--journal', action='store_true',
+      help='journal the ouch frames of every session')
+p.add('--note', type=str, default='')
+p.add('--workers', help='comma separated host:port of worker daemons, '
+      'sessions place their processes on them')
+options, args = p.parse_known_args()
+if options.virtual_clock and not options.inprocess:
+    p.error('--virtual_clock needs --inprocess')
+
+
+def run_session(session_code, timeout):
+    """
+    runs a session to completion or until its deadline,
+    returns the session code and exit code
+    """
+    cmd = [sys.executable, 'simulate.py', '--session_code', session_code,
+           '--note', options.note, '--timeout', str(timeout)]
+    for flag in ('debug', 'inprocess', 'virtual_clock', 'agent_host', 
+                 'zygote', 'journal'):
+        if getattr(options, flag):
+            cmd.append('--' + flag)
+    if options.workers:
+        cmd.extend(['--workers', options.workers])
+    proc = subprocess.Popen(cmd, start_new_session=True)
+    # simulate.py has its own watchdog for session processes,
+    # this one covers setup, export and the manager itself
+    deadline = timeout + settings.session_timeout_grace
+    try:
+        exit_code = proc.wait(timeout=deadline)
+    except subprocess.TimeoutExpired:
+        log.error('session %s passed its deadline, killing it.' % session_code)
+        kill_process_group(proc)
+        exit_code = proc.wait()
+    log.info('session %s finished with exit code %s.' % (session_code, exit_code))
+    return session_code, exit_code
+
+
+def kill_process_group(proc, grace=5):
+    os.killpg(proc.pid, signal.SIGTERM)
+    try:
+        proc.wait(timeout=grace)
+    except subprocess.TimeoutExpired:
+        os.killpg(proc.pid, signal.SIGKILL)
+
+
+def start_zygote(timeout=30):
+    """ returns the zygote process, None if one is running already """
+    if zygote_available():
+        return None
+    proc = subprocess.Popen([sys.executable, 'zygote.py'])
+    deadline = time.monotonic() + timeout
+    while not zygote_available():
+        if proc.poll() is not None or time.monotonic() > deadline:
+            proc.kill()
+            raise RuntimeError('zygote did not start')
+        time.sleep(0.05)
+    return proc
+
+
+def main():
+    zygote = start_zygote() if options.zygote else None
+    timeout = options.timeout or (
+        get_simulation_parameters()['session_duration'] + 
+        settings.session_timeout_grace)
+    session_codes = [random_chars(8) for _ in range(options.sessions)]
+    log.info('running %s sessions, %s at a time: %s' % (
+        len(session_codes), options.concurrency, ' '.join(session_codes)))
+    start = time.monotonic()
+    with ThreadPoolExecutor(max_workers=options.concurrency) as executor:
+        results = list(executor.map(
+            lambda code: run_session(code, timeout), session_codes))
+    failed = [code for code, exit_code in results if exit_code != 0]
+    log.info('%s sessions done in %.1f seconds, %s failed: %s' % (
+        len(results), time.monotonic() - start, len(failed), ' '.join(failed)))
+    if zygote is not None:
+        zygote.terminate()
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    logging.basicConfig(
+        level=logging.DEBUG if options.debug else logging.INFO,
+        filename=settings.logs_dir + 'batch_%s.log' % random_chars(8),
+        format="[%(asctime)s.%(msecs)03d] %(levelname)s \
+        [%(name)s.%(funcName)s:%(lineno)d] %(message)s",
+        datefmt='%H:%M:%S')
+    sys.exit(main())
@@ -6,8 +6,17 @@ from protocols.ouch_proxy_protocol import (
 from protocols.json_line_protocol import JSONLineServerFactory
 from primitives.base_market_proxy import BaseMarketProxy
 from proxies.elo_market_proxy import ELOMarketProxy
+from builders import build_market_proxy
+from db.db import flush_snapshots
+from manifest import open_manifest
 from utility import random_chars, get_simulation_parameters
+import latency
+import metrics
+import tracing
 import logging as log
+import socket
+import sys
+import os
 
 
 p = configargparse.getArgParser()
@@ -19,21 +28,44 @@ p.add('--ouch_port', default=9201, type=int,
       help='port to listen to OUCH messages on')
 p.add('--json_port', default=9202, type=int,
       help='port to listen to JSON messages on')
+p.add('--ouch_fd', type=int,
+      help='inherited listening socket to take OUCH connections on, '
+           'instead of binding --ouch_port')
+p.add('--json_fd', type=int,
+      help='inherited listening socket to take JSON connections on, '
+           'instead of binding --json_port')
 p.add('--exchange_host', help='Address of the matching engine to proxy')
 p.add('--exchange_port', default=9001, type=int)
-p.add('--tag', choices=['focal', 'external'], type=str)
+p.add('--tag', type=str, help='market tag, as in the market topology')
+p.add('--market_id', type=int, 
+      help='defaults to 0 for the focal market, 1 otherwise')
+p.add('--manifest', help='compiled session manifest to read parameters from')
 options, args = p.parse_known_args()
 
 
+def listen(port, fd, factory):
+    if fd is None:
+        return reactor.listenTCP(port, factory)
+    # twisted expects a non blocking listening socket
+    os.set_blocking(fd, False)
+    listening_port = reactor.adoptStreamPort(fd, socket.AF_INET, factory)
+    # twisted works on a duplicate of the descriptor
+    os.close(fd)
+    return listening_port
+
+
 def main(market_proxy_cls: BaseMarketProxy):
-    proxy_server = market_proxy_cls(
+    proxy_server = build_market_proxy(
         options.tag, options.session_code, options.exchange_host,
-        options.exchange_port, **get_simulation_parameters())
+        options.exchange_port, get_simulation_parameters(),
+        market_proxy_cls=market_proxy_cls, market_id=options.market_id)
 
     reactor.connectTCP(options.exchange_host, options.exchange_port,
                        ProxyOuchClientFactory(proxy_server))
-    reactor.listenTCP(options.ouch_port, ProxyOuchServerFactory(proxy_server))
-    reactor.listenTCP(options.json_port, JSONLineServerFactory(proxy_server))
+    listen(options.ouch_port, options.ouch_fd, ProxyOuchServerFactory(proxy_server))
+    listen(options.json_port, options.json_fd, JSONLineServerFactory(proxy_server))
+
+    metrics.watch_reactor(reactor)
 
     d = task.deferLater(reactor, options.session_duration, proxy_server.close_session)
     d.addCallback(lambda _ : reactor.stop())
@@ -48,4 +80,20 @@ if __name__ == '__main__':
         format="[%(asctime)s.%(msecs)03d] %(levelname)s \
         [%(name)s.%(funcName)s:%(lineno)d] %(message)s",
         datefmt='%H:%M:%S')
+    tracing.configure_from_settings(
+        settings.logs_dir + 'session_%s_market_%s.trace' % (
+            options.session_code, options.tag), 
+        process_tag='market_%s' % options.tag)
+    metrics.configure_from_settings(
+        settings.logs_dir + 'session_%s_market_%s.metrics.json' % (
+            options.session_code, options.tag), 
+        process_tag='market_%s' % options.tag)
+    if settings.record_latency:
+        latency.recorder.configure(
+            settings.logs_dir + 'session_%s_market_%s.latency.json' % (
+                options.session_code, options.tag))
+    if options.manifest:
+        open_manifest(options.manifest)
     main(ELOMarketProxy)
+    # a session missing snapshot rows must not look complete
+    sys.exit(1 if flush_snapshots() else 0)
@@ -29,16 +29,158 @@ default_simulation_parameters = {
     'random_seed': None,
     'fundamental_values': [],
     'agent_state_configs': [],
+    # market topology, see topology.py
+    'markets': [],
+    'agent_markets': [],
 }
 
 logs_dir = './app/logs/'
 results_export_path = './app/data/{session_id}_{record_class}_accessed_{timestamp}.csv'
+# also export results as memory mappable numpy arrays
+export_columnar = True
+results_columnar_export_path = './app/data/columnar/{session_id}_{record_class}_accessed_{timestamp}.npy'
+# gzip exported csv files
+compress_results = False
 params_export_path = './app/data/{session_id}_params_{timestamp}.yaml'
 
-custom_config_path = './app/parameters.yaml'
+# web api jobs run with parameters of their own through PARAMETERS_PATH
+custom_config_path = os.getenv('PARAMETERS_PATH', './app/parameters.yaml')
+# compiled session manifests, see manifest.py
+# worker hosts need to see this directory at the same path
+manifest_dir = './app/manifests/'
+use_session_manifest = True
+
+# snapshot records are inserted in batches of this size
+db_batch_size = 300
+# write snapshots from a background thread with COPY,
+# at most `db_writer_queue_size` batches wait in memory
+db_background_writer = True
+db_writer_queue_size = 64
+# a failed COPY is retried this many times, waiting twice
+# as long after each attempt, starting from the delay in seconds
+db_writer_retries = 3
+db_writer_retry_delay = 0.5
+# while a full queue holds up the reactor,
+# a warning is logged every this many seconds
+db_writer_stall_warning = 1.0
+# build snapshot batches as usual but never write them, for benchmarks
+db_dry_run = False
+# postgres channel agents notify once their
+# market_end snapshot is committed
+session_complete_channel = 'session_complete'
+# record only changed columns of agent and market snapshots,
+# with a full keyframe row every `snapshot_keyframe_interval` rows
+snapshot_delta_mode = False
+snapshot_keyframe_interval = 100
 
 focal_exchange_host = os.getenv('FOCAL_EXCHANGE_HOST', 'localhost')
 external_exchange_host = os.getenv('EXTERNAL_EXCHANGE_HOST', 'localhost')
+# exchange hosts by market tag, others run on localhost
+exchange_hosts = {
+    'focal': focal_exchange_host,
+    'external': external_exchange_host,
+}
+
+# seconds exchanges get to start accepting connections
+exchange_start_timeout = 10
+
+# worker daemons (worker.py) running session processes on other hosts
+worker_port = 9500
+# shared by simulate.py and workers, workers refuse to start without it
+worker_token = os.getenv('WORKER_TOKEN', '')
+# the only scripts workers run, and environment variables they take
+worker_scripts = (
+    'run_proxy.py',
+    'run_agent.py',
+    'run_agent_host.py',
+    'exchange_server/run_exchange_server.py',
+)
+worker_env = ('TRACE_LEVEL', 'TRACE_SAMPLE_RATE', 'RECORD_JOURNAL')
+# seconds to wait for a worker to answer
+worker_timeout = 10
+# share of a cpu each kind of process takes, to place them on workers
+process_cpu_weights = {
+    'exchange': 1,
+    'proxy': 1,
+    'rabbit': 0.25,
+    'elo': 0.5,
+}
+# shards of an agent host (run_agent_host.py), None for one per cpu of
+# the host simulate.py runs on. an agent host weighs a cpu per shard
+agent_host_shards = None
+
+# zygote.py, forks session processes with heavy modules imported
+zygote_socket = os.getenv('ZYGOTE_SOCKET', '/tmp/fimsim_zygote.sock')
+# modules importing the twisted reactor can not be preloaded
+zygote_preload = [
+    'numpy',
+    'yaml',
+    'configargparse',
+    'peewee',
+    'psycopg2',
+    'zope.interface',
+    'twisted.internet.defer',
+    'twisted.internet.protocol',
+    'twisted.internet.task',
+    'twisted.internet.epollreactor',
+    'twisted.protocols.basic',
+    'high_frequency_trading.hft.incoming_message',
+    'high_frequency_trading.hft.equations',
+]
+
+# web api (api/app.py), simulations queue up as jobs and
+# `api_job_concurrency` of them run at a time
+api_job_concurrency = int(os.getenv('API_JOB_CONCURRENCY', 1))
+# finished jobs the api remembers
+api_job_history = 1000
+api_job_dir = './app/jobs/'
+# result rows per page, rows are read from the db in chunks
+api_result_page_size = 10000
+api_result_chunk_size = 1000
+
+# extra seconds session processes get before the watchdog kills them
+session_timeout_grace = 30
+
+# event tracing: 'off', 'info' or 'debug'
+trace_level = os.getenv('TRACE_LEVEL', 'off')
+trace_sample_rate = float(os.getenv('TRACE_SAMPLE_RATE', 1.0))
+trace_buffer_size = 65536
+
+# proxy flow control, frames wait in bounded buffers per consumer
+# while it is down or slow. when a buffer is full 'block' stops
+# reading from whoever feeds it, 'drop_oldest' and 'drop_newest'
+# discard frames. counters are logged when the session closes.
+# an agent connection that blocks stops sending orders,
+# json subscribers that block stop the market reading the exchange
+exchange_buffer_limit = 10000
+exchange_buffer_policy = 'block'
+agent_buffer_limit = 1000
+agent_buffer_policy = 'block'
+json_buffer_limit = 1000
+json_buffer_policy = 'block'
+
+# per hop order latency histograms, merged into
+# `latency_export_path` with the session results
+record_latency = True
+latency_export_path = './app/data/{session_id}_latency_{timestamp}.json'
+
+# journal every ouch frame proxies route to pre-allocated,
+# memory mapped segment files, see journal.py
+record_journal = bool(os.getenv('RECORD_JOURNAL'))
+journal_dir = './app/journals/'
+journal_segment_size = 64 * 1024 * 1024
+# replay.py, journals exported as json lines events
+events_export_path = './app/data/{session_id}_events.jsonl'
+# virtual seconds a replay waits for responses after the last frame
+replay_drain = 1.0
+
+# live counters and gauges of session processes, dumped every
+# `metrics_interval` seconds and served by simulate.py --metrics_port
+# and the web api in prometheus text format, see metrics.py
+record_metrics = True
+metrics_interval = 1.0
+# seconds between reactor lag probes
+metrics_lag_interval = 0.1
 
 ports = {
     'focal_proxy_ouch_port': 9201,
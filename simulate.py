@@ -1,20 +1,29 @@
 # elo simulation
+import virtual_clock
+# before anything imports the twisted reactor
+virtual_clock.install_if_requested()
 import sys
 import subprocess
-import shlex
 import settings
 import configargparse
 from utility import (
     random_chars, get_interactive_agent_count, 
     get_simulation_parameters, copy_params_to_logs)
 import numpy as np
-from db.db import session_results_ready
-from db.db_commands import export_session
+from db.db import (
+    session_results_ready, flush_snapshots, SessionCompletionListener)
+from db.db_commands import export_session, ensure_tables
 import logging
-from contextlib import closing
-import socket
-from time import sleep
-import atexit
+import signal
+import time
+import os
+from launchers import LocalLauncher, WorkerLauncher, start_exchanges
+from manifest import compile_manifest, open_manifest
+import tracing
+import topology
+import latency
+import metrics
+import datetime
 
 log = logging.getLogger(__name__)
 
@@ -22,38 +31,42 @@ p = configargparse.getArgParser()
 p.add('--debug', action='store_true')
 p.add('--session_code', default=random_chars(8), type=str)
 p.add('--note', type=str)
+p.add('--inprocess', action='store_true',
+      help='run proxies and agents in a single reactor in this process')
+p.add('--virtual_clock', action='store_true',
+      help='run proxies and agents on a virtual clock, as fast as possible, '
+           'needs --inprocess. exchanges stay on the wall clock')
+p.add('--timeout', type=float,
+      help='seconds to wait for session processes before killing them, '
+           'defaults to session duration plus settings.session_timeout_grace')
+p.add('--trace_level', choices=tracing.LEVELS.keys(),
+      help='trace hot path events of session processes, '
+           'merge trace files with merge_traces.py')
+p.add('--workers', type=lambda arg: arg.split(','),
+      help='comma separated host:port of worker daemons (worker.py) to '
+           'place session processes on, by default they run here')
+p.add('--agent_host', action='store_true',
+      help='run all agents in one agent host (run_agent_host.py) '
+           'sharded over cpu cores, instead of a process per agent')
+p.add('--zygote', action='store_true',
+      help='fork session processes from the zygote (zygote.py) '
+           'at settings.zygote_socket, if it is running')
+p.add('--metrics_port', type=int,
+      help='serve live metrics of session processes on this port '
+           'in prometheus text format, 0 picks a free port')
+p.add('--journal', action='store_true',
+      help='journal every ouch frame proxies route, see journal.py')
 options, args = p.parse_known_args()
+if options.virtual_clock and not options.inprocess:
+    # each process would move its own clock
+    p.error('--virtual_clock needs --inprocess')
 
-# gets a list of `num_ports` of available ports between 9000 and 10000
-def get_available_ports(num_ports):
-    ports = []
-    for port in range(9000, 10000):
-        with closing(socket.socket(socket.AF_INET, socket.SOCK_STREAM)) as sock:
-            res = sock.connect_ex(('localhost', port))
-            if res != 0:
-                ports.append(port)
-                if len(ports) == num_ports:
-                    return ports
-    raise RuntimeError('no available ports')
-
-def start_exchange(port, exchange_format, fba_interval):
-    cmd = [
-        sys.executable,
-        'exchange_server/run_exchange_server.py',
-        '--host', 'localhost',
-        '--port', str(port),
-        '--mechanism', exchange_format.lower(),
-    ]
-    if exchange_format.lower() == 'fba':
-        cmd.extend([
-            '--interval', str(fba_interval),
-        ])
-    if options.debug:
-        cmd.append('--debug')
-    proc = subprocess.Popen(cmd)
-    # make sure this process is eventually killed
-    atexit.register(proc.terminate)
-    return proc
+if options.trace_level:
+    # session processes inherit the environment
+    os.environ['TRACE_LEVEL'] = settings.trace_level = options.trace_level
+if options.journal:
+    os.environ['RECORD_JOURNAL'] = '1'
+    settings.record_journal = True
 
 def run_elo_simulation(session_code):
     """
@@ -72,101 +85,200 @@ def run_elo_simulation(session_code):
         datefmt='%H:%M:%S')
     # commands to run each process
     # one proxy per exchange
-    # one pacemaker agent per proxy
+    # rabbits per proxy as the topology says
 
-    # start exchanges
+    if not settings.db_dry_run:
+        # before any process of the session writes snapshots
+        ensure_tables()
     params = get_simulation_parameters()
-    focal_exchange_port, external_exchange_port = get_available_ports(2)
-    focal_exchange_proc = start_exchange(
-        focal_exchange_port,
-        params['focal_market_format'],
-        params['focal_market_fba_interval']
-    )
-    external_exchange_proc = start_exchange(
-        external_exchange_port,
-        params['external_market_format'],
-        params['external_market_fba_interval']
-    )
-    # sleep for a second after making the exchanges to ensure they don't buffer messages
-    # when the experiment starts. not sure this is necessary, but just being safe
-    sleep(1)
-
-    p = settings.ports
-    session_dur = params['session_duration']
     if params['random_seed']:
         random_seed = int(params['random_seed'])
     else:
         random_seed = np.random.randint(0, 99)
+    manifest = None
+    if settings.use_session_manifest:
+        # validated once, tapes drawn once, for all session processes
+        manifest = open_manifest(compile_manifest(
+            session_code, params, random_seed))
+        params = manifest.params
+    markets = topology.get_markets(params)
 
-    # (cmd, process_name)
-    focal_proxy = """ run_proxy.py --ouch_port {0} --json_port {1}
-                      --session_code {2} --exchange_host {3} --exchange_port {4} 
-                      --session_duration {5} --tag focal""".format(
-                p['focal_proxy_ouch_port'], 
-                p['focal_proxy_json_port'],
-                session_code, 
-                settings.focal_exchange_host,
-                focal_exchange_port, 
-                session_dur), 'focal_proxy'
-    external_proxy = """run_proxy.py --ouch_port {0} --json_port {1}
-                        --session_code {2} --exchange_host {3} --exchange_port {4} 
-                        --session_duration {5} --tag external""".format(
-                p['external_proxy_ouch_port'], 
-                p['external_proxy_json_port'], 
-                session_code, 
-                settings.external_exchange_host,
-                external_exchange_port, 
-                session_dur), 'external_proxy'
-
-    rabbit_agent_focal = """run_agent.py --session_duration {0} --exchange_ouch_port {1}
-                            --session_code {2} --agent_type rabbit --config_num {3} 
-                            --random_seed {4}""".format(
-                    session_dur, 
-                    p['focal_proxy_ouch_port'],
-                    session_code, 
-                    0, 
-                    random_seed), 'rabbit_agent_focal'
-    rabbit_agent_external = """run_agent.py --session_duration {0} --exchange_ouch_port {1}
-                               --session_code {2} --agent_type rabbit --config_num {3} 
-                               --random_seed {4}""".format(
-                    session_dur, 
-                    p['external_proxy_ouch_port'],
-                    session_code, 
-                    1, 
-                    random_seed), 'rabbit_agent_external'
-
-    interactive_agents = []
-    for i in range(get_interactive_agent_count(params['agent_state_configs'])):
-        agent_i = """run_agent.py --session_duration {0} --exchange_ouch_port {1} \
-            --exchange_json_port {2}  --external_exchange_host 127.0.0.1 \
-            --external_exchange_json_port {3} --session_code {4} \
-            --agent_type elo --config_num {5} --debug""".format(
-                session_dur, 
-                p['focal_proxy_ouch_port'],
-                p['focal_proxy_json_port'], 
-                p['external_proxy_json_port'],
-                session_code, 
-                i), 'dynamic_agent_{0}'.format(i)
-        interactive_agents.append(agent_i)
+    if options.metrics_port is not None:
+        metrics.serve_session_metrics(session_code, options.metrics_port)
 
-    processes = {}
-    for pair in [focal_proxy, external_proxy, rabbit_agent_focal,
-                 rabbit_agent_external] + interactive_agents:
-        cmd, process_tag = pair[0], pair[1]
-        if options.debug:
-            cmd += ' --debug'
-        cmd = sys.executable + ' ' + cmd
-        processes[process_tag] = subprocess.Popen(shlex.split(cmd))
-    exit_codes = [p.wait() for p in processes.values()]
-    # once all other subprocesses have finished, kill exchanges
-    focal_exchange_proc.terminate()
-    external_exchange_proc.terminate()
-    if sum(exit_codes) == 0 and session_results_ready(session_code):
+    # start exchanges
+    launcher = WorkerLauncher(options.workers) if options.workers else (
+        LocalLauncher(settings.zygote_socket if options.zygote else None))
+    exchange_procs, exchanges = start_exchanges(markets, launcher,
+                                                 debug=options.debug)
+    if options.virtual_clock and any(
+            market['format'] == 'FBA' for market in markets):
+        log.warning('exchanges run batches on the wall clock, FBA intervals '
+                    'are not compressed on a virtual clock.')
+
+    # rabbits plus interactive agents
+    num_agents = len(topology.get_rabbits(markets, random_seed)) + (
+        get_interactive_agent_count(params['agent_state_configs']))
+    with SessionCompletionListener(session_code) as completion:
+        if options.inprocess:
+            # imported here, installs the twisted reactor
+            from all_in_one import run_session
+            tracing.configure_from_settings(
+                settings.logs_dir + 'session_%s_inprocess.trace' % session_code,
+                process_tag='inprocess')
+            if settings.record_latency:
+                latency.recorder.configure(
+                    settings.logs_dir + 'session_%s_inprocess.latency.json' % (
+                        session_code))
+            metrics.configure_from_settings(
+                settings.logs_dir + 'session_%s_inprocess.metrics.json' % (
+                    session_code), process_tag='inprocess')
+            run_session(session_code, params, exchanges, random_seed,
+                        manifest=manifest)
+            # snapshots are written by a background thread of this process
+            records_lost = flush_snapshots()
+            latency.recorder.dump()
+            exit_codes = [1 if records_lost else 0]
+        else:
+            exit_codes = run_session_processes(
+                session_code, params, markets, exchanges, random_seed,
+                launcher, manifest)
+        # once all other subprocesses have finished, kill exchanges
+        for proc in exchange_procs.values():
+            proc.terminate()
+        launcher.close()
+        results_ready = all(code == 0 for code in exit_codes) and (
+            completion.wait(num_agents) or session_results_ready(session_code))
+    if results_ready:
         export_session(session_code)
-        copy_params_to_logs(session_code)
+        copy_params_to_logs(session_code, params)
+        if settings.record_latency:
+            latency.export_session_latency(
+                session_code, settings.logs_dir, 
+                settings.latency_export_path.format(
+                    session_id=session_code, 
+                    timestamp=datetime.datetime.now()))
 
     log.info('session %s complete!' % session_code)
+    return results_ready
+
+
+def run_session_processes(session_code, params, markets, exchanges, 
+                          random_seed, launcher, manifest=None):
+    """
+    runs proxies and agents of a session as separate processes
+    returns their exit codes
+    """
+    session_dur = str(params['session_duration'])
+    timeout = options.timeout or float(session_dur) + (
+        settings.session_timeout_grace)
+    # session processes on workers get the tracing and journal
+    # environment we run with
+    env = {key: os.environ[key] for key in settings.worker_env
+           if key in os.environ}
+
+    # workers get a copy of the manifest
+    manifest_dir = launcher.share_manifest(manifest) if manifest else None
+
+    def launch(process_tag, kind, cmd, **kwargs):
+        if manifest_dir is not None:
+            cmd.extend(['--manifest', manifest_dir])
+        if options.debug:
+            cmd.append('--debug')
+        processes[process_tag] = launcher.launch(
+            process_tag, cmd, kind, env=env, **kwargs)
+        return processes[process_tag]
+
+    processes = {}
+    # proxies first, agents need to know where they are
+    proxies = {}
+    for market in markets:
+        tag = market['tag']
+        exchange_host, exchange_port = exchanges[tag]
+        proxy = launch('%s_proxy' % tag, 'proxy', [
+            'run_proxy.py', 
+            '--ouch_port', '{ouch_port}', '--json_port', '{json_port}',
+            '--ouch_fd', '{ouch_fd}', '--json_fd', '{json_fd}',
+            '--session_code', session_code, 
+            '--exchange_host', exchange_host,
+            '--exchange_port', str(exchange_port), 
+            '--session_duration', session_dur, 
+            '--tag', tag, '--market_id', str(market['market_id'])],
+            listen=('ouch', 'json'))
+        proxies[tag] = (proxy.host, proxy.ports['ouch'], proxy.ports['json'])
+
+    if options.agent_host:
+        cmd = ['run_agent_host.py', '--session_duration', session_dur,
+               '--session_code', session_code]
+        for tag, (host, ouch_port, json_port) in proxies.items():
+            cmd.extend(['--market', '%s:%s:%s:%s' % (
+                tag, host, ouch_port, json_port)])
+        for tag, config_num, seed in topology.get_rabbits(
+                markets, random_seed):
+            cmd.extend(['--rabbit', '%s:%s:%s' % (
+                tag, config_num, '' if seed is None else seed)])
+        num_elos = get_interactive_agent_count(params['agent_state_configs'])
+        for i in range(num_elos):
+            cmd.extend(['--elo', str(i)])
+        # placed by the cpus its shards take
+        shards = max(1, min(
+            settings.agent_host_shards or os.cpu_count(),
+            len(topology.get_rabbits(markets, random_seed)) + num_elos))
+        cmd.extend(['--shards', str(shards)])
+        launch('agent_host', 'agent_host', cmd, weight=shards)
+        return wait_or_kill(processes, time.monotonic() + timeout)
+
+    for i, (tag, config_num, seed) in enumerate(
+            topology.get_rabbits(markets, random_seed)):
+        host, ouch_port, _ = proxies[tag]
+        cmd = ['run_agent.py', '--session_duration', session_dur, 
+               '--exchange_host', host, '--exchange_ouch_port', str(ouch_port),
+               '--session_code', session_code, '--agent_type', 'rabbit',
+               '--config_num', str(config_num)]
+        if seed is not None:
+            cmd.extend(['--random_seed', str(seed)])
+        cmd.extend(['--agent_index', str(i)])
+        launch('rabbit_agent_%s_%s' % (tag, i), 'rabbit', cmd)
+
+    for i in range(get_interactive_agent_count(params['agent_state_configs'])):
+        focal, external = topology.get_agent_markets(params, i, markets)
+        host, ouch_port, json_port = proxies[focal]
+        cmd = ['run_agent.py', '--session_duration', session_dur, 
+               '--exchange_host', host, '--exchange_ouch_port', str(ouch_port),
+               '--exchange_json_port', str(json_port), '--market_tag', focal,
+               '--session_code', session_code, '--agent_type', 'elo',
+               '--config_num', str(i), '--agent_index', str(i), '--debug']
+        for tag in external:
+            cmd.extend(['--external_feed', '%s:%s:%s' % (
+                tag, proxies[tag][0], proxies[tag][2])])
+        launch('dynamic_agent_{0}'.format(i), 'elo', cmd)
+
+    return wait_or_kill(processes, time.monotonic() + timeout)
+
+
+def wait_or_kill(processes: dict, deadline):
+    """
+    watchdog, waits for session processes until the deadline
+    then kills whatever is still running
+    returns exit codes
+    """
+    exit_codes = []
+    for process_tag, proc in processes.items():
+        try:
+            exit_codes.append(
+                proc.wait(timeout=max(0, deadline - time.monotonic())))
+        except subprocess.TimeoutExpired:
+            log.error('deadline passed, killing %s' % process_tag)
+            proc.kill()
+            exit_codes.append(proc.wait())
+    return exit_codes
+
+
+def terminate_on_sigterm():
+    """ so atexit handlers (exchanges, db writer) run on sigterm too """
+    signal.signal(signal.SIGTERM, lambda *_: sys.exit(1))
 
 
 if __name__ == '__main__':
-    run_elo_simulation(options.session_code)
+    terminate_on_sigterm()
+    sys.exit(0 if run_elo_simulation(options.session_code) else 1)
@@ -0,0 +1,71 @@
+from twisted.internet.task import Clock
+
+from discrete_event_emitter import DiscreteEventEmitter, DiscreteEventScheduler
+
+
+class Owner:
+
+    def __init__(self, clock):
+        self.clock = clock
+        self.events = []
+
+    def handle_discrete_event(self, event):
+        self.events.append((self.clock.seconds(), event['type'], 
+                            event['value']))
+
+
+def emitter(name, rows, owner):
+    em = type(name, (DiscreteEventEmitter, ), {
+        'name': name, 'fieldnames': ('value', ), 'fieldprocessors': (int, )
+    })(rows)
+    em.owner = owner
+    return em
+
+
+def test_events_fire_in_time_order_across_emitters():
+    clock = Clock()
+    owner = Owner(clock)
+    scheduler = DiscreteEventScheduler([
+        emitter('a', [(0.5, 1), (2.0, 3)], owner),
+        emitter('b', [(1.0, 2), (2.5, 4)], owner)], clock=clock)
+    scheduler.start()
+    clock.advance(3)
+    assert [value for _, _, value in owner.events] == [1, 2, 3, 4]
+    clock.pump([0.1] * 30)
+    assert len(owner.events) == 4
+
+
+def test_ties_fire_in_emitter_order():
+    clock = Clock()
+    owner = Owner(clock)
+    scheduler = DiscreteEventScheduler([
+        emitter('a', [(1.0, 1)], owner),
+        emitter('b', [(1.0, 2)], owner)], clock=clock)
+    scheduler.start()
+    clock.advance(1)
+    assert [name for _, name, _ in owner.events] == ['a', 'b']
+
+
+def test_one_call_on_the_clock_at_a_time():
+    clock = Clock()
+    owner = Owner(clock)
+    scheduler = DiscreteEventScheduler([
+        emitter('a', [(t, t) for t in range(1, 10)], owner),
+        emitter('b', [(t + 0.5, t) for t in range(1, 10)], owner)], 
+        clock=clock)
+    scheduler.start()
+    assert len(clock.getDelayedCalls()) == 1
+    clock.advance(1)
+    assert len(clock.getDelayedCalls()) == 1 and owner.events == [(1, 'a', 1)]
+    scheduler.stop()
+    assert not clock.getDelayedCalls()
+
+
+def test_unsorted_rows_are_sorted():
+    clock = Clock()
+    owner = Owner(clock)
+    scheduler = DiscreteEventScheduler(
+        [emitter('a', [(2.0, 2), (1.0, 1)], owner)], clock=clock)
+    scheduler.start()
+    clock.pump([1, 1])
+    assert owner.events == [(1, 'a', 1), (2, 'a', 2)]
@@ -0,0 +1,30 @@
+import numpy as np
+import pytest
+
+pytest.importorskip('high_frequency_trading.hft.equations')
+
+import draw
+
+
+def test_asof():
+    times = np.array([0., 1., 2.5])
+    at = np.array([-1., 0., 0.5, 1., 2.4, 2.5, 10.])
+    assert draw.asof(times, at).tolist() == [-1, 0, 0, 1, 1, 2, 2]
+
+
+def test_order_sides_follow_buy_prob():
+    asset_values = np.array([[0., 100000.]])
+    orders = draw.elo_random_order_sequence(
+        asset_values, 1000, 0, 1, 50, 0.01, 1, buy_prob=0.9,
+        random_state=np.random.RandomState(1))
+    buys = orders['buy_sell_indicator'] == 'B'
+    assert 0.85 < buys.mean() < 0.95
+
+
+def test_orders_take_the_latest_fundamental_value():
+    asset_values = np.array([[0., 100.], [5., 200.]])
+    orders = draw.elo_random_order_sequence(
+        asset_values, 10, 0, 1, 0, 0.01, 1, 
+        random_state=np.random.RandomState(2))
+    expected = np.where(orders['arrival_time'] < 5, 100., 200.)
+    assert (orders['fundamental_price'] == expected).all()
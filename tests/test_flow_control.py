@@ -0,0 +1,111 @@
+from protocols.flow_control import BoundedSender, FlowCounters, UpstreamGate
+
+
+class Transport:
+
+    def __init__(self):
+        self.paused = False
+        self.producer = None
+
+    def registerProducer(self, producer, streaming):
+        self.producer = producer
+
+    def pauseProducing(self):
+        self.paused = True
+
+    def resumeProducing(self):
+        self.paused = False
+
+
+def paused_sender(policy, limit=2, upstream=None):
+    sent = []
+    sender = BoundedSender(sent.append, limit, policy, FlowCounters(),
+                           upstream=upstream)
+    sender.attach(Transport())
+    sender.pauseProducing()
+    return sender, sent
+
+
+def test_writes_through_while_writable():
+    sent = []
+    sender = BoundedSender(sent.append, 2, 'block', FlowCounters())
+    sender.attach(Transport())
+    sender.write(b'a')
+    assert sent == [b'a'] and not sender.buffer
+
+
+def test_buffers_until_attached():
+    sent = []
+    sender = BoundedSender(sent.append, 2, 'block', FlowCounters())
+    sender.write(b'a')
+    assert sent == []
+    sender.attach(Transport())
+    assert sent == [b'a']
+
+
+def test_drop_oldest():
+    sender, sent = paused_sender('drop_oldest')
+    for frame in (b'a', b'b', b'c'):
+        sender.write(frame)
+    assert list(sender.buffer) == [b'b', b'c']
+    assert sender.counters.dropped == 1
+    sender.resumeProducing()
+    assert sent == [b'b', b'c']
+
+
+def test_drop_newest():
+    sender, sent = paused_sender('drop_newest')
+    for frame in (b'a', b'b', b'c'):
+        sender.write(frame)
+    assert list(sender.buffer) == [b'a', b'b']
+    assert sender.counters.dropped == 1
+
+
+def test_block_holds_upstream_until_drained():
+    upstream = Transport()
+    gate = UpstreamGate(lambda: [upstream])
+    sender, sent = paused_sender('block', upstream=gate)
+    for frame in (b'a', b'b', b'c'):
+        sender.write(frame)
+    # nothing is dropped, the feeding transport is paused
+    assert list(sender.buffer) == [b'a', b'b', b'c']
+    assert sender.counters.dropped == 0
+    assert gate.closed and upstream.paused
+    sender.resumeProducing()
+    assert sent == [b'a', b'b', b'c']
+    assert not gate.closed and not upstream.paused
+
+
+def test_transport_behind_two_gates_resumes_when_both_open():
+    transport = Transport()
+    first = UpstreamGate(lambda: [transport])
+    second = UpstreamGate(lambda: [transport])
+    first.hold()
+    second.hold()
+    first.release()
+    assert transport.paused
+    second.release()
+    assert not transport.paused
+
+
+def test_admit_pauses_new_transports_of_a_closed_gate():
+    transports = []
+    gate = UpstreamGate(lambda: transports)
+    gate.hold()
+    transport = Transport()
+    transports.append(transport)
+    gate.admit(transport)
+    assert transport.paused
+    gate.release()
+    assert not transport.paused
+
+
+def test_close_drops_waiting_frames_and_releases_upstream():
+    upstream = Transport()
+    gate = UpstreamGate(lambda: [upstream])
+    sender, sent = paused_sender('block', upstream=gate)
+    for frame in (b'a', b'b'):
+        sender.write(frame)
+    sender.close()
+    assert sender.counters.dropped == 2 and not sender.buffer
+    assert not gate.closed and not upstream.paused
@@ -0,0 +1,40 @@
+from latency import (
+    SUB_BUCKET_BITS, LatencyHistogram, bucket_index, bucket_value)
+
+
+def test_small_values_are_exact():
+    for value in range(2 ** (SUB_BUCKET_BITS + 1)):
+        assert bucket_value(bucket_index(value)) == value
+
+
+def test_bucket_relative_error():
+    for value in (100, 1000, 12345, 10 ** 6, 2 ** 40 + 17):
+        low = bucket_value(bucket_index(value))
+        assert low <= value
+        assert (value - low) / value < 1 / 2 ** SUB_BUCKET_BITS
+
+
+def test_buckets_are_monotonic():
+    indexes = [bucket_index(value) for value in range(5000)]
+    assert indexes == sorted(indexes)
+
+
+def test_percentiles_and_merge():
+    first, second = LatencyHistogram(), LatencyHistogram()
+    for micros in range(1, 51):
+        first.record(micros / 1e6)
+    for micros in range(51, 101):
+        second.record(micros / 1e6)
+    merged = first.merge(second)
+    assert merged.count == 100
+    assert (merged.min, merged.max) == (1, 100)
+    assert merged.percentile(50) == 50
+    assert merged.percentile(100) <= 100
+
+
+def test_round_trips_through_dict():
+    histogram = LatencyHistogram()
+    for seconds in (0.001, 0.002, 0.5):
+        histogram.record(seconds)
+    copy = LatencyHistogram.from_dict(histogram.to_dict())
+    assert copy.summary() == histogram.summary()
@@ -0,0 +1,47 @@
+import pytest
+
+pytest.importorskip('high_frequency_trading.hft.equations')
+
+from manifest import validate_parameters
+
+MARKETS = [{'tag': 'focal', 'format': 'CDA'}, {'tag': 'external', 
+                                                'format': 'FBA'}]
+
+
+def params(**kwargs):
+    p = {'session_duration': 10, 'lambdaI': [1, 2],
+         'agent_state_configs': [[0, 1, 0, 0, 0, 0]]}
+    p.update(kwargs)
+    return p
+
+
+def test_valid_parameters():
+    assert validate_parameters(params(), MARKETS)['lambdaI'] == [1, 2]
+
+
+def test_single_rate_applies_to_every_market():
+    assert validate_parameters(params(lambdaI=3), MARKETS)['lambdaI'] == [3, 3]
+
+
+@pytest.mark.parametrize('bad', [
+    {'session_duration': 0},
+    {'session_duration': 'long'},
+    {'lambdaI': [1]},
+    {'lambdaI': [1, -2]},
+    {'agent_state_configs': [[0, 0, 0, 0, 0, 0]]},
+    {'agent_state_configs': [[0, 1, 0]]},
+])
+def test_invalid_parameters(bad):
+    with pytest.raises(ValueError):
+        validate_parameters(params(**bad), MARKETS)
+
+
+def test_unknown_market_format():
+    with pytest.raises(ValueError):
+        validate_parameters(params(), [{'tag': 'focal', 'format': 'XYZ'}])
+
+
+def test_does_not_change_its_input():
+    given = params(lambdaI=3)
+    validate_parameters(given, MARKETS)
+    assert given['lambdaI'] == 3
@@ -0,0 +1,74 @@
+import pytest
+
+pytest.importorskip('high_frequency_trading.hft.exchange')
+pytest.importorskip('exchange_server.OuchServer')
+
+from twisted.internet import protocol, reactor
+from benchmarks.proxy_throughput import (
+    StubExchange, StubExchangeFactory, ENTER, ACCEPTED, STOCK)
+from builders import build_market_proxy
+from protocols.loopback import connect_loopback
+from protocols.ouch_proxy_protocol import (
+    ProxyOuchServerFactory, ProxyOuchClientFactory)
+import settings
+
+# a proxy between an agent and an exchange, both on in memory
+# transports, the way simulate.py --inprocess and replay.py run it.
+# loopback transports take bytes only, frames routed as views fail here
+
+
+class LoopbackStubExchange(StubExchange):
+
+    def connectionMade(self):
+        # no tcp options on a loopback transport
+        self.factory.connections.append(self)
+
+
+class LoopbackStubExchangeFactory(StubExchangeFactory):
+
+    def buildProtocol(self, addr):
+        return LoopbackStubExchange(self)
+
+
+class Agent(protocol.Protocol):
+
+    def __init__(self):
+        self.received = b''
+
+    def connectionMade(self):
+        self.transport.write(ENTER.pack(
+            b'O', b'ABCD0000000001', b'B', 100, STOCK, 1000000, 5, b'ABCD',
+            b'Y', b'P', b'N', 0, b'N', b'R'))
+
+    def dataReceived(self, data):
+        self.received += data
+
+
+class AgentFactory(protocol.ClientFactory):
+
+    def __init__(self):
+        self.agent = Agent()
+
+    def buildProtocol(self, addr):
+        return self.agent
+
+
+def test_order_round_trip(monkeypatch):
+    monkeypatch.setattr(settings, 'db_dry_run', True)
+    monkeypatch.setattr(settings, 'record_journal', False)
+    proxy = build_market_proxy(
+        'focal', 'loopback', '127.0.0.1', 0,
+        dict(settings.default_simulation_parameters))
+    exchange = LoopbackStubExchangeFactory(execution_interval=100)
+    connect_loopback(exchange, ProxyOuchClientFactory(proxy))
+    agents = AgentFactory()
+    connect_loopback(ProxyOuchServerFactory(proxy), agents)
+    # loopback transports deliver on the next reactor iteration
+    for _ in range(100):
+        if agents.agent.received:
+            break
+        reactor.iterate(0)
+    received = agents.agent.received
+    assert exchange.accepted == 1
+    assert received[:1] == b'A' and len(received) == ACCEPTED.size
+    assert received[9:23] == b'ABCD0000000001'
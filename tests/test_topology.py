@@ -0,0 +1,47 @@
+import pytest
+
+import topology
+
+LEGACY = {
+    'focal_market_format': 'CDA', 'focal_market_fba_interval': 0,
+    'external_market_format': 'fba', 'external_market_fba_interval': 2,
+}
+
+
+def test_legacy_focal_and_external_markets():
+    markets = topology.get_markets(LEGACY)
+    assert [m['tag'] for m in markets] == ['focal', 'external']
+    assert [m['market_id'] for m in markets] == [0, 1]
+    assert markets[1]['format'] == 'FBA' and markets[1]['fba_interval'] == 2
+
+
+def test_listed_markets():
+    markets = topology.get_markets({'markets': [
+        {'tag': 'a'}, {'tag': 'b', 'format': 'FBA', 'rabbits': 2}]})
+    assert [(m['tag'], m['format'], m['rabbits']) for m in markets] == [
+        ('a', 'CDA', 1), ('b', 'FBA', 2)]
+
+
+def test_market_tags_are_unique():
+    with pytest.raises(ValueError):
+        topology.get_markets({'markets': [{'tag': 'a'}, {'tag': 'a'}]})
+
+
+def test_agent_markets_default_to_first_market():
+    markets = topology.get_markets({'markets': [
+        {'tag': 'a'}, {'tag': 'b'}, {'tag': 'c'}]})
+    assert topology.get_agent_markets({}, 0, markets) == ('a', ['b', 'c'])
+
+
+def test_listed_agent_markets():
+    markets = topology.get_markets({'markets': [{'tag': 'a'}, {'tag': 'b'}]})
+    params = {'agent_markets': [None, {'focal': 'b', 'external': ['a']}]}
+    assert topology.get_agent_markets(params, 0, markets) == ('a', ['b'])
+    assert topology.get_agent_markets(params, 1, markets) == ('b', ['a'])
+
+
+def test_agent_markets_must_exist():
+    markets = topology.get_markets({'markets': [{'tag': 'a'}]})
+    params = {'agent_markets': [{'focal': 'z'}]}
+    with pytest.raises(ValueError):
+        topology.get_agent_markets(params, 0, markets)
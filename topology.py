@@ -0,0 +1,69 @@
+import settings
+import logging
+
+log = logging.getLogger(__name__)
+
+# which markets a session runs and who trades where.
+# parameters may list markets explicitly,
+#
+#   markets:
+#     - {tag: focal, format: CDA}
+#     - {tag: venue_b, format: FBA, fba_interval: 1, rabbits: 2}
+#   agent_markets:   # per interactive agent, by config number
+#     - {focal: focal, external: [venue_b]}
+#
+# otherwise the focal / external pair is built from the
+# legacy *_market_format and *_market_fba_interval parameters.
+# market ids follow list order, rabbits of market k draw their
+# arrival rate from lambdaI[k]. interactive agents not listed in
+# agent_markets trade on the first market and watch all others.
+
+
+def get_markets(params: dict):
+    markets = params.get('markets') or [
+        {'tag': tag,
+         'format': params['%s_market_format' % tag],
+         'fba_interval': params['%s_market_fba_interval' % tag]}
+        for tag in ('focal', 'external')]
+    topology = []
+    for market_id, market in enumerate(markets):
+        tag = market['tag']
+        topology.append({
+            'tag': tag,
+            'market_id': market_id,
+            'format': market.get('format', 'CDA').upper(),
+            'fba_interval': market.get('fba_interval', 1),
+            'rabbits': int(market.get('rabbits', 1)),
+            'exchange_host': market.get('exchange_host') or
+                settings.exchange_hosts.get(tag, 'localhost'),
+        })
+    tags = [market['tag'] for market in topology]
+    if len(set(tags)) != len(tags):
+        raise ValueError('market tags are not unique: %s' % tags)
+    return topology
+
+
+def get_agent_markets(params: dict, config_num: int, markets: list):
+    """ returns the tag of the market an agent trades on and tags it watches """
+    tags = [market['tag'] for market in markets]
+    agent_markets = params.get('agent_markets') or []
+    if config_num < len(agent_markets) and agent_markets[config_num]:
+        focal = agent_markets[config_num]['focal']
+        external = list(agent_markets[config_num].get('external', ()))
+    else:
+        focal, external = tags[0], tags[1:]
+    for tag in [focal] + external:
+        if tag not in tags:
+            raise ValueError('agent %s refers to unknown market %s' % (
+                config_num, tag))
+    return focal, external
+
+
+def get_rabbits(markets: list, random_seed):
+    """ (market tag, config num, random seed) of each rabbit """
+    rabbits = []
+    for market in markets:
+        for i in range(market['rabbits']):
+            seed = random_seed + i if random_seed is not None else None
+            rabbits.append((market['tag'], market['market_id'], seed))
+    return rabbits
@@ -0,0 +1,148 @@
+from collections import deque
+import atexit
+import json
+import os
+import random
+import threading
+import time
+import logging
+
+log = logging.getLogger(__name__)
+
+# compact event tracing for hot paths.
+# call sites emit (event, *fields) tuples into an in memory ring buffer,
+# a background thread drains it to a json lines file, which starts with
+# a {"process", "wall", "monotonic"} line relating event times to wall time.
+# disabled levels are bound to a no-op so they cost a call and nothing else.
+#
+#   trace = tracing.get_tracer(__name__)
+#   trace.info('handle_json', account_id, msg_type)
+
+LEVELS = {'debug': 10, 'info': 20, 'off': 100}
+
+
+def _noop(*_):
+    pass
+
+
+class Tracer:
+
+    def __init__(self, category, registry):
+        self.category = category
+        self.registry = registry
+        self.debug = self.info = _noop
+
+    def bind(self):
+        registry = self.registry
+        self.debug = self._emitter(LEVELS['debug']) if (
+            registry.level <= LEVELS['debug']) else _noop
+        self.info = self._emitter(LEVELS['info']) if (
+            registry.level <= LEVELS['info']) else _noop
+
+    def _emitter(self, level):
+        category = self.category
+        buffer = self.registry.buffer
+        clock = time.monotonic
+        sample_rate = self.registry.sample_rate
+        if sample_rate >= 1:
+            def emit(event, *fields):
+                buffer.append((clock(), category, event, fields))
+        else:
+            rand = random.random
+            def emit(event, *fields):
+                if rand() < sample_rate:
+                    buffer.append((clock(), category, event, fields))
+        return emit
+
+
+class TraceRegistry:
+
+    def __init__(self):
+        self.level = LEVELS['off']
+        self.sample_rate = 1.0
+        self.buffer = deque(maxlen=1)
+        self.tracers = {}
+        self.sink = None
+
+    def get_tracer(self, category):
+        try:
+            return self.tracers[category]
+        except KeyError:
+            tracer = self.tracers[category] = Tracer(category, self)
+            tracer.bind()
+            return tracer
+
+    def configure(self, path, level='info', sample_rate=1.0, 
+                  buffer_size=65536, flush_interval=0.5, process_tag=''):
+        """
+        start tracing to `path`, events below `level` 
+        and all but a `sample_rate` share of the rest are dropped
+        """
+        self.close()
+        self.level = LEVELS[level]
+        self.sample_rate = sample_rate
+        if self.level < LEVELS['off']:
+            # oldest records are dropped if the sink falls behind
+            self.buffer = deque(maxlen=buffer_size)
+            self.sink = TraceSink(path, self.buffer, flush_interval, 
+                                  process_tag or str(os.getpid()))
+            self.sink.start()
+        for tracer in self.tracers.values():
+            tracer.bind()
+
+    def close(self):
+        if self.sink is not None:
+            self.sink.stop()
+            self.sink = None
+
+
+class TraceSink(threading.Thread):
+
+    def __init__(self, path, buffer, flush_interval, process_tag):
+        super().__init__(name='trace-sink', daemon=True)
+        self.path = path
+        self.buffer = buffer
+        self.flush_interval = flush_interval
+        self.process_tag = process_tag
+        self.stopped = threading.Event()
+
+    def run(self):
+        with open(self.path, 'a') as f:
+            # records are timed on the monotonic clock, a wall clock
+            # reading taken with it lets traces of many hosts be merged
+            f.write(json.dumps({'process': self.process_tag, 
+                                'wall': time.time(), 
+                                'monotonic': time.monotonic()}) + '\n')
+            f.flush()
+            while not self.stopped.wait(self.flush_interval):
+                self.drain(f)
+            self.drain(f)
+
+    def drain(self, f):
+        buffer, tag = self.buffer, self.process_tag
+        lines = []
+        while buffer:
+            t, category, event, fields = buffer.popleft()
+            lines.append(json.dumps((t, tag, category, event) + fields, 
+                                    default=str))
+        if lines:
+            f.write('\n'.join(lines))
+            f.write('\n')
+            f.flush()
+
+    def stop(self):
+        self.stopped.set()
+        self.join()
+
+
+registry = TraceRegistry()
+get_tracer = registry.get_tracer
+atexit.register(registry.close)
+
+
+def configure_from_settings(path, process_tag=''):
+    import settings
+    registry.configure(path, level=settings.trace_level, 
+                       sample_rate=settings.trace_sample_rate,
+                       buffer_size=settings.trace_buffer_size, 
+                       process_tag=process_tag)
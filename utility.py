@@ -1,5 +1,4 @@
 from high_frequency_trading.hft.incoming_message import IncomingWSMessage, IncomingMessage
-from twisted.internet import reactor, error
 from random import randint, choice
 from shutil import copyfile
 import subprocess
@@ -16,7 +15,21 @@ log = logging.getLogger(__name__)
 SESSION_CODE_CHARSET = string.ascii_lowercase + string.digits  # otree <3
 
 
+# set when a process runs off a session manifest (manifest.py)
+_session_parameters = None
+_initial_market_view = None
+
+
+def use_parameters(params: dict, initial_market_view=None):
+    """ serve these parameters instead of reading parameters.yaml """
+    global _session_parameters, _initial_market_view
+    _session_parameters = params
+    _initial_market_view = initial_market_view
+
+
 def get_simulation_parameters():
+    if _session_parameters is not None:
+        return dict(_session_parameters)
     custom_parameters = read_yaml(settings.custom_config_path)
     merged_parameters = settings.default_simulation_parameters.copy()
     if custom_parameters:
@@ -27,16 +40,16 @@ def get_simulation_parameters():
 
 
 def get_elo_agent_parameters(
-        parameter_names=('a_x_multiplier', 'a_y_multiplier', 'speed_unit_cost')
-    ):
-    all_parameters = get_simulation_parameters()
+        parameter_names=('a_x_multiplier', 'a_y_multiplier', 'speed_unit_cost'),
+        params=None):
+    all_parameters = params or get_simulation_parameters()
     return {k: all_parameters[k] for k in parameter_names}
 
 
-def copy_params_to_logs(session_id: str):
+def copy_params_to_logs(session_id: str, params=None):
     path = settings.params_export_path.format(
         session_id=session_id, 
-        params=get_simulation_parameters(),
+        params=params or get_simulation_parameters(),
         timestamp=datetime.datetime.now(),
     )
     copyfile(settings.custom_config_path, path)
@@ -46,9 +59,11 @@ def get_interactive_agent_count(agent_events):
     return max([int(row[1]) for row in agent_events])
 
 
-def get_traders_initial_market_view():
-    result = settings.initial_trader_market_view
-    for k, v in get_simulation_parameters().items():
+def get_traders_initial_market_view(params=None):
+    if params is None and _initial_market_view is not None:
+        return dict(_initial_market_view)
+    result = dict(settings.initial_trader_market_view)
+    for k, v in (params or get_simulation_parameters()).items():
         if k in result:
             result[k] = v
     log.info('initial market view of trader: %s' % ' '.join(
@@ -68,7 +83,36 @@ def random_chars(num_chars):
     return ''.join(choice(SESSION_CODE_CHARSET) for _ in range(num_chars))
 
 
-def transform_incoming_message(source, message, external_market_state=None):
+class ExternalFeedState:
+    """
+    traders in elo environment see a single external feed,
+    with many external venues it is the best bid and offer
+    across venues and their mean signed volume
+    """
+
+    def __init__(self, venues=('external',)):
+        self.venues = {venue: {'best_bid': None, 'best_offer': None, 
+            'signed_volume': 0} for venue in venues}
+
+    def update(self, venue, **fields):
+        self.venues[venue].update(fields)
+
+    def feed(self):
+        bids = [v['best_bid'] for v in self.venues.values() 
+            if v['best_bid'] is not None]
+        offers = [v['best_offer'] for v in self.venues.values() 
+            if v['best_offer'] is not None]
+        volumes = [v['signed_volume'] for v in self.venues.values()]
+        return {
+            'e_best_bid': max(bids) if bids else None,
+            'e_best_offer': min(offers) if offers else None,
+            'e_signed_volume': volumes[0] if len(volumes) == 1 else (
+                sum(volumes) / len(volumes)),
+        }
+
+
+def transform_incoming_message(source, message, external_market_state=None,
+                               venue='external'):
     """ this handles key mismatches in messages
         between the otree app and simulator"""
     def transform_external_proxy_msg(message):
@@ -82,23 +126,14 @@ def transform_incoming_message(source, message, external_market_state=None):
             return message
         if not external_market_state:
             raise Exception('external_market_state is not set.')
-        if message['type'] == 'bbo':
-            message['e_best_bid'] = message['best_bid']
-            message['e_best_offer'] = message['best_offer']
-            external_market_state['e_best_bid'] = message['best_bid']
-            external_market_state['e_best_offer'] = message['best_offer']
-            message['e_signed_volume'] = external_market_state['e_signed_volume']
-        if message['type'] == 'post_batch':
-            message['e_best_bid'] = message['best_bid']
-            message['e_best_offer'] = message['best_offer']
-            external_market_state['e_best_bid'] = message['best_bid']
-            external_market_state['e_best_offer'] = message['best_offer']
-            message['e_signed_volume'] = external_market_state['e_signed_volume']
+        if message['type'] in ('bbo', 'post_batch'):
+            external_market_state.update(venue, 
+                best_bid=message['best_bid'], 
+                best_offer=message['best_offer'])
         if message['type'] == 'signed_volume':
-            message['e_signed_volume'] = message['signed_volume']
-            message['e_best_bid'] = external_market_state['e_best_bid']
-            message['e_best_offer'] = external_market_state['e_best_offer']
-            external_market_state['e_signed_volume'] = message['signed_volume']
+            external_market_state.update(venue, 
+                signed_volume=message['signed_volume'])
+        message.update(external_market_state.feed())
         message['type'] = 'external_feed_change'
         return message
     message['subsession_id'] = 0
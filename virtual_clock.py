@@ -0,0 +1,119 @@
+import datetime
+import sys
+import time
+import logging
+
+try:
+    from twisted.internet.epollreactor import EPollReactor as _PlatformReactor
+except ImportError:
+    from twisted.internet.selectreactor import SelectReactor as _PlatformReactor
+
+log = logging.getLogger(__name__)
+
+# a reactor that runs on virtual time.
+# scheduled calls run in the same order as they would
+# on the wall clock, but whenever there is no network
+# activity the clock jumps straight to the next scheduled call.
+# must be installed before anything imports twisted.internet.reactor
+#
+# the clock is local to a process, so only sessions whose proxies
+# and agents share one reactor (simulate.py --inprocess, replay.py)
+# can run on it. exchanges are separate processes and stay on the
+# wall clock, FBA batch intervals are not compressed.
+# the clock holds still while orders sent to an exchange wait
+# for a response, so a slow exchange can't fall behind virtual time.
+
+VIRTUAL_CLOCK_FLAG = '--virtual_clock'
+
+
+class InFlightRequests:
+    """ order tokens sent to an exchange and not yet answered """
+
+    def __init__(self, max_wait):
+        # real seconds to wait for a response,
+        # requests the exchange never answers are given up on
+        self.max_wait = max_wait
+        self.sent_at = {}
+        self.expired = 0
+
+    def __len__(self):
+        return len(self.sent_at)
+
+    def sent(self, token):
+        self.sent_at[token] = time.monotonic()
+
+    def answered(self, token):
+        self.sent_at.pop(token, None)
+
+    def waiting(self):
+        if not self.sent_at:
+            return False
+        deadline = time.monotonic() - self.max_wait
+        expired = [token for token, sent_at in self.sent_at.items() 
+                   if sent_at < deadline]
+        for token in expired:
+            del self.sent_at[token]
+        if expired:
+            if not self.expired:
+                log.warning('no exchange response in %ss to %s, moving '
+                            'the virtual clock on.' % (self.max_wait, expired))
+            self.expired += len(expired)
+        return bool(self.sent_at)
+
+
+class VirtualClockReactor(_PlatformReactor):
+
+    def __init__(self, io_grace=0.002, max_wait=1.0):
+        # ReactorBase.__init__ may already ask for the time
+        self._virtual_now = 0.0
+        self._io_activity = 0
+        # how long to wait for the network (exchanges, other processes)
+        # in real time before moving the virtual clock forward
+        self.io_grace = io_grace
+        # market proxies record their requests to exchanges here
+        self.in_flight = InFlightRequests(max_wait)
+        self.epoch = datetime.datetime.now()
+        super().__init__()
+
+    def seconds(self):
+        return self._virtual_now
+
+    def now(self):
+        return self.epoch + datetime.timedelta(seconds=self._virtual_now)
+
+    def _doReadOrWrite(self, *args, **kwargs):
+        self._io_activity += 1
+        return super()._doReadOrWrite(*args, **kwargs)
+
+    def doIteration(self, timeout):
+        self._io_activity = 0
+        if timeout is None or timeout <= 0:
+            super().doIteration(timeout)
+            return
+        super().doIteration(min(timeout, self.io_grace))
+        if not self._io_activity and not self.in_flight.waiting():
+            self._virtual_now += timeout
+
+
+def is_requested(argv=None):
+    argv = sys.argv if argv is None else argv
+    return VIRTUAL_CLOCK_FLAG in argv
+
+
+def install(io_grace=0.002):
+    from twisted.internet.main import installReactor
+    reactor = VirtualClockReactor(io_grace=io_grace)
+    installReactor(reactor)
+    reactor.callWhenRunning(_use_virtual_timestamps, reactor)
+    return reactor
+
+
+def install_if_requested(argv=None):
+    if is_requested(argv):
+        return install()
+
+
+def _use_virtual_timestamps(reactor):
+    from db import db
+    db.timestamp_source = reactor.now
+    log.info('running on virtual clock, epoch %s.' % reactor.epoch)
@@ -0,0 +1,242 @@
+# worker daemon, launches session processes for simulate.py
+# running on other hosts, see launchers.WorkerLauncher
+#
+#   WORKER_TOKEN=secret python worker.py --host 0.0.0.0 --port 9500 \
+#       --advertise_host 10.0.0.5
+#
+# a json line protocol, every request carries the shared
+# settings.worker_token, a connection with a wrong one is dropped.
+# only settings.worker_scripts are run. requests:
+#   {"type": "info"}
+#   {"type": "launch", "id": .., "cmd": [..], "kind": .., "listen": [..],
+#    "ports": [..], "ready_port": .., "env": {..}}
+#   {"type": "signal", "id": .., "signal": "TERM" | "KILL"}
+#   {"type": "manifest", "session": .., "files": {name: base64, ..}}
+# events:
+#   info, launched (with ports or an error), ready, exit (with exit code),
+#   manifest (with the directory it was written to or an error)
+# processes of a connection are killed when it closes.
+import configargparse
+from twisted.internet import protocol, reactor, task
+from twisted.protocols import basic
+from launchers import prepare_command, port_accepts_connections
+from manifest import unpack_manifest
+from zygote import ZygoteProcess
+import settings
+import signal
+import hmac
+import json
+import sys
+import os
+import logging
+
+log = logging.getLogger(__name__)
+
+p = configargparse.getArgParser()
+p.add('--host', default='127.0.0.1', help='interface to listen on, '
+      '0.0.0.0 to take sessions from other hosts')
+p.add('--port', default=settings.worker_port, type=int)
+p.add('--advertise_host', default='127.0.0.1',
+      help='address other hosts reach servers on this worker at')
+p.add('--cpus', default=os.cpu_count(), type=int,
+      help='cpu capacity offered to sessions')
+p.add('--zygote', help='fork processes from the zygote (zygote.py) '
+      'listening on this unix socket')
+p.add('--debug', action='store_true')
+options, args = p.parse_known_args()
+
+
+class SessionProcess(protocol.ProcessProtocol):
+
+    def __init__(self, conn, process_id):
+        self.conn = conn
+        self.process_id = process_id
+
+    def processEnded(self, reason):
+        code = reason.value.exitCode
+        if code is None:
+            code = -(reason.value.signal or 1)
+        log.info('%s exited with %s' % (self.process_id, code))
+        self.conn.process_ended(self.process_id, code)
+
+
+class ZygoteChild:
+    """ a process forked by the zygote, watched like a spawned one """
+
+    def __init__(self, conn, process_id, proc):
+        self.conn = conn
+        self.process_id = process_id
+        self.proc = proc
+        self.pid = proc.pid
+        self.watch = task.LoopingCall(self.check)
+        self.watch.start(0.05, now=False)
+
+    def check(self):
+        if self.proc.poll() is not None:
+            self.watch.stop()
+            log.info('%s exited with %s' % (self.process_id, 
+                                            self.proc.returncode))
+            self.conn.process_ended(self.process_id, self.proc.returncode)
+
+    def signalProcess(self, signal_name):
+        self.proc.send_signal(getattr(signal, 'SIG' + signal_name))
+
+
+class WorkerProtocol(basic.LineReceiver):
+    delimiter = b'\n'
+
+    def __init__(self, factory):
+        self.factory = factory
+        self.processes = {}
+        self.readiness_checks = {}
+
+    def send(self, **msg):
+        if self.transport is not None and self.transport.connected:
+            self.sendLine(json.dumps(msg).encode('utf-8'))
+
+    def lineReceived(self, line):
+        try:
+            msg = json.loads(line.decode('utf-8'))
+            token = str(msg.get('token', ''))
+            handler = getattr(self, 'handle_%s' % msg['type'])
+        except (ValueError, KeyError, AttributeError):
+            log.exception('invalid request, ignoring: %s' % line)
+            return
+        if not hmac.compare_digest(token, settings.worker_token):
+            log.error('wrong token from %s, dropping connection.' % (
+                self.transport.getPeer(), ))
+            self.transport.loseConnection()
+            return
+        handler(msg)
+
+    def handle_info(self, msg):
+        self.send(type='info', host=options.advertise_host, cpus=options.cpus,
+                  running=sum(len(c.processes) for c in self.factory.connections),
+                  load=os.getloadavg()[0])
+
+    def handle_launch(self, msg):
+        process_id = msg['id']
+        try:
+            check_command(msg['cmd'])
+            cmd, sockets, ports = prepare_command(
+                msg['cmd'], msg.get('listen', ()), msg.get('ports', ()),
+                bind_host='0.0.0.0')
+        except (KeyError, IndexError, OSError, ValueError) as e:
+            self.send(type='launched', id=process_id, error=str(e))
+            return
+        env = dict(os.environ)
+        env.update({key: str(value) for key, value in
+                    (msg.get('env') or {}).items()
+                    if key in settings.worker_env})
+        transport = None
+        if options.zygote:
+            try:
+                transport = ZygoteChild(self, process_id, ZygoteProcess(
+                    cmd, path=options.zygote, env=env, 
+                    pass_fds=[sock.fileno() for sock in sockets.values()]))
+            except OSError as e:
+                log.warning('zygote at %s failed, starting %s: %s' % (
+                    options.zygote, process_id, e))
+        if transport is None:
+            child_fds = {0: 0, 1: 1, 2: 2}
+            child_fds.update({sock.fileno(): sock.fileno() for sock in
+                              sockets.values()})
+            transport = reactor.spawnProcess(
+                SessionProcess(self, process_id), sys.executable,
+                [sys.executable] + cmd, env=env, childFDs=child_fds)
+        # the process owns the listening sockets now
+        for sock in sockets.values():
+            sock.close()
+        self.processes[process_id] = transport
+        log.info('launched %s: %s' % (process_id, ' '.join(cmd)))
+        self.send(type='launched', id=process_id, pid=transport.pid,
+                  ports=ports)
+        ready_port = msg.get('ready_port')
+        if ready_port is None:
+            self.send(type='ready', id=process_id)
+        else:
+            check = task.LoopingCall(self.check_ready, process_id,
+                                     ports[ready_port])
+            self.readiness_checks[process_id] = check
+            check.start(0.05)
+
+    def handle_manifest(self, msg):
+        try:
+            directory = unpack_manifest(msg['session'], msg['files'])
+        except (KeyError, TypeError, ValueError, OSError) as e:
+            log.error('failed to unpack manifest: %s' % e)
+            self.send(type='manifest', error=str(e))
+            return
+        self.send(type='manifest', directory=directory)
+
+    def check_ready(self, process_id, port):
+        if port_accepts_connections(port):
+            self.readiness_checks.pop(process_id).stop()
+            self.send(type='ready', id=process_id)
+
+    def handle_signal(self, msg):
+        transport = self.processes.get(msg['id'])
+        if transport is not None:
+            try:
+                transport.signalProcess(msg.get('signal', 'TERM'))
+            except Exception:
+                log.exception('failed to signal %s' % msg['id'])
+
+    def process_ended(self, process_id, code):
+        self.processes.pop(process_id, None)
+        check = self.readiness_checks.pop(process_id, None)
+        if check is not None:
+            check.stop()
+        self.send(type='exit', id=process_id, code=code)
+
+    def connectionMade(self):
+        self.factory.connections.append(self)
+
+    def connectionLost(self, reason):
+        self.factory.connections.remove(self)
+        for process_id, transport in list(self.processes.items()):
+            log.warning('client left, killing %s' % process_id)
+            try:
+                transport.signalProcess('KILL')
+            except Exception:
+                pass
+
+
+def check_command(cmd):
+    """ raises ValueError unless `cmd` runs a session script """
+    if not isinstance(cmd, list) or not cmd or not all(
+            isinstance(arg, str) for arg in cmd):
+        raise ValueError('command must be a list of strings')
+    # interpreter flags (-c, -m) never get past this
+    if cmd[0] not in settings.worker_scripts:
+        raise ValueError('%s is not one of %s' % (
+            cmd[0], ', '.join(settings.worker_scripts)))
+
+
+class WorkerFactory(protocol.ServerFactory):
+
+    def __init__(self):
+        self.connections = []
+
+    def buildProtocol(self, addr):
+        return WorkerProtocol(self)
+
+
+def main():
+    if not settings.worker_token:
+        p.error('set WORKER_TOKEN, the worker runs commands for '
+                'whoever knows it')
+    reactor.listenTCP(options.port, WorkerFactory(), interface=options.host)
+    log.info('worker listening on %s:%s, %s cpus' % (
+        options.host or '*', options.port, options.cpus))
+    reactor.run()
+
+
+if __name__ == '__main__':
+    logging.basicConfig(
+        level=logging.DEBUG if options.debug else logging.INFO,
+        filename=settings.logs_dir + 'worker_%s.log' % options.port,
+        format="[%(asctime)s.%(msecs)03d] %(levelname)s \
+        [%(name)s.%(funcName)s:%(lineno)d] %(message)s",
+        datefmt='%H:%M:%S')
+    main()
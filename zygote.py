@@ -0,0 +1,294 @@
+# zygote, pays interpreter startup and heavy imports once per host.
+# it imports settings.zygote_preload and waits on a unix socket,
+# each request forks a child that runs a script as if started with
+#
+#   python <script> <args..>
+#
+# the client hands over its stdio and inherited descriptors with
+# the request, the child gets them at the same descriptor numbers.
+# the zygote reports the pid of the child and later its exit code,
+# a child is killed when the connection of its client closes.
+#
+#   python zygote.py &
+#   python simulate.py --zygote
+#
+# modules importing the twisted reactor can not be preloaded,
+# the reactor of a child is installed after the fork.
+import settings
+from array import array
+import importlib
+import subprocess
+import logging
+import select
+import signal
+import socket
+import random
+import runpy
+import fcntl
+import json
+import time
+import sys
+import os
+
+log = logging.getLogger(__name__)
+
+# most descriptors a request can carry, stdio included
+MAX_FDS = 16
+REACTOR_MODULE = 'twisted.internet.reactor'
+
+
+def preload(modules):
+    for module in modules:
+        try:
+            importlib.import_module(module)
+        except ImportError as e:
+            log.warning('could not preload %s: %s' % (module, e))
+            continue
+        if REACTOR_MODULE in sys.modules:
+            raise RuntimeError('preloading %s installs the twisted reactor, '
+                               'remove it from settings.zygote_preload' % module)
+
+
+def exit_code(status):
+    """ as subprocess.Popen reports it """
+    if os.WIFSIGNALED(status):
+        return -os.WTERMSIG(status)
+    return os.WEXITSTATUS(status)
+
+
+def receive_request(conn):
+    data, fds = b'', []
+    while not data.endswith(b'\n'):
+        chunk, ancdata, _, _ = conn.recvmsg(
+            65536, socket.CMSG_SPACE(MAX_FDS * array('i').itemsize))
+        if not chunk:
+            raise ConnectionError('client left before its request was read')
+        data += chunk
+        for level, kind, payload in ancdata:
+            if level == socket.SOL_SOCKET and kind == socket.SCM_RIGHTS:
+                fds.extend(array('i', payload[:len(payload) - (
+                    len(payload) % array('i').itemsize)]))
+    return json.loads(data.decode('utf-8')), fds
+
+
+def run_child(request, fds):
+    """ in the forked child, never returns """
+    code = 1
+    try:
+        # the script configures logging, the log file
+        # of the zygote is closed before its descriptor is reused
+        root = logging.getLogger()
+        for handler in list(root.handlers):
+            root.removeHandler(handler)
+            handler.close()
+        # received descriptors go where the client had them,
+        # out of the way first so none is overwritten
+        targets = request['fds']
+        high = [fcntl.fcntl(fd, fcntl.F_DUPFD, 256) for fd in fds]
+        for fd in fds:
+            os.close(fd)
+        for fd, target in zip(high, targets):
+            os.dup2(fd, target)
+            os.close(fd)
+        for signum in (signal.SIGCHLD, signal.SIGTERM, signal.SIGINT):
+            signal.signal(signum, signal.SIG_DFL)
+        os.chdir(request['cwd'])
+        os.environ.clear()
+        os.environ.update(request['env'])
+        # settings read the environment of the client
+        importlib.reload(settings)
+        # children must not share random state
+        random.seed()
+        if 'numpy' in sys.modules:
+            sys.modules['numpy'].random.seed()
+        script = request['argv'][0]
+        sys.argv = list(request['argv'])
+        sys.path[0] = os.path.dirname(os.path.abspath(script))
+        runpy.run_path(script, run_name='__main__')
+        code = 0
+    except SystemExit as e:
+        if e.code is None:
+            code = 0
+        elif isinstance(e.code, int):
+            code = e.code
+        else:
+            print(e.code, file=sys.stderr)
+    except BaseException:
+        import traceback
+        traceback.print_exc()
+    finally:
+        try:
+            import atexit
+            atexit._run_exitfuncs()
+            logging.shutdown()
+            sys.stdout.flush()
+            sys.stderr.flush()
+        finally:
+            os._exit(code)
+
+
+def send_line(conn, msg):
+    try:
+        conn.sendall(json.dumps(msg).encode('utf-8') + b'\n')
+    except OSError:
+        pass
+
+
+def serve(path):
+    if os.path.exists(path):
+        os.unlink(path)
+    listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    listener.bind(path)
+    listener.listen(socket.SOMAXCONN)
+    # pid -> connection of the client that asked for it,
+    # None once the client is gone
+    children = {}
+    log.info('zygote ready on %s' % path)
+    while True:
+        readable, _, _ = select.select(
+            [listener] + [c for c in children.values() if c], [], [], 0.05)
+        for sock in readable:
+            if sock is listener:
+                conn, _ = listener.accept()
+                try:
+                    request, fds = receive_request(conn)
+                except ConnectionError:
+                    # availability checks connect and leave
+                    conn.close()
+                    continue
+                except (ValueError, OSError):
+                    log.exception('invalid request')
+                    conn.close()
+                    continue
+                pid = os.fork()
+                if pid == 0:
+                    listener.close()
+                    for other in children.values():
+                        if other:
+                            other.close()
+                    conn.close()
+                    run_child(request, fds)
+                for fd in fds:
+                    os.close(fd)
+                children[pid] = conn
+                send_line(conn, {'pid': pid})
+                log.info('forked %s: %s' % (pid, ' '.join(request['argv'])))
+            elif not sock.recv(1):
+                # client is gone, so is its child
+                for pid, conn in children.items():
+                    if conn is sock:
+                        log.warning('client of %s left, killing it' % pid)
+                        os.kill(pid, signal.SIGKILL)
+                        children[pid] = None
+                sock.close()
+        # reap children
+        while children:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except ChildProcessError:
+                break
+            if pid == 0:
+                break
+            conn = children.pop(pid, None)
+            if conn is not None:
+                send_line(conn, {'exit': exit_code(status)})
+                conn.close()
+
+
+class ZygoteProcess:
+    """ a child of the zygote, driven like subprocess.Popen """
+
+    def __init__(self, args, path=None, pass_fds=(), cwd=None, env=None):
+        self.args = list(args)
+        self.returncode = None
+        self.buffer = b''
+        fds = [0, 1, 2] + list(pass_fds)
+        request = {
+            'argv': self.args,
+            'cwd': cwd or os.getcwd(),
+            'env': dict(os.environ if env is None else env),
+            'fds': fds,
+        }
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.connect(path or settings.zygote_socket)
+        data = json.dumps(request).encode('utf-8') + b'\n'
+        sent = self.sock.sendmsg([data], [(
+            socket.SOL_SOCKET, socket.SCM_RIGHTS, array('i', fds))])
+        if sent < len(data):
+            self.sock.sendall(data[sent:])
+        self.pid = self.read_message(None)['pid']
+
+    def read_message(self, timeout):
+        # settimeout(0) would make recv non blocking,
+        # so the socket blocks and select does the waiting
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while b'\n' not in self.buffer:
+            if deadline is not None:
+                readable, _, _ = select.select(
+                    [self.sock], [], [], max(0, deadline - time.monotonic()))
+                if not readable:
+                    raise socket.timeout('timed out')
+            chunk = self.sock.recv(4096)
+            if not chunk:
+                raise ConnectionError('zygote went away')
+            self.buffer += chunk
+        line, self.buffer = self.buffer.split(b'\n', 1)
+        return json.loads(line.decode('utf-8'))
+
+    def wait(self, timeout=None):
+        if self.returncode is None:
+            try:
+                msg = self.read_message(timeout)
+            except (socket.timeout, BlockingIOError):
+                raise subprocess.TimeoutExpired(self.args, timeout)
+            except ConnectionError:
+                msg = {'exit': -signal.SIGKILL}
+            self.returncode = msg['exit']
+            self.sock.close()
+        return self.returncode
+
+    def poll(self):
+        if self.returncode is None:
+            readable, _, _ = select.select([self.sock], [], [], 0)
+            if readable:
+                self.wait()
+        return self.returncode
+
+    def send_signal(self, signum):
+        if self.returncode is None:
+            try:
+                os.kill(self.pid, signum)
+            except ProcessLookupError:
+                pass
+
+    def terminate(self):
+        self.send_signal(signal.SIGTERM)
+
+    def kill(self):
+        self.send_signal(signal.SIGKILL)
+
+
+def zygote_available(path=None):
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(path or settings.zygote_socket)
+    except OSError:
+        return False
+    finally:
+        sock.close()
+    return True
+
+
+if __name__ == '__main__':
+    logging.basicConfig(
+        level=logging.INFO,
+        filename=settings.logs_dir + 'zygote.log',
+        format="[%(asctime)s.%(msecs)03d] %(levelname)s \
+        [%(name)s.%(funcName)s:%(lineno)d] %(message)s",
+        datefmt='%H:%M:%S')
+    start = time.monotonic()
+    preload(settings.zygote_preload)
+    log.info('preloaded %s modules in %.3f seconds' % (
+        len(settings.zygote_preload), time.monotonic() - start))
+    signal.signal(signal.SIGTERM, lambda *_: sys.exit(0))
+    serve(sys.argv[1] if len(sys.argv) > 1 else settings.zygote_socket)